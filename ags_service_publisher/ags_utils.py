@@ -2,631 +2,1194 @@ from __future__ import unicode_literals
 
 import os
 import getpass
+import itertools
 import json
+import math
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 from ssl import create_default_context
-from urllib3.poolmanager import PoolManager
+from urllib3.util.retry import Retry
 from xml.etree import ElementTree
 
 import requests
-from requests.compat import urljoin
+from requests.compat import urljoin, urlparse
 from requests.adapters import HTTPAdapter
 
 from datasources import parse_database_from_service_string
 from helpers import split_quoted_string, unquote_string
-from logging_io import setup_logger
+from logging_io import setup_logger, LazyFormat, LazyJson
+from request_metrics import request_metrics, get_operation_name
 
 log = setup_logger(__name__)
 
+default_pool_size = 10
+default_max_retries = 3
+default_bulk_operation_size = 100
+default_max_concurrent_restarts = 4
+default_max_services_down = 10
+default_poll_interval = 1
+default_max_poll_interval = 10
+default_upload_part_size = 16 * 1024 * 1024
+default_max_concurrent_upload_parts = 4
+default_publishing_job_timeout = 3600
+publish_service_definition_tool_path = '/arcgis/rest/services/System/PublishingTools/GPServer/Publish Service Definition'
+failed_job_statuses = ('esriJobFailed', 'esriJobCancelled', 'esriJobTimedOut')
 
-def create_session(server_url, proxies=None):
+
+def create_session(server_url, proxies=None, pool_size=default_pool_size, max_retries=default_max_retries):
     session = requests.Session()
     if proxies:
         session.proxies = proxies
-    adapter = SSLContextAdapter()
+    adapter = SSLContextAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=max_retries, backoff_factor=0.5, raise_on_status=False)
+    )
     session.mount(server_url, adapter)
     return session
 
 
-def generate_token(server_url, username=None, password=None, expiration=15, ags_instance=None, session=None):
-    username, password = prompt_for_credentials(username, password, ags_instance)
-    log.info('Generating token (URL: {}, user: {})'.format(server_url, username))
-    url = urljoin(server_url, '/arcgis/admin/generateToken')
-    try:
-        r = session.post(
-            url,
-            {
-                'username': username,
-                'password': password,
-                'client': 'requestip',
-                'expiration': str(expiration),
-                'f': 'json'
-            }
-        )
-        log.debug('Request URL: {}'.format(r.url))
-        assert r.status_code == 200
-        data = r.json()
-        if data.get('status') == 'error':
-            raise RuntimeError(data.get('messages'))
-        log.info(
-            'Successfully generated token (URL: {}, user: {}, expires: {}'
-            .format(server_url, username, data['expires'])
-        )
-        return data['token']
-    except StandardError:
-        log.exception('An error occurred while generating token (URL: {}, user: {})'.format(server_url, username))
-        raise
+class AgsAdminClient(object):
+    """Client for the ArcGIS Server Administrator and REST APIs of a single ArcGIS Server instance.
+    Holds the instance's token and base URLs, and owns one long-lived session with a pool of keep-alive connections
+    (unless an existing session is passed in), so that a whole batch of requests reuses the same connections.
+    May be used as a context manager, in which case its session is closed on exit.
+    If a response cache and TTL are given, the responses to read-only requests (service folder and service listings,
+    service info and manifests) are cached on disk and reused for up to TTL seconds."""
 
+    def __init__(
+        self,
+        server_url,
+        token=None,
+        proxies=None,
+        pool_size=default_pool_size,
+        max_retries=default_max_retries,
+        ags_instance=None,
+        session=None,
+        token_manager=None,
+        response_cache=None,
+        response_cache_ttl=None
+    ):
+        self.server_url = server_url
+        self.token = token
+        self.token_expires = None
+        self.token_manager = token_manager
+        self.ags_instance = ags_instance
+        self.admin_url = urljoin(server_url, '/arcgis/admin')
+        self.admin_services_url = self.admin_url + '/services'
+        self.admin_uploads_url = self.admin_url + '/uploads'
+        self.rest_services_url = urljoin(server_url, '/arcgis/rest/services')
+        self.service_reports = {}
+        self.response_cache = response_cache
+        self.response_cache_ttl = response_cache_ttl
+        self.owns_session = session is None
+        self.session = create_session(server_url, proxies, pool_size, max_retries) if session is None else session
 
-def get_site_mode(server_url, token, session=None):
-    log.debug('Getting site mode (URL: {})'.format(server_url))
-    url = urljoin(server_url, 'arcgis/admin/mode')
-    try:
-        r = session.post(url, params={'f': 'json'}, data={'token': token})
-        log.debug('Request URL: {}'.format(r.url))
-        assert (r.status_code == 200)
-        data = r.json()
-        if data.get('status') == 'error':
-            raise RuntimeError(data.get('messages'))
-        site_mode = data.get('siteMode')
-        log.debug(
-            'Site mode info (URL {}): {}'
-            .format(r.url, json.dumps(data, indent=4))
+    @classmethod
+    def from_user_config(cls, user_config, env_name, ags_instance):
+        from response_cache import response_cache
+        from tokens import token_manager
+        ags_instance_props = user_config['environments'][env_name]['ags_instances'][ags_instance]
+        response_cache_ttl = ags_instance_props.get('response_cache_ttl', user_config.get('response_cache_ttl'))
+        return cls(
+            ags_instance_props['url'],
+            token_manager.get_token(ags_instance, ags_instance_props.get('token')),
+            proxies=ags_instance_props.get('proxies') or user_config.get('proxies'),
+            pool_size=max(
+                default_pool_size,
+                ags_instance_props.get('max_concurrent_requests') or user_config.get('max_concurrent_requests') or 0
+            ),
+            ags_instance=ags_instance,
+            token_manager=token_manager,
+            response_cache=response_cache if response_cache_ttl else None,
+            response_cache_ttl=response_cache_ttl
         )
-        return site_mode
-    except StandardError:
-        log.exception('An error occurred while getting site mode (URL: {})'.format(server_url))
-        raise
 
+    def __enter__(self):
+        return self
 
-def set_site_mode(server_url, token, site_mode, session=None):
-    log.debug('Setting site mode to {} (URL: {})'.format(site_mode, server_url))
-    url = urljoin(server_url, 'arcgis/admin/mode/update')
-    try:
-        r = session.post(url, params={'f': 'json', 'siteMode': site_mode, 'runAsync': False}, data={'token': token})
-        log.debug('Request URL: {}'.format(r.url))
-        assert (r.status_code == 200)
-        data = r.json()
-        status = data.get('status')
-        if status == 'error':
-            raise RuntimeError(data.get('messages'))
-        if status != 'success':
-            raise RuntimeError(data)
-        log.debug(
-            'Site mode update result (URL {}): {}'
-            .format(r.url, status)
-        )
-        return status
-    except StandardError:
-        log.exception('An error occurred while setting site mode to {} (URL: {})'.format(site_mode, server_url))
-        raise
+    def __exit__(self, *args):
+        self.close()
 
+    def close(self):
+        if self.owns_session:
+            self.session.close()
 
-def list_service_folders(server_url, token, session=None):
-    log.debug('Listing service folders (URL: {})'.format(server_url))
-    url = urljoin(server_url, '/arcgis/admin/services')
-    try:
-        r = session.post(url, params={'f': 'json'}, data={'token': token})
-        log.debug('Request URL: {}'.format(r.url))
-        assert (r.status_code == 200)
-        data = r.json()
-        if data.get('status') == 'error':
-            raise RuntimeError(data.get('messages'))
-        service_folders = data.get('folders')
-        log.debug(
-            'Service folders (URL {}): {}'
-            .format(r.url, json.dumps(service_folders, indent=4))
+    def admin_service_url(self, service_name, service_folder=None, service_type='MapServer', operation=None):
+        return '/'.join(
+            part for part in (
+                self.admin_services_url,
+                service_folder,
+                '{}.{}'.format(service_name, service_type),
+                operation
+            ) if part
         )
-        return service_folders
-    except StandardError:
-        log.exception('An error occurred while listing service folders (URL: {})'.format(server_url))
-        raise
 
+    def rest_service_url(self, service_name, service_folder=None, service_type='MapServer', operation=None):
+        return '/'.join(
+            part for part in (
+                self.rest_services_url,
+                service_folder,
+                '{}/{}'.format(service_name, service_type),
+                operation
+            ) if part
+        )
 
-def list_services(server_url, token, service_folder=None, session=None):
-    log.debug('Listing services (URL: {}, Folder: {})'.format(server_url, service_folder))
-    url = urljoin(
-        server_url,
-        '/'.join(
-            (
-                part for part in (
-                    '/arcgis/admin/services',
-                    service_folder
-                ) if part
+    def get_token(self):
+        if self.token_manager:
+            self.token = self.token_manager.get_token(self.ags_instance, self.token)
+        return self.token
+
+    def post(self, url, params=None, data=None, files=None, stream=False):
+        # Every request made to the instance goes through here so that its timing can be recorded
+        status_code = None
+        num_bytes = 0
+        start_time = time.time()
+        try:
+            r = self.session.post(url, params=params, data=data, files=files, stream=stream)
+            status_code = r.status_code
+            # Streamed responses have not been read yet, so rely on the Content-Length header for those
+            num_bytes = int(r.headers.get('Content-Length', 0)) if stream else len(r.content)
+            return r
+        finally:
+            request_metrics.record(
+                get_operation_name(url),
+                self.ags_instance or urlparse(self.server_url).netloc,
+                status_code,
+                num_bytes,
+                time.time() - start_time
             )
-        )
-    )
-    try:
-        r = session.post(url, params={'f': 'json'}, data={'token': token})
+
+    def request(self, url, params=None, files=None, data=None, stream=False):
+        r = self.post(url, params, dict(data or {}, token=self.get_token()), files, stream)
         log.debug('Request URL: {}'.format(r.url))
         assert (r.status_code == 200)
-        data = r.json()
-        if data.get('status') == 'error':
-            raise RuntimeError(data.get('messages'))
-        log.debug(
-            '{} services (URL {}): {}'
-            .format(service_folder, r.url, json.dumps(data, indent=4))
-        )
-        services = data['services']
-        return services
-    except StandardError:
-        log.exception(
-            'An error occurred while listing services (URL: {}, Folder: {})'
-            .format(server_url, service_folder)
+        return r
+
+    def get_cached_response(self, url, fetch):
+        if self.response_cache is None:
+            return fetch()
+        return self.response_cache.get_or_fetch(
+            self.ags_instance,
+            self.response_cache.key_from_url(url),
+            self.response_cache_ttl,
+            fetch
         )
-        raise
 
+    def request_json_cached(self, url):
+        return self.get_cached_response(url, lambda: self.request_json(url))
 
-def list_service_workspaces(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
-    if service_type == 'GeometryServer':
-        log.warn(
-            'Unsupported service type {} for service {} in folder {}'
-            .format(service_type, service_name, service_folder)
-        )
-        return
-    log.debug(
-        'Listing workspaces for service {} (URL: {}, Folder: {})'
-        .format(service_name, server_url, service_folder)
-    )
-    url = urljoin(
-        server_url,
-        '/'.join(
-            (
-                part for part in (
-                    '/arcgis/admin/services',
-                    service_folder,
-                    '{}.{}'.format(service_name, service_type),
-                    'iteminfo/manifest/manifest.xml'
-                ) if part
+    def invalidate_cached_responses(self, service_name, service_folder=None, service_type='MapServer'):
+        if self.response_cache is not None:
+            self.response_cache.invalidate_service(self.ags_instance, service_name, service_folder, service_type)
+
+    def request_json(self, url, params=None, files=None, data=None, renew_invalid_token=True):
+        r = self.request(url, dict(params or {}, f='json'), files, data)
+        response_data = r.json()
+        if renew_invalid_token and is_invalid_token_response(response_data):
+            if self.token_manager and self.token_manager.can_renew(self.ags_instance):
+                log.warn('Token rejected by ArcGIS Server instance {}, renewing token'.format(self.ags_instance))
+                self.token = self.token_manager.renew_token(self.ags_instance)
+                return self.request_json(url, params, files, data, False)
+            log.error(
+                'Token rejected by ArcGIS Server instance {} (URL {}), and it cannot be renewed as no credentials have '
+                'been registered in this process. Generate a new token with Runner.generate_tokens (with '
+                'reuse_credentials=True, in the same process as the job, to have it renewed automatically).'
+                .format(self.ags_instance, self.server_url)
             )
-        )
-    )
-    try:
-        r = session.post(url, data={'token': token})
-        log.debug('Request URL: {}'.format(r.url))
-        assert (r.status_code == 200)
-        data = r.text
-        datasets = parse_datasets_from_service_manifest(data)
-        conn_props = parse_connection_properties_from_service_manifest(data)
-
-        for dataset_props in datasets:
-            yield dict(
-                user=conn_props.get('USER', 'n/a'),
-                database=parse_database_from_service_string(conn_props.get('INSTANCE', 'n/a')),
-                version=conn_props.get('VERSION', 'n/a'),
-                **dataset_props
-            )
-    except StandardError:
-        log.exception(
-            'An error occurred while listing workspaces for service {}/{}'
-            .format(service_folder, service_name)
-        )
-        raise
+        if response_data.get('status') == 'error':
+            raise RuntimeError(response_data.get('messages'))
+        if response_data.get('error'):
+            raise RuntimeError(response_data.get('error').get('message'))
+        return response_data
+
+    def generate_token(self, username=None, password=None, expiration=15):
+        username, password = prompt_for_credentials(username, password, self.ags_instance)
+        log.info('Generating token (URL: {}, user: {})'.format(self.server_url, username))
+        url = self.admin_url + '/generateToken'
+        try:
+            r = self.post(
+                url,
+                data={
+                    'username': username,
+                    'password': password,
+                    'client': 'requestip',
+                    'expiration': str(expiration),
+                    'f': 'json'
+                }
+            )
+            log.debug('Request URL: {}'.format(r.url))
+            assert r.status_code == 200
+            data = r.json()
+            if data.get('status') == 'error':
+                raise RuntimeError(data.get('messages'))
+            log.info(
+                'Successfully generated token (URL: {}, user: {}, expires: {}'
+                .format(self.server_url, username, data['expires'])
+            )
+            self.token = data['token']
+            self.token_expires = data.get('expires')
+            return self.token
+        except StandardError:
+            log.exception('An error occurred while generating token (URL: {}, user: {})'.format(self.server_url, username))
+            raise
 
+    def get_site_mode(self):
+        log.debug('Getting site mode (URL: {})'.format(self.server_url))
+        try:
+            data = self.request_json(self.admin_url + '/mode')
+            site_mode = data.get('siteMode')
+            log.debug(LazyFormat(
+                'Site mode info (URL {}): {}',
+                self.server_url, LazyJson(data)
+            ))
+            return site_mode
+        except StandardError:
+            log.exception('An error occurred while getting site mode (URL: {})'.format(self.server_url))
+            raise
 
-def delete_service(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
-    log.info('Deleting service {} (URL {}, Folder: {})'.format(service_name, server_url, service_folder))
-    url = urljoin(
-        server_url,
-        '/'.join(
-            (
-                part for part in (
-                    '/arcgis/admin/services',
-                    service_folder,
-                    '{}.{}'.format(service_name, service_type),
-                    'delete'
-                ) if part
+    def set_site_mode(self, site_mode):
+        log.debug('Setting site mode to {} (URL: {})'.format(site_mode, self.server_url))
+        try:
+            r = self.request(
+                self.admin_url + '/mode/update',
+                {'f': 'json', 'siteMode': site_mode, 'runAsync': False}
             )
-        )
-    )
-    try:
-        r = session.post(url, params={'f': 'json'}, data={'token': token})
-        log.debug('Request URL: {}'.format(r.url))
-        assert (r.status_code == 200)
-        data = r.json()
-        if data.get('status') == 'error':
-            raise RuntimeError(data.get('messages'))
-        log.info(
-            'Service {} successfully deleted (URL {}, Folder: {})'
-            .format(service_name, server_url, service_folder)
-        )
-    except StandardError:
-        log.exception(
-            'An error occurred while deleting service {}/{}'
-            .format(service_folder, service_name)
-        )
-        raise
+            data = r.json()
+            status = data.get('status')
+            if status == 'error':
+                raise RuntimeError(data.get('messages'))
+            if status != 'success':
+                raise RuntimeError(data)
+            log.debug(
+                'Site mode update result (URL {}): {}'
+                .format(r.url, status)
+            )
+            return status
+        except StandardError:
+            log.exception('An error occurred while setting site mode to {} (URL: {})'.format(site_mode, self.server_url))
+            raise
 
+    def list_service_folders(self):
+        log.debug('Listing service folders (URL: {})'.format(self.server_url))
+        try:
+            data = self.request_json_cached(self.admin_services_url)
+            service_folders = data.get('folders')
+            log.debug(LazyFormat(
+                'Service folders (URL {}): {}',
+                self.server_url, LazyJson(service_folders)
+            ))
+            return service_folders
+        except StandardError:
+            log.exception('An error occurred while listing service folders (URL: {})'.format(self.server_url))
+            raise
 
-def get_service_info(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
-    log.debug('Getting info for service {} (URL {}, Folder: {})'.format(service_name, server_url, service_folder))
-    url = urljoin(
-        server_url,
-        '/'.join(
-            (
-                part for part in (
-                    '/arcgis/rest/services',
-                    service_folder,
-                    '{}/{}'.format(service_name, service_type)
-                ) if part
+    def list_services(self, service_folder=None, use_cache=True):
+        # Callers that act on the listing (e.g. deleting services not in it) should pass use_cache=False, so that a
+        # listing cached before other jobs changed the folder is never acted on
+        log.debug('Listing services (URL: {}, Folder: {})'.format(self.server_url, service_folder))
+        url = '/'.join(part for part in (self.admin_services_url, service_folder) if part)
+        try:
+            data = self.request_json_cached(url) if use_cache else self.request_json(url)
+            log.debug(LazyFormat(
+                '{} services (URL {}): {}',
+                service_folder, url, LazyJson(data)
+            ))
+            services = data['services']
+            return services
+        except StandardError:
+            log.exception(
+                'An error occurred while listing services (URL: {}, Folder: {})'
+                .format(self.server_url, service_folder)
             )
-        )
-    )
-    try:
-        r = session.post(url, params={'f': 'json'}, data={'token': token})
-        log.debug('Request URL: {}'. format(r.url))
-        assert (r.status_code == 200)
-        data = r.json()
-        if data.get('status') == 'error':
-            raise RuntimeError(data.get('messages'))
-        if data.get('error'):
-            raise RuntimeError(data.get('error').get('message'))
+            raise
+
+    def list_service_workspaces(self, service_name, service_folder=None, service_type='MapServer'):
+        if service_type == 'GeometryServer':
+            log.warn(
+                'Unsupported service type {} for service {} in folder {}'
+                .format(service_type, service_name, service_folder)
+            )
+            return
         log.debug(
-            'Service {} info (URL {}, Folder: {}): {}'
-            .format(service_name, server_url, service_folder, json.dumps(data, indent=4))
-        )
-        return data
-    except StandardError:
-        log.exception(
-            'An error occurred while getting info for service {}/{}'
-            .format(service_folder, service_name)
+            'Listing workspaces for service {} (URL: {}, Folder: {})'
+            .format(service_name, self.server_url, service_folder)
         )
-        raise
+        url = self.admin_service_url(service_name, service_folder, service_type, 'iteminfo/manifest/manifest.xml')
+        try:
+            def fetch_manifest():
+                r = self.request(url, stream=True)
+                try:
+                    r.raw.decode_content = True
+                    return parse_service_manifest(r.raw)
+                finally:
+                    r.close()
 
+            datasets, conn_props = self.get_cached_response(url, fetch_manifest)
 
-def get_service_item_info(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
-    log.debug('Getting item info for service {} (URL {}, Folder: {})'.format(service_name, server_url, service_folder))
-    url = urljoin(
-        server_url,
-        '/'.join(
-            (
-                part for part in (
-                    '/arcgis/admin/services',
-                    service_folder,
-                    '{}.{}'.format(service_name, service_type),
-                    'iteminfo'
-                ) if part
+            user = conn_props.get('USER', 'n/a')
+            database = parse_database_from_service_string(conn_props.get('INSTANCE', 'n/a'))
+            version = conn_props.get('VERSION', 'n/a')
+            for dataset_props in datasets:
+                yield dict(
+                    user=user,
+                    database=database,
+                    version=version,
+                    **dataset_props
+                )
+        except StandardError:
+            log.exception(
+                'An error occurred while listing workspaces for service {}/{}'
+                .format(service_folder, service_name)
             )
-        )
-    )
-    try:
-        r = session.post(url, params={'f': 'json'}, data={'token': token})
-        log.debug('Request URL: {}'. format(r.url))
-        assert (r.status_code == 200)
-        data = r.json()
-        if data.get('status') == 'error':
-            raise RuntimeError(data.get('messages'))
-        if data.get('error'):
-            raise RuntimeError(data.get('error').get('message'))
-        log.debug(
-            'Service {} item info (URL {}, Folder: {}): {}'
-            .format(service_name, server_url, service_folder, json.dumps(data, indent=4))
-        )
-        return data
-    except StandardError:
-        log.exception(
-            'An error occurred while getting item info for service {}/{}'
-            .format(service_folder, service_name)
-        )
-        raise
+            raise
 
+    def delete_service(self, service_name, service_folder=None, service_type='MapServer'):
+        log.info('Deleting service {} (URL {}, Folder: {})'.format(service_name, self.server_url, service_folder))
+        try:
+            self.request_json(self.admin_service_url(service_name, service_folder, service_type, 'delete'))
+            self.invalidate_service_reports(service_folder)
+            self.invalidate_cached_responses(service_name, service_folder, service_type)
+            log.info(
+                'Service {} successfully deleted (URL {}, Folder: {})'
+                .format(service_name, self.server_url, service_folder)
+            )
+        except StandardError:
+            log.exception(
+                'An error occurred while deleting service {}/{}'
+                .format(service_folder, service_name)
+            )
+            raise
 
-def set_service_item_info(server_url, token, item_info, service_name, service_folder=None, service_type='MapServer', session=None):
-    log.debug('Setting item info for service {} (URL {}, Folder: {})'.format(service_name, server_url, service_folder))
-    url = urljoin(
-        server_url,
-        '/'.join(
-            (
-                part for part in (
-                    '/arcgis/admin/services',
-                    service_folder,
-                    '{}.{}'.format(service_name, service_type),
-                    'iteminfo/edit'
-                ) if part
+    def get_service_info(self, service_name, service_folder=None, service_type='MapServer'):
+        log.debug('Getting info for service {} (URL {}, Folder: {})'.format(service_name, self.server_url, service_folder))
+        try:
+            data = self.request_json_cached(self.rest_service_url(service_name, service_folder, service_type))
+            log.debug(LazyFormat(
+                'Service {} info (URL {}, Folder: {}): {}',
+                service_name, self.server_url, service_folder, LazyJson(data)
+            ))
+            return data
+        except StandardError:
+            log.exception(
+                'An error occurred while getting info for service {}/{}'
+                .format(service_folder, service_name)
             )
-        )
-    )
-    try:
-        r = session.post(
-            url,
-            params={
-                'f': 'json'
-            },
-            data={'token': token},
-            files=[
-                (
-                    'serviceItemInfo',
+            raise
+
+    def get_service_item_info(self, service_name, service_folder=None, service_type='MapServer'):
+        log.debug('Getting item info for service {} (URL {}, Folder: {})'.format(service_name, self.server_url, service_folder))
+        try:
+            data = self.request_json(self.admin_service_url(service_name, service_folder, service_type, 'iteminfo'))
+            log.debug(LazyFormat(
+                'Service {} item info (URL {}, Folder: {}): {}',
+                service_name, self.server_url, service_folder, LazyJson(data)
+            ))
+            return data
+        except StandardError:
+            log.exception(
+                'An error occurred while getting item info for service {}/{}'
+                .format(service_folder, service_name)
+            )
+            raise
+
+    def set_service_item_info(self, item_info, service_name, service_folder=None, service_type='MapServer'):
+        log.debug('Setting item info for service {} (URL {}, Folder: {})'.format(service_name, self.server_url, service_folder))
+        try:
+            data = self.request_json(
+                self.admin_service_url(service_name, service_folder, service_type, 'iteminfo/edit'),
+                files=[
                     (
-                        None,
-                        json.dumps(item_info)
-                    )
-                ),
-                (
-                    'thumbnail',
+                        'serviceItemInfo',
+                        (
+                            None,
+                            json.dumps(item_info)
+                        )
+                    ),
                     (
-                        '',
-                        None,
-                        'application/octet-stream'
+                        'thumbnail',
+                        (
+                            '',
+                            None,
+                            'application/octet-stream'
+                        )
                     )
-                )
-            ]
-        )
-        log.debug('Request URL: {}'.format(r.url))
-        assert (r.status_code == 200)
-        data = r.json()
-        if data.get('status') == 'error':
-            raise RuntimeError(data.get('messages'))
-        if data.get('error'):
-            raise RuntimeError(data.get('error').get('message'))
-        log.debug(
-            'Updated service {} item info (URL {}, Folder: {}): {}'
-            .format(service_name, server_url, service_folder, json.dumps(data, indent=4))
-        )
-        return data
-    except StandardError:
-        log.exception(
-            'An error occurred while setting item info for service {}/{}'
-            .format(service_folder, service_name)
-        )
-        raise
+                ]
+            )
+            log.debug(LazyFormat(
+                'Updated service {} item info (URL {}, Folder: {}): {}',
+                service_name, self.server_url, service_folder, LazyJson(data)
+            ))
+            return data
+        except StandardError:
+            log.exception(
+                'An error occurred while setting item info for service {}/{}'
+                .format(service_folder, service_name)
+            )
+            raise
 
+    def get_service_manifest(self, service_name, service_folder=None, service_type='MapServer'):
+        log.debug('Getting manifest for service {} (URL {}, Folder: {})'.format(service_name, self.server_url, service_folder))
+        try:
+            data = self.request_json_cached(
+                self.admin_service_url(service_name, service_folder, service_type, 'iteminfo/manifest/manifest.json')
+            )
+            log.debug(LazyFormat(
+                'Service {} manifest (URL {}, Folder: {}): {}',
+                service_name, self.server_url, service_folder, LazyJson(data)
+            ))
+            return data
+        except StandardError:
+            log.exception(
+                'An error occurred while getting manifest for service {}/{}'
+                .format(service_folder, service_name)
+            )
+            raise
 
-def get_service_manifest(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
-    log.debug('Getting manifest for service {} (URL {}, Folder: {})'.format(service_name, server_url, service_folder))
-    url = urljoin(
-        server_url,
-        '/'.join(
-            (
-                part for part in (
-                    '/arcgis/admin/services',
-                    service_folder,
-                    '{}.{}'.format(service_name, service_type),
-                    'iteminfo/manifest/manifest.json'
-                ) if part
+    def get_service_status(self, service_name, service_folder=None, service_type='MapServer'):
+        log.debug('Getting status of service {} (URL {}, Folder: {})'.format(service_name, self.server_url, service_folder))
+        try:
+            data = self.request_json(self.admin_service_url(service_name, service_folder, service_type, 'status'))
+            log.debug(LazyFormat(
+                'Service {} status (URL {}, Folder: {}): {}',
+                service_name, self.server_url, service_folder, LazyJson(data)
+            ))
+            return data
+        except StandardError:
+            log.exception(
+                'An error occurred while getting the status of service {}/{}'
+                .format(service_folder, service_name)
             )
-        )
-    )
-    try:
-        r = session.post(url, params={'f': 'json'}, data={'token': token})
-        log.debug('Request URL: {}'. format(r.url))
-        assert (r.status_code == 200)
-        data = r.json()
-        if data.get('status') == 'error':
-            raise RuntimeError(data.get('messages'))
-        if data.get('error'):
-            raise RuntimeError(data.get('error').get('message'))
-        log.debug(
-            'Service {} manifest (URL {}, Folder: {}): {}'
-            .format(service_name, server_url, service_folder, json.dumps(data, indent=4))
-        )
-        return data
-    except StandardError:
-        log.exception(
-            'An error occurred while getting manifest for service {}/{}'
-            .format(service_folder, service_name)
-        )
-        raise
+            raise
 
+    def get_service_folder_report(self, service_folder=None, parameters=('status', 'iteminfo')):
+        log.debug('Getting report for service folder {} (URL {}, Parameters: {})'.format(service_folder, self.server_url, parameters))
+        url = '/'.join(part for part in (self.admin_services_url, service_folder, 'report') if part)
+        try:
+            data = self.request_json(url, {'parameters': json.dumps(parameters)})
+            log.debug(LazyFormat(
+                'Service folder {} report (URL {}): {}',
+                service_folder, self.server_url, LazyJson(data)
+            ))
+            return data['reports']
+        except StandardError:
+            log.exception(
+                'An error occurred while getting the report for service folder {} (URL {})'
+                .format(service_folder, self.server_url)
+            )
+            raise
 
-def get_service_status(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
-    log.debug('Getting status of service {} (URL {}, Folder: {})'.format(service_name, server_url, service_folder))
-    url = urljoin(
-        server_url,
-        '/'.join(
-            (
-                part for part in (
-                    '/arcgis/admin/services',
-                    service_folder,
-                    '{}.{}'.format(service_name, service_type),
-                    'status'
-                ) if part
+    def get_cached_service_report(self, service_name, service_folder=None, service_type='MapServer'):
+        # Fetches the status and item info of every service in the folder in one request, then serves subsequent
+        # lookups for that folder from memory until the folder is invalidated
+        if service_folder not in self.service_reports:
+            self.service_reports[service_folder] = {
+                (report['serviceName'], report['type']): report
+                for report in self.get_service_folder_report(service_folder)
+            }
+        return self.service_reports[service_folder].get((service_name, service_type))
+
+    def get_cached_service_status(self, service_name, service_folder=None, service_type='MapServer'):
+        report = self.get_cached_service_report(service_name, service_folder, service_type)
+        if report is None or 'status' not in report:
+            log.debug(
+                'Service {} not found in report for service folder {}, getting its status directly'
+                .format(service_name, service_folder)
             )
-        )
-    )
-    try:
-        r = session.post(url, params={'f': 'json'}, data={'token': token})
-        log.debug('Request URL: {}'.format(r.url))
-        assert (r.status_code == 200)
-        data = r.json()
-        if data.get('status') == 'error':
-            raise RuntimeError(data.get('messages'))
-        log.debug(
-            'Service {} status (URL {}, Folder: {}): {}'
-            .format(service_name, server_url, service_folder, json.dumps(data, indent=4))
-        )
-        return data
-    except StandardError:
-        log.exception(
-            'An error occurred while getting the status of service {}/{}'
-            .format(service_folder, service_name)
-        )
-        raise
+            return self.get_service_status(service_name, service_folder, service_type)
+        return report['status']
 
+    def invalidate_service_reports(self, service_folder=None):
+        self.service_reports.pop(service_folder, None)
 
-def test_service(server_url, token, service_name, service_folder=None, service_type='MapServer', warn_on_errors=False, session=None):
-    log.info('Testing {} service {} (URL {}, Folder: {})'.format(service_type, service_name, server_url, service_folder))
-
-    def perform_service_health_check(operation, params, service_status):
-        url = urljoin(
-            server_url,
-            '/'.join(
-                (
-                    part for part in (
-                        '/arcgis/rest/services',
-                        service_folder,
-                        '{}/{}'.format(service_name, service_type),
-                        operation
-                    ) if part
+    def test_service(self, service_name, service_folder=None, service_type='MapServer', warn_on_errors=False, use_cached_status=False):
+        log.info('Testing {} service {} (URL {}, Folder: {})'.format(service_type, service_name, self.server_url, service_folder))
+
+        def perform_service_health_check(operation, params, service_status):
+            url = self.rest_service_url(service_name, service_folder, service_type, operation)
+            start_time = time.time()
+            r = self.post(url, params, {'token': self.get_token()})
+            end_time = time.time()
+            response_time = end_time - start_time
+            log.debug(
+                'Request URL: {}, HTTP Status: {}, Response Time: {:.2f}'
+                .format(r.url, r.status_code, response_time)
+            )
+            data = r.json()
+            error = data.get('error')
+            error_message = error.get('message') if error else None
+            if not warn_on_errors:
+                r.raise_for_status()
+                if error_message:
+                    raise RuntimeError(error_message)
+            if not error_message and r.status_code == 200:
+                log.info('{} service {}/{} tested successfully'.format(service_type, service_folder, service_name))
+            elif error_message:
+                log.warn(
+                    'An error occurred while testing {} service {}/{}: {}'
+                    .format(service_type, service_folder, service_name, error_message)
+                )
+            elif r.status_code != 200:
+                log.warn(
+                    '{} service {}/{} responded with a status code of {} ({})'
+                    .format(service_type, service_folder, service_name, r.status_code, r.reason)
+                )
+            return {
+                'request_url': r.url,
+                'request_method': r.request.method,
+                'http_status_code': r.status_code,
+                'http_status_reason': r.reason,
+                'response_time': response_time,
+                'configured_state': service_status.get('configuredState'),
+                'realtime_state': service_status.get('realTimeState'),
+                'error_message': error_message
+            }
+
+        try:
+            if use_cached_status:
+                service_status = self.get_cached_service_status(service_name, service_folder, service_type)
+            else:
+                service_status = self.get_service_status(service_name, service_folder, service_type)
+            configured_state = service_status.get('configuredState')
+            realtime_state = service_status.get('realTimeState')
+            if realtime_state != 'STARTED':
+                log.warn(
+                    '{} service {}/{} is not running (configured state: {}, realtime state: {})!'
+                    .format(service_type, service_folder, service_name, configured_state, realtime_state)
+                )
+                return {
+                    'configured_state': configured_state,
+                    'realtime_state': realtime_state
+                }
+            if service_type == 'MapServer':
+                service_info = self.get_service_info(service_name, service_folder, service_type)
+                initial_extent = json.dumps(service_info.get('initialExtent'))
+                return perform_service_health_check(
+                    'identify',
+                    {
+                        'f': 'json',
+                        'geometry': initial_extent,
+                        'geometryType': 'esriGeometryEnvelope',
+                        'tolerance': '0',
+                        'layers': 'all',
+                        'mapExtent': initial_extent,
+                        'imageDisplay': '400,300,96',
+                        'returnGeometry': 'false'
+                    },
+                    service_status
+                )
+            elif service_type == 'GeocodeServer':
+                service_info = self.get_service_info(service_name, service_folder, service_type)
+                address_fields = service_info.get('addressFields')
+                first_address_field_name = address_fields[0].get('name')
+                return perform_service_health_check(
+                    'findAddressCandidates',
+                    {
+                        'f': 'json',
+                        first_address_field_name: '100 Main St'
+                    },
+                    service_status
                 )
+            else:
+                log.warn(
+                    'Unsupported service type {} for service {} in folder {}'
+                    .format(service_type, service_name, service_folder)
+                )
+                return {
+                    'configured_state': configured_state,
+                    'realtime_state': realtime_state
+                }
+        except StandardError as e:
+            log.exception(
+                'An error occurred while testing {} service {}/{}'
+                .format(service_type, service_folder, service_name)
             )
-        )
-        start_time = time.time()
-        r = session.post(url, params=params, data={'token': token})
-        end_time = time.time()
-        response_time = end_time - start_time
-        log.debug(
-            'Request URL: {}, HTTP Status: {}, Response Time: {:.2f}'
-            .format(r.url, r.status_code, response_time)
-        )
-        data = r.json()
-        error = data.get('error')
-        error_message = error.get('message') if error else None
-        if not warn_on_errors:
-            r.raise_for_status()
-            if error_message:
-                raise RuntimeError(error_message)
-        if not error_message and r.status_code == 200:
-            log.info('{} service {}/{} tested successfully'.format(service_type, service_folder, service_name))
-        elif error_message:
-            log.warn(
-                'An error occurred while testing {} service {}/{}: {}'
-                .format(service_type, service_folder, service_name, error_message)
+            if not warn_on_errors:
+                raise
+            return {
+                'error_message': e.message
+            }
+
+    def stop_service(self, service_name, service_folder=None, service_type='MapServer'):
+        log.info('Stopping service {} (URL {}, Folder: {})'.format(service_name, self.server_url, service_folder))
+        try:
+            self.request_json(self.admin_service_url(service_name, service_folder, service_type, 'stop'))
+            self.invalidate_service_reports(service_folder)
+            log.info(
+                'Service {} successfully stopped (URL {}, Folder: {})'
+                .format(service_name, self.server_url, service_folder)
             )
-        elif r.status_code != 200:
-            log.warn(
-                '{} service {}/{} responded with a status code of {} ({})'
-                .format(service_type, service_folder, service_name, r.status_code, r.reason)
-            )
-        return {
-            'request_url': r.url,
-            'request_method': r.request.method,
-            'http_status_code': r.status_code,
-            'http_status_reason': r.reason,
-            'response_time': response_time,
-            'configured_state': service_status.get('configuredState'),
-            'realtime_state': service_status.get('realTimeState'),
-            'error_message': error_message
-        }
+        except StandardError:
+            log.exception(
+                'An error occurred while stopping service {}/{}'
+                .format(service_folder, service_name)
+            )
+            raise
 
-    try:
-        service_status = get_service_status(server_url, token, service_name, service_folder, service_type, session=session)
+    def start_service(self, service_name, service_folder=None, service_type='MapServer'):
+        log.info('Starting service {} (URL {}, Folder: {})'.format(service_name, self.server_url, service_folder))
+        try:
+            self.request_json(self.admin_service_url(service_name, service_folder, service_type, 'start'))
+            self.invalidate_service_reports(service_folder)
+            log.info(
+                'Service {} successfully started (URL {}, Folder: {})'
+                .format(service_name, self.server_url, service_folder)
+            )
+        except StandardError:
+            log.exception(
+                'An error occurred while starting service {}/{}'
+                .format(service_folder, service_name)
+            )
+            raise
+
+    def bulk_service_operation(self, operation, services, verb):
+        services = list(services)
+        for i in range(0, len(services), default_bulk_operation_size):
+            chunk = services[i:i + default_bulk_operation_size]
+            service_names = ', '.join(
+                '/'.join(part for part in (service_folder, service_name) if part)
+                for service_name, service_folder, service_type in chunk
+            )
+            log.info('{} {} services (URL {}): {}'.format(verb, len(chunk), self.server_url, service_names))
+            try:
+                self.request_json(
+                    '{}/{}'.format(self.admin_services_url, operation),
+                    data={
+                        'services': json.dumps({
+                            'services': [
+                                {
+                                    'folderName': service_folder or '',
+                                    'serviceName': service_name,
+                                    'type': service_type
+                                }
+                                for service_name, service_folder, service_type in chunk
+                            ]
+                        })
+                    }
+                )
+            except StandardError:
+                log.exception(
+                    'An error occurred while {} services (URL {}): {}'
+                    .format(verb.lower(), self.server_url, service_names)
+                )
+                raise
+            finally:
+                for service_folder in set(service_folder for service_name, service_folder, service_type in chunk):
+                    self.invalidate_service_reports(service_folder)
+
+    def stop_services(self, services):
+        self.bulk_service_operation('stopServices', services, 'Stopping')
+
+    def start_services(self, services):
+        self.bulk_service_operation('startServices', services, 'Starting')
+
+    def delete_services(self, services):
+        services = list(services)
+        try:
+            self.bulk_service_operation('deleteServices', services, 'Deleting')
+        finally:
+            for service_name, service_folder, service_type in services:
+                self.invalidate_cached_responses(service_name, service_folder, service_type)
+
+    def check_restarted_service(self, service_name, service_folder=None, service_type='MapServer', test_after_restart=True):
+        service_status = self.get_cached_service_status(service_name, service_folder, service_type)
         configured_state = service_status.get('configuredState')
         realtime_state = service_status.get('realTimeState')
-        if realtime_state != 'STARTED':
-            log.warn(
-                '{} service {}/{} is not running (configured state: {}, realtime state: {})!'
-                .format(service_type, service_folder, service_name, configured_state, realtime_state)
+        error_message = None
+        succeeded = False
+        if realtime_state == 'STARTED':
+            if test_after_restart:
+                test_data = self.test_service(service_name, service_folder, service_type, warn_on_errors=True, use_cached_status=True)
+                configured_state = test_data.get('configured_state')
+                realtime_state = test_data.get('realtime_state')
+                error_message = test_data.get('error_message')
+                if realtime_state == 'STARTED' and not error_message:
+                    succeeded = True
+            else:
+                succeeded = True
+        return succeeded, configured_state, realtime_state, error_message
+
+    def wait_for_service_states(self, services, states, timeout=30):
+        # Polls the service folder reports (one request per folder per poll, with exponential backoff) until each
+        # service's realtime state is one of the given states, or until timeout seconds have elapsed
+        pending_services = list(services)
+        deadline = time.time() + timeout
+        poll_interval = default_poll_interval
+        while True:
+            for service_folder in set(service_folder for service_name, service_folder, service_type in pending_services):
+                self.invalidate_service_reports(service_folder)
+            pending_services = [
+                (service_name, service_folder, service_type)
+                for service_name, service_folder, service_type in pending_services
+                if self.get_cached_service_status(service_name, service_folder, service_type).get('realTimeState') not in states
+            ]
+            if not pending_services:
+                return True
+            remaining_time = deadline - time.time()
+            if remaining_time <= 0:
+                log.debug(
+                    '{} services did not reach state {} within {} seconds (URL {})'
+                    .format(len(pending_services), '/'.join(states), timeout, self.server_url)
+                )
+                return False
+            log.debug(
+                'Waiting for {} services to reach state {} (URL {})'
+                .format(len(pending_services), '/'.join(states), self.server_url)
             )
-            return {
-                'configured_state': configured_state,
-                'realtime_state': realtime_state
-            }
-        if service_type == 'MapServer':
-            service_info = get_service_info(server_url, token, service_name, service_folder, service_type, session=session)
-            initial_extent = json.dumps(service_info.get('initialExtent'))
-            return perform_service_health_check(
-                'identify',
-                {
-                    'f': 'json',
-                    'geometry': initial_extent,
-                    'geometryType': 'esriGeometryEnvelope',
-                    'tolerance': '0',
-                    'layers': 'all',
-                    'mapExtent': initial_extent,
-                    'imageDisplay': '400,300,96',
-                    'returnGeometry': 'false'
-                },
-                service_status
-            )
-        elif service_type == 'GeocodeServer':
-            service_info = get_service_info(server_url, token, service_name, service_folder, service_type, session=session)
-            address_fields = service_info.get('addressFields')
-            first_address_field_name = address_fields[0].get('name')
-            return perform_service_health_check(
-                'findAddressCandidates',
-                {
-                    'f': 'json',
-                    first_address_field_name: '100 Main St'
-                },
-                service_status
+            time.sleep(min(poll_interval, remaining_time))
+            poll_interval = min(poll_interval * 2, default_max_poll_interval)
+
+    def restart_service(
+        self,
+        service_name,
+        service_folder=None,
+        service_type='MapServer',
+        delay=30,
+        max_retries=3,
+        test_after_restart=True
+    ):
+        self.restart_services(((service_name, service_folder, service_type),), delay, max_retries, test_after_restart)
+
+    def restart_services(
+        self,
+        services,
+        delay=30,
+        max_retries=3,
+        test_after_restart=True,
+        max_concurrent_restarts=default_max_concurrent_restarts,
+        max_services_down=default_max_services_down
+    ):
+        """Restarts services in rolling batches, so that no more than max_services_down services are down at once.
+        Up to max_concurrent_restarts service folders are restarted concurrently, but they share the max_services_down
+        limit, so a folder's batch waits until enough of the other folders' services are back up; batches within the
+        same service folder are restarted one after another. Instead of sleeping, the service statuses are polled for
+        up to delay seconds after stopping and again after starting each batch."""
+        folder_batches = []
+        for service_folder, folder_services in itertools.groupby(
+            sorted(services, key=lambda service: service[1]),
+            key=lambda service: service[1]
+        ):
+            folder_services = list(folder_services)
+            folder_batches.append([
+                folder_services[i:i + max_services_down]
+                for i in range(0, len(folder_services), max_services_down)
+            ])
+
+        # One unit per service that may be down. A batch takes all of its units at once (one batch at a time, so that
+        # two folders never each hold part of what they need and wait on each other) and returns them once it is done.
+        services_down = threading.Semaphore(max_services_down)
+        services_down_lock = threading.Lock()
+
+        def restart_folder(batches):
+            folder_errors = []
+            for batch in batches:
+                with services_down_lock:
+                    for _ in batch:
+                        services_down.acquire()
+                try:
+                    folder_errors.extend(self.restart_service_batch(batch, delay, max_retries, test_after_restart))
+                except StandardError as e:
+                    log.exception('An error occurred while restarting services (URL {})'.format(self.server_url))
+                    folder_errors.append(
+                        'An error occurred while restarting services {}: {}'
+                        .format(', '.join('{}/{}'.format(service[1], service[0]) for service in batch), e)
+                    )
+                finally:
+                    for _ in batch:
+                        services_down.release()
+            return folder_errors
+
+        errors = []
+        if len(folder_batches) > 0:
+            pool = ThreadPool(min(max_concurrent_restarts, len(folder_batches)))
+            try:
+                for folder_errors in pool.imap(restart_folder, folder_batches):
+                    errors.extend(folder_errors)
+            finally:
+                pool.terminate()
+        if errors:
+            raise RuntimeError('\n'.join(errors))
+
+    def restart_service_batch(self, services, delay=30, max_retries=3, test_after_restart=True):
+        remaining_services = list(services)
+        results = {}
+        retry_count = 0
+        while remaining_services and retry_count < max_retries:
+            retry_count += 1
+            log.info(
+                'Restarting {} services (URL {}, attempt #{} of {})'
+                .format(len(remaining_services), self.server_url, retry_count, max_retries)
             )
-        else:
-            log.warn(
-                'Unsupported service type {} for service {} in folder {}'
-                .format(service_type, service_name, service_folder)
+            self.stop_services(remaining_services)
+            log.debug(
+                'Waiting up to {} seconds for services to stop before restarting them (URL {})'
+                .format(delay, self.server_url)
             )
-            return {
-                'configured_state': configured_state,
-                'realtime_state': realtime_state
-            }
-    except StandardError as e:
-        log.exception(
-            'An error occurred while testing {} service {}/{}'
-            .format(service_type, service_folder, service_name)
-        )
-        if not warn_on_errors:
-            raise
-        return {
-            'error_message': e.message
-        }
+            self.wait_for_service_states(remaining_services, ('STOPPED',), delay)
+            self.start_services(remaining_services)
+            log.debug(
+                'Waiting up to {} seconds for services to start before checking their status (URL {})'
+                .format(delay, self.server_url)
+            )
+            self.wait_for_service_states(remaining_services, ('STARTED',), delay)
+            failed_services = []
+            for service in remaining_services:
+                service_name, service_folder, service_type = service
+                succeeded, configured_state, realtime_state, error_message = results[service] = \
+                    self.check_restarted_service(service_name, service_folder, service_type, test_after_restart)
+                if succeeded:
+                    log.info(
+                        '{} service {}/{} successfully restarted after {} attempts (configured state: {}, realtime state: {})'
+                        .format(service_type, service_folder, service_name, retry_count, configured_state, realtime_state)
+                    )
+                else:
+                    failed_services.append(service)
+            remaining_services = failed_services
 
+        errors = []
+        for service in remaining_services:
+            service_name, service_folder, service_type = service
+            succeeded, configured_state, realtime_state, error_message = results[service]
+            errors.append(
+                '{} service {}/{} was not successfully restarted after {} attempts! (configured state: {}, realtime state: {}, error message: {})'
+                .format(service_type, service_folder, service_name, retry_count, configured_state, realtime_state, error_message)
+            )
+        return errors
 
-def stop_service(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
-    log.info('Stopping service {} (URL {}, Folder: {})'.format(service_name, server_url, service_folder))
-    url = urljoin(
-        server_url,
-        '/'.join(
-            (
-                part for part in (
-                    '/arcgis/admin/services',
-                    service_folder,
-                    '{}.{}'.format(service_name, service_type),
-                    'stop'
-                ) if part
+    def register_upload(self, item_name, description=None):
+        log.debug('Registering upload of item {} (URL {})'.format(item_name, self.server_url))
+        try:
+            data = self.request_json(
+                self.admin_uploads_url + '/register',
+                data={'itemName': item_name, 'description': description or ''}
             )
+            item_id = data['item']['itemID']
+            log.debug('Registered upload of item {} as item ID {} (URL {})'.format(item_name, item_id, self.server_url))
+            return item_id
+        except StandardError:
+            log.exception('An error occurred while registering upload of item {} (URL {})'.format(item_name, self.server_url))
+            raise
+
+    def list_uploaded_parts(self, item_id):
+        data = self.request_json('{}/{}/parts'.format(self.admin_uploads_url, item_id))
+        return [int(part_number) for part_number in data.get('parts', ())]
+
+    def upload_part(self, item_id, part_number, part_data):
+        log.debug(
+            'Uploading part {} ({} bytes) of item ID {} (URL {})'
+            .format(part_number, len(part_data), item_id, self.server_url)
         )
-    )
-    try:
-        r = session.post(url, params={'f': 'json'}, data={'token': token})
-        log.debug('Request URL: {}'.format(r.url))
-        assert (r.status_code == 200)
-        data = r.json()
-        if data.get('status') == 'error':
-            raise RuntimeError(data.get('messages'))
-        log.info(
-            'Service {} successfully stopped (URL {}, Folder: {})'
-            .format(service_name, server_url, service_folder)
-        )
-    except StandardError:
-        log.exception(
-            'An error occurred while stopping service {}/{}'
-            .format(service_folder, service_name)
+        return self.request_json(
+            '{}/{}/uploadPart'.format(self.admin_uploads_url, item_id),
+            files={'file': ('part{}'.format(part_number), part_data, 'application/octet-stream')},
+            data={'partId': part_number}
         )
-        raise
 
-
-def start_service(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
-    log.info('Starting service {} (URL {}, Folder: {})'.format(service_name, server_url, service_folder))
-    url = urljoin(
-        server_url,
-        '/'.join(
-            (
-                part for part in (
-                    '/arcgis/admin/services',
-                    service_folder,
-                    '{}.{}'.format(service_name, service_type),
-                    'start'
-                ) if part
+    def commit_upload(self, item_id, part_numbers):
+        log.debug('Committing {} parts of item ID {} (URL {})'.format(len(part_numbers), item_id, self.server_url))
+        try:
+            return self.request_json(
+                '{}/{}/commit'.format(self.admin_uploads_url, item_id),
+                data={'parts': ','.join(str(part_number) for part_number in sorted(part_numbers))}
             )
+        except StandardError:
+            log.exception('An error occurred while committing upload of item ID {} (URL {})'.format(item_id, self.server_url))
+            raise
+
+    def upload_file(
+        self,
+        file_path,
+        part_size=default_upload_part_size,
+        max_concurrent_upload_parts=default_max_concurrent_upload_parts,
+        max_retries=default_max_retries,
+        resume_file=None,
+        description=None
+    ):
+        """Uploads a file to the instance's uploads directory in parts of part_size bytes, up to
+        max_concurrent_upload_parts of them at once, and commits it. Parts that fail to upload are retried up to
+        max_retries times.
+        If resume_file is given, the item ID and the parts uploaded so far are recorded in it as the upload progresses,
+        so that an upload that is interrupted or fails can be resumed from the parts the instance already has by
+        calling upload_file again with the same resume_file. It is removed once the upload has been committed.
+        Returns a dict with the item ID and the throughput of the upload."""
+        file_size = os.path.getsize(file_path)
+        file_mtime = os.path.getmtime(file_path)
+        num_parts = max(1, int(math.ceil(file_size / float(part_size))))
+        upload_key = dict(file_path=file_path, file_size=file_size, file_mtime=file_mtime, part_size=part_size)
+
+        item_id = None
+        uploaded_parts = set()
+        if resume_file and os.path.isfile(resume_file):
+            try:
+                with open(resume_file, 'rb') as f:
+                    upload_state = json.load(f)
+                if all(upload_state.get(key) == value for key, value in upload_key.iteritems()):
+                    uploaded_parts = set(self.list_uploaded_parts(upload_state['item_id']))
+                    item_id = upload_state['item_id']
+                    log.info(
+                        'Resuming upload of file {} as item ID {} ({} of {} parts already uploaded, URL {})'
+                        .format(file_path, item_id, len(uploaded_parts), num_parts, self.server_url)
+                    )
+                else:
+                    log.debug('File {} has changed since its upload was started, starting over'.format(file_path))
+            except (StandardError, IOError):
+                log.warn(
+                    'Unable to resume upload of file {} (URL {}), starting over'.format(file_path, self.server_url),
+                    exc_info=True
+                )
+                uploaded_parts = set()
+        if item_id is None:
+            item_id = self.register_upload(os.path.basename(file_path), description)
+        resumed_parts = len(uploaded_parts)
+        lock = threading.Lock()
+
+        def save_upload_state():
+            if not resume_file:
+                return
+            with open(resume_file, 'wb') as f:
+                json.dump(dict(upload_key, item_id=item_id, uploaded_parts=sorted(uploaded_parts)), f)
+
+        def upload(part_number):
+            with open(file_path, 'rb') as f:
+                f.seek((part_number - 1) * part_size)
+                part_data = f.read(part_size)
+            try:
+                self.upload_part(item_id, part_number, part_data)
+            except StandardError as e:
+                log.debug(
+                    'An error occurred while uploading part {} of item ID {} (URL {})'
+                    .format(part_number, item_id, self.server_url),
+                    exc_info=True
+                )
+                return 0, e
+            with lock:
+                uploaded_parts.add(part_number)
+                save_upload_state()
+            return len(part_data), None
+
+        log.info(
+            'Uploading file {} ({} bytes) as item ID {} in {} parts (URL {})'
+            .format(file_path, file_size, item_id, num_parts, self.server_url)
+        )
+        save_upload_state()
+        start_time = time.time()
+        bytes_uploaded = 0
+        retry_count = 0
+        remaining_parts = [part_number for part_number in range(1, num_parts + 1) if part_number not in uploaded_parts]
+        if remaining_parts:
+            pool = ThreadPool(min(max_concurrent_upload_parts, len(remaining_parts)))
+            try:
+                while remaining_parts:
+                    errors = []
+                    for num_bytes, error in pool.imap_unordered(upload, remaining_parts):
+                        bytes_uploaded += num_bytes
+                        if error is not None:
+                            errors.append(error)
+                    remaining_parts = [part_number for part_number in remaining_parts if part_number not in uploaded_parts]
+                    if not remaining_parts:
+                        break
+                    if retry_count >= max_retries:
+                        raise RuntimeError(
+                            'Unable to upload {} of {} parts of file {} (URL {}): {}'
+                            .format(len(remaining_parts), num_parts, file_path, self.server_url, errors[-1])
+                        )
+                    retry_count += 1
+                    log.warn(
+                        'Retrying upload of {} parts of file {} (URL {}, attempt #{} of {})'
+                        .format(len(remaining_parts), file_path, self.server_url, retry_count, max_retries)
+                    )
+            finally:
+                pool.terminate()
+        self.commit_upload(item_id, range(1, num_parts + 1))
+        elapsed = time.time() - start_time
+        if resume_file and os.path.isfile(resume_file):
+            os.remove(resume_file)
+        upload_stats = dict(
+            item_id=item_id,
+            file_size=file_size,
+            parts=num_parts,
+            resumed_parts=resumed_parts,
+            bytes_uploaded=bytes_uploaded,
+            elapsed=elapsed,
+            throughput=bytes_uploaded / elapsed if elapsed > 0 else None
         )
-    )
-    try:
-        r = session.post(url, params={'f': 'json'}, data={'token': token})
-        log.debug('Request URL: {}'.format(r.url))
-        assert (r.status_code == 200)
-        data = r.json()
-        if data.get('status') == 'error':
-            raise RuntimeError(data.get('messages'))
         log.info(
-            'Service {} successfully started (URL {}, Folder: {})'
-            .format(service_name, server_url, service_folder)
+            'Uploaded {:.1f} MB of file {} as item ID {} in {:.1f} seconds ({:.2f} MB/s, {} of {} parts resumed, URL {})'
+            .format(
+                bytes_uploaded / 1048576.0,
+                file_path,
+                item_id,
+                elapsed,
+                (upload_stats['throughput'] or 0) / 1048576.0,
+                resumed_parts,
+                num_parts,
+                self.server_url
+            )
         )
-    except StandardError:
-        log.exception(
-            'An error occurred while starting service {}/{}'
-            .format(service_folder, service_name)
+        return upload_stats
+
+    def publish_uploaded_service_definition(self, item_id, timeout=default_publishing_job_timeout):
+        # Creates the service from an uploaded service definition item by running the Publish Service Definition
+        # geoprocessing tool, polling (with exponential backoff) until the job finishes or timeout seconds have elapsed
+        log.info('Publishing service definition item ID {} (URL {})'.format(item_id, self.server_url))
+        url = urljoin(self.server_url, publish_service_definition_tool_path)
+        try:
+            job_id = self.request_json(url + '/submitJob', data={'in_sdp_id': item_id})['jobId']
+            deadline = time.time() + timeout
+            poll_interval = default_poll_interval
+            while True:
+                data = self.request_json('{}/jobs/{}'.format(url, job_id))
+                job_status = data.get('jobStatus')
+                if job_status == 'esriJobSucceeded':
+                    log.debug(LazyFormat('Publishing job {} messages: {}', job_id, LazyJson(data.get('messages'))))
+                    return data
+                if job_status in failed_job_statuses:
+                    raise RuntimeError(
+                        'Publishing job {} for item ID {} ended with status {}: {}'
+                        .format(
+                            job_id,
+                            item_id,
+                            job_status,
+                            '; '.join(
+                                message.get('description', '')
+                                for message in data.get('messages', ())
+                                if message.get('type') == 'esriJobMessageTypeError'
+                            )
+                        )
+                    )
+                remaining_time = deadline - time.time()
+                if remaining_time <= 0:
+                    raise RuntimeError(
+                        'Publishing job {} for item ID {} did not finish within {} seconds'
+                        .format(job_id, item_id, timeout)
+                    )
+                time.sleep(min(poll_interval, remaining_time))
+                poll_interval = min(poll_interval * 2, default_max_poll_interval)
+        except StandardError:
+            log.exception(
+                'An error occurred while publishing service definition item ID {} (URL {})'
+                .format(item_id, self.server_url)
+            )
+            raise
+
+    def upload_service_definition(
+        self,
+        sd,
+        part_size=default_upload_part_size,
+        max_concurrent_upload_parts=default_max_concurrent_upload_parts,
+        resume_file=None,
+        timeout=default_publishing_job_timeout
+    ):
+        # Alternative to arcpy's Upload Service Definition tool that uploads the .sd file in resumable parts
+        upload_stats = self.upload_file(
+            sd,
+            part_size,
+            max_concurrent_upload_parts,
+            resume_file=resume_file,
+            description='Service definition'
         )
-        raise
+        self.publish_uploaded_service_definition(upload_stats['item_id'], timeout)
+        return upload_stats
+
+
+# Module-level functions retained for backwards compatibility; each delegates to an AgsAdminClient wrapping the given
+# session (or a new session, if none is given).
+
+def generate_token(server_url, username=None, password=None, expiration=15, ags_instance=None, session=None):
+    with AgsAdminClient(server_url, ags_instance=ags_instance, session=session) as client:
+        return client.generate_token(username, password, expiration)
+
+
+def get_site_mode(server_url, token, session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.get_site_mode()
+
+
+def set_site_mode(server_url, token, site_mode, session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.set_site_mode(site_mode)
+
+
+def list_service_folders(server_url, token, session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.list_service_folders()
+
+
+def list_services(server_url, token, service_folder=None, session=None, use_cache=True):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.list_services(service_folder, use_cache)
+
+
+def list_service_workspaces(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        for dataset_props in client.list_service_workspaces(service_name, service_folder, service_type):
+            yield dataset_props
+
+
+def delete_service(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.delete_service(service_name, service_folder, service_type)
+
+
+def get_service_info(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.get_service_info(service_name, service_folder, service_type)
+
+
+def get_service_item_info(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.get_service_item_info(service_name, service_folder, service_type)
+
+
+def set_service_item_info(server_url, token, item_info, service_name, service_folder=None, service_type='MapServer', session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.set_service_item_info(item_info, service_name, service_folder, service_type)
+
+
+def get_service_manifest(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.get_service_manifest(service_name, service_folder, service_type)
+
+
+def get_service_status(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.get_service_status(service_name, service_folder, service_type)
+
+
+def get_service_folder_report(server_url, token, service_folder=None, parameters=('status', 'iteminfo'), session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.get_service_folder_report(service_folder, parameters)
+
+
+def test_service(server_url, token, service_name, service_folder=None, service_type='MapServer', warn_on_errors=False, session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.test_service(service_name, service_folder, service_type, warn_on_errors)
+
+
+def stop_service(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.stop_service(service_name, service_folder, service_type)
+
+
+def start_service(server_url, token, service_name, service_folder=None, service_type='MapServer', session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.start_service(service_name, service_folder, service_type)
+
+
+def stop_services(server_url, token, services, session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.stop_services(services)
+
+
+def start_services(server_url, token, services, session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.start_services(services)
+
+
+def delete_services(server_url, token, services, session=None):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.delete_services(services)
 
 
 def restart_service(
@@ -640,55 +1203,64 @@ def restart_service(
     test_after_restart=True,
     session=None
 ):
-    succeeded = False
-    configured_state = None
-    realtime_state = None
-    error_message = None
-    retry_count = 0
-    while retry_count < max_retries:
-        retry_count += 1
-        log.info(
-            'Restarting service {} (URL {}, Folder: {}, attempt #{} of {})'
-            .format(service_name, server_url, service_folder, retry_count, max_retries)
-        )
-        stop_service(server_url, token, service_name, service_folder, service_type, session=session)
-        log.debug(
-            'Waiting {} seconds before restarting service {} (URL {}, Folder: {})'
-            .format(delay, service_name, server_url, service_folder)
-        )
-        time.sleep(delay)
-        start_service(server_url, token, service_name, service_folder, service_type, session=session)
-        log.debug(
-            'Waiting {} seconds before checking status of service {} (URL {}, Folder: {})'
-            .format(delay, service_name, server_url, service_folder)
-        )
-        time.sleep(delay)
-        service_status = get_service_status(server_url, token, service_name, service_folder, service_type, session=session)
-        configured_state = service_status.get('configuredState')
-        realtime_state = service_status.get('realTimeState')
-        if realtime_state == 'STARTED':
-            if test_after_restart:
-                test_data = test_service(server_url, token, service_name, service_folder, service_type, warn_on_errors=True, session=session)
-                configured_state = test_data.get('configured_state')
-                realtime_state = test_data.get('realtime_state')
-                error_message = test_data.get('error_message')
-                if realtime_state == 'STARTED' and not error_message:
-                    succeeded = True
-            else:
-                succeeded = True
-            if succeeded:
-                break
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.restart_service(service_name, service_folder, service_type, delay, max_retries, test_after_restart)
 
-    if succeeded:
-        log.info(
-            '{} service {}/{} successfully restarted after {} attempts (configured state: {}, realtime state: {})'
-            .format(service_type, service_folder, service_name, retry_count, configured_state, realtime_state)
-        )
+
+def upload_service_definition(
+    server_url,
+    token,
+    sd,
+    part_size=default_upload_part_size,
+    max_concurrent_upload_parts=default_max_concurrent_upload_parts,
+    resume_file=None,
+    session=None
+):
+    with AgsAdminClient(server_url, token, session=session) as client:
+        return client.upload_service_definition(sd, part_size, max_concurrent_upload_parts, resume_file)
+
+
+def is_invalid_token_response(data):
+    # 498 (invalid or expired token) and 499 (token required) are returned either at the top level (Admin API) or
+    # within an error object (REST API)
+    return data.get('code') in (498, 499) or (data.get('error') or {}).get('code') in (498, 499)
+
+
+def parse_service_manifest(source):
+    """Parses the datasets and connection properties out of a service manifest in a single pass, reading it
+    incrementally from source (a file name or file-like object) and discarding each dataset element once it has been
+    read.
+    Returns a tuple of (datasets, conn_props) equivalent to the results of parse_datasets_from_service_manifest and
+    parse_connection_properties_from_service_manifest."""
+    datasets = []
+    conn_strings = {}
+    path = []
+    for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(element.tag)
+            continue
+        # Path of the element relative to the root element
+        element_path = tuple(path[1:])
+        path.pop()
+        if element_path == ('Databases', 'SVCDatabase', 'Datasets', 'SVCDataset'):
+            dataset_path = element.find('OnPremisePath').text
+            datasets.append(dict(
+                dataset_name=os.path.basename(dataset_path),
+                dataset_type=element.find('DatasetType').text,
+                dataset_path=dataset_path
+            ))
+            element.clear()
+        elif element_path[:2] == ('Databases', 'SVCDatabase') and len(element_path) == 3:
+            # Only the first occurrence of each connection string element is used, as with ElementTree.find
+            conn_strings.setdefault(element.tag, element.text)
+
+    for conn_string_tag in ('OnServerConnectionString', 'OnPremiseConnectionString'):
+        conn_string = conn_strings.get(conn_string_tag)
+        if conn_string is not None:
+            return datasets, parse_connection_string(conn_string)
     else:
-        raise RuntimeError(
-            '{} service {}/{} was not successfully restarted after {} attempts! (configured state: {}, realtime state: {}, error message: {})'
-            .format(service_type, service_folder, service_name, retry_count, configured_state, realtime_state, error_message)
-        )
+        log.warn('No connection string element found!')
+        return datasets, {}
 
 
 def parse_datasets_from_service_manifest(data):
@@ -722,13 +1294,19 @@ def parse_connection_properties_from_service_manifest(data):
         return {}
 
 
-def parse_connection_string(conn_string):
-    properties = {}
+# Parsed connection strings, keyed by connection string (most services share a handful of them)
+connection_string_cache = {}
 
-    for pair in split_quoted_string(conn_string, ';'):
-        key, value = split_quoted_string(pair, '=')
-        properties[key] = unquote_string(value)
-    return properties
+
+def parse_connection_string(conn_string):
+    properties = connection_string_cache.get(conn_string)
+    if properties is None:
+        properties = {}
+        for pair in split_quoted_string(conn_string, ';'):
+            key, value = split_quoted_string(pair, '=')
+            properties[key] = unquote_string(value)
+        connection_string_cache[conn_string] = properties
+    return dict(properties)
 
 
 def prompt_for_credentials(username=None, password=None, ags_instance=None):
@@ -784,10 +1362,12 @@ class SSLContextAdapter(HTTPAdapter):
         context = create_default_context()
         kwargs['ssl_context'] = context
         context.load_default_certs() # this loads the OS defaults on Windows
-        self.poolmanager = PoolManager(*args, **kwargs)
+        # Defer to HTTPAdapter so that the pool_connections and pool_maxsize settings are honored
+        return super(SSLContextAdapter, self).init_poolmanager(*args, **kwargs)
 
     def proxy_manager_for(self, *args, **kwargs):
         context = create_default_context()
         kwargs['ssl_context'] = context
         context.load_default_certs() # this loads the OS defaults on Windows
         return super(SSLContextAdapter, self).proxy_manager_for(*args, **kwargs)
+
@@ -0,0 +1,212 @@
+from __future__ import unicode_literals
+
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+from logging_io import setup_logger
+
+log = setup_logger(__name__)
+
+backup_dir_name = 'Backup'
+backup_index_file_name = 'backupindex.json'
+backup_blob_dir_name = 'blobs'
+backup_restore_dir_name = 'Restored'
+backup_chunk_size = 1024 * 1024
+
+
+class BackupStore(object):
+    """Content-addressed store of backups of services' source files (MXDs, or locator files along with their .xml and
+    .lox files) in a backup directory.
+    Each distinct version of a file is stored once, as a blob named after the SHA-1 hash of its contents, so backing up
+    a file identical to one already in the store writes nothing. An index (kept in the backup directory as JSON) maps
+    each backup of each service, by timestamp, to the blobs of its files, and remembers the size and modification time
+    of each source file as of its last backup, so that unchanged files are not even read again.
+    If compress_superseded is set, a blob is gzip-compressed once it is no longer the latest backup of any service."""
+
+    def __init__(self, backup_dir, compress_superseded=True):
+        self.backup_dir = backup_dir
+        self.blob_dir = os.path.join(backup_dir, backup_blob_dir_name)
+        self.index_file = os.path.join(backup_dir, backup_index_file_name)
+        self.compress_superseded = compress_superseded
+        self.index = None
+        self.lock = threading.RLock()
+
+    def load_index(self):
+        with self.lock:
+            if self.index is not None:
+                return
+            self.index = dict(blobs={}, sources={}, services={})
+            if not os.path.isfile(self.index_file):
+                return
+            log.debug('Loading backup index from file: {}'.format(self.index_file))
+            try:
+                with open(self.index_file, 'rb') as f:
+                    self.index.update(json.load(f))
+            except (IOError, ValueError):
+                log.warn('Unable to read backup index file {}, ignoring'.format(self.index_file), exc_info=True)
+
+    def save_index(self):
+        with self.lock:
+            log.debug('Writing backup index to file: {}'.format(self.index_file))
+            # Write to a temporary file first so that an interrupted job never leaves a partially written index file
+            temp_file = '{}.{}.tmp'.format(self.index_file, uuid.uuid4().hex)
+            try:
+                with open(temp_file, 'wb') as f:
+                    json.dump(self.index, f, indent=4, sort_keys=True)
+                if os.path.exists(self.index_file):
+                    os.remove(self.index_file)
+                os.rename(temp_file, self.index_file)
+            except (IOError, OSError):
+                log.warn('Unable to write backup index file {}'.format(self.index_file), exc_info=True)
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+    def backup(self, service_name, file_paths, timestamp=None):
+        # Backs up the files in file_paths as the latest backup of the service, returning the hash of each file
+        timestamp = timestamp or datetime.datetime.now()
+        with self.lock:
+            self.load_index()
+            if not os.path.isdir(self.backup_dir):
+                log.warn('Creating backup directory {}'.format(self.backup_dir))
+                os.makedirs(self.backup_dir)
+            backups = self.index['services'].setdefault(service_name, [])
+            previous_blobs = set(backups[-1]['files'].itervalues()) if backups else set()
+            files = {
+                os.path.basename(file_path): self.add_blob(file_path)
+                for file_path in file_paths
+            }
+            backups.append(dict(timestamp=timestamp.isoformat(), files=files))
+            if self.compress_superseded:
+                for blob_hash in previous_blobs - set(files.itervalues()):
+                    if blob_hash not in self.get_latest_blobs():
+                        self.compress_blob(blob_hash)
+            self.save_index()
+            return files
+
+    def add_blob(self, file_path):
+        source_key = os.path.normcase(os.path.abspath(file_path))
+        stat = os.stat(file_path)
+        source_state = self.index['sources'].get(source_key)
+        if (
+            source_state and
+            source_state['size'] == stat.st_size and
+            source_state['mtime'] == stat.st_mtime and
+            source_state['blob'] in self.index['blobs']
+        ):
+            log.info('Source file {} has not changed since its last backup, skipping'.format(file_path))
+            return source_state['blob']
+        blob_hash = get_file_hash(file_path)
+        if blob_hash in self.index['blobs']:
+            log.info('Source file {} is identical to an existing backup, skipping'.format(file_path))
+        else:
+            blob_file_name = blob_hash + os.path.splitext(file_path)[1].lower()
+            blob_path = os.path.join(self.blob_dir, blob_hash[:2], blob_file_name)
+            log.info('Backing up source file {} to {}'.format(file_path, blob_path))
+            if not os.path.isdir(os.path.dirname(blob_path)):
+                os.makedirs(os.path.dirname(blob_path))
+            # Copy to a temporary file first so that an interrupted copy never leaves a partially written blob
+            temp_path = '{}.{}.tmp'.format(blob_path, uuid.uuid4().hex)
+            shutil.copyfile(file_path, temp_path)
+            if os.path.exists(blob_path):
+                os.remove(blob_path)
+            os.rename(temp_path, blob_path)
+            self.index['blobs'][blob_hash] = dict(
+                path=os.path.relpath(blob_path, self.backup_dir),
+                size=stat.st_size,
+                compressed=False
+            )
+        self.index['sources'][source_key] = dict(size=stat.st_size, mtime=stat.st_mtime, blob=blob_hash)
+        return blob_hash
+
+    def get_latest_blobs(self):
+        return {
+            blob_hash
+            for backups in self.index['services'].itervalues() if backups
+            for blob_hash in backups[-1]['files'].itervalues()
+        }
+
+    def compress_blob(self, blob_hash):
+        blob = self.index['blobs'].get(blob_hash)
+        if not blob or blob['compressed']:
+            return
+        blob_path = os.path.join(self.backup_dir, blob['path'])
+        compressed_blob_path = blob_path + '.gz'
+        log.debug('Compressing superseded backup {}'.format(blob_path))
+        temp_path = '{}.{}.tmp'.format(compressed_blob_path, uuid.uuid4().hex)
+        try:
+            with open(blob_path, 'rb') as f_in, gzip.open(temp_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, backup_chunk_size)
+            os.rename(temp_path, compressed_blob_path)
+            os.remove(blob_path)
+        except (IOError, OSError):
+            log.warn('Unable to compress backup {}'.format(blob_path), exc_info=True)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        blob['path'] = blob['path'] + '.gz'
+        blob['compressed'] = True
+
+    def get_backups(self, service_name):
+        # Returns the backups of the service, oldest first, as dicts with the keys timestamp and files (a dict mapping
+        # each file name to the hash of its contents)
+        with self.lock:
+            self.load_index()
+            return list(self.index['services'].get(service_name, ()))
+
+    def restore(self, service_name, target_dir, timestamp=None):
+        # Restores the files of the backup of the service made at timestamp (an ISO 8601 string), or of its latest
+        # backup, to target_dir, returning their paths
+        with self.lock:
+            self.load_index()
+            backups = self.index['services'].get(service_name)
+            if not backups:
+                raise RuntimeError('No backups of service {} found in {}'.format(service_name, self.backup_dir))
+            if timestamp is None:
+                backup = backups[-1]
+            else:
+                matching_backups = [backup for backup in backups if backup['timestamp'] == timestamp]
+                if not matching_backups:
+                    raise RuntimeError(
+                        'No backup of service {} made at {} (backups: {})'
+                        .format(service_name, timestamp, ', '.join(backup['timestamp'] for backup in backups))
+                    )
+                backup = matching_backups[-1]
+            restored_files = []
+            for file_name, blob_hash in backup['files'].iteritems():
+                blob = self.index['blobs'][blob_hash]
+                blob_path = os.path.join(self.backup_dir, blob['path'])
+                file_path = os.path.join(target_dir, file_name)
+                log.info('Restoring backup {} of service {} to {}'.format(blob_path, service_name, file_path))
+                with gzip.open(blob_path, 'rb') if blob['compressed'] else open(blob_path, 'rb') as f_in:
+                    with open(file_path, 'wb') as f_out:
+                        shutil.copyfileobj(f_in, f_out, backup_chunk_size)
+                restored_files.append(file_path)
+            return restored_files
+
+
+def get_file_hash(file_path):
+    hash_object = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(backup_chunk_size), b''):
+            hash_object.update(chunk)
+    return hash_object.hexdigest()
+
+
+backup_stores = {}
+backup_stores_lock = threading.Lock()
+
+
+def get_backup_store(source_dir):
+    # Returns the backup store of a source directory, shared by everything that backs up files in it
+    backup_dir = os.path.abspath(os.path.join(source_dir, backup_dir_name))
+    key = os.path.normcase(backup_dir)
+    with backup_stores_lock:
+        if key not in backup_stores:
+            backup_stores[key] = BackupStore(backup_dir)
+        return backup_stores[key]
@@ -0,0 +1,73 @@
+from __future__ import unicode_literals
+
+import os
+import threading
+
+from logging_io import setup_logger
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+log = setup_logger(__name__)
+
+
+class DirectoryIndex(object):
+    """In-memory index of the names of the files in each directory it is asked about, so that looking up whether many
+    files exist (e.g. the source and staging files of every service in a configuration file) costs a single listing of
+    each directory rather than a stat of each file, which matters on network shares.
+    Names are matched case-insensitively, as on Windows. Directories are listed with scandir if it is installed, which
+    also tells files apart from subdirectories without extra stats; otherwise os.listdir is used and only the names
+    actually looked up are checked with a stat.
+    Directories are listed once, when first looked up, so an index should not outlive changes to the directories it
+    covers (see invalidate)."""
+
+    def __init__(self):
+        self.directories = {}
+        self.lock = threading.Lock()
+
+    def get_entries(self, directory):
+        # Returns a dict mapping the lowercased name of each entry in the directory to its name and whether it is a
+        # file (or None if that is not known yet)
+        directory = os.path.abspath(directory)
+        key = os.path.normcase(directory)
+        with self.lock:
+            entries = self.directories.get(key)
+            if entries is None:
+                entries = self.directories[key] = list_directory(directory)
+            return entries
+
+    def find_file(self, directory, file_name):
+        # Returns the absolute path of the file named file_name (matched case-insensitively) in the directory, or None
+        # if there is no such file
+        entries = self.get_entries(directory)
+        entry = entries.get(file_name.lower())
+        if entry is None:
+            return None
+        name, is_file = entry
+        file_path = os.path.join(os.path.abspath(directory), name)
+        if is_file is None:
+            is_file = os.path.isfile(file_path)
+            with self.lock:
+                entries[file_name.lower()] = (name, is_file)
+        return file_path if is_file else None
+
+    def invalidate(self, directory=None):
+        # Forgets the listing of the directory (or of every directory), so that it is listed again on its next lookup
+        with self.lock:
+            if directory is None:
+                self.directories.clear()
+            else:
+                self.directories.pop(os.path.normcase(os.path.abspath(directory)), None)
+
+
+def list_directory(directory):
+    log.debug('Listing directory: {}'.format(directory))
+    try:
+        if scandir is not None:
+            return {entry.name.lower(): (entry.name, entry.is_file()) for entry in scandir(directory)}
+        return {name.lower(): (name, None) for name in os.listdir(directory)}
+    except OSError:
+        log.debug('Unable to list directory {}'.format(directory), exc_info=True)
+        return {}
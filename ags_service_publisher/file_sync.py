@@ -0,0 +1,110 @@
+from __future__ import unicode_literals
+
+import filecmp
+import logging
+import os
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
+
+from logging_io import setup_logger
+
+log = setup_logger(__name__)
+
+default_max_concurrent_copies = 4
+mtime_tolerance = 0.001
+
+
+class FileSyncStats(object):
+    """Counts the files (and bytes) copied and skipped as unchanged by sync_file during a job, so that they can be
+    reported once it finishes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.copied_files = 0
+            self.copied_bytes = 0
+            self.skipped_files = 0
+            self.skipped_bytes = 0
+
+    def record(self, copied, num_bytes):
+        with self.lock:
+            if copied:
+                self.copied_files += 1
+                self.copied_bytes += num_bytes
+            else:
+                self.skipped_files += 1
+                self.skipped_bytes += num_bytes
+
+    def log_summary(self, level=logging.INFO):
+        with self.lock:
+            if not self.copied_files and not self.skipped_files:
+                return
+            log.log(
+                level,
+                'Staging files: {} copied ({} bytes), {} skipped as unchanged ({} bytes)'
+                .format(self.copied_files, self.copied_bytes, self.skipped_files, self.skipped_bytes)
+            )
+
+
+def sync_file(source_path, target_path, compare_contents=False):
+    # Copies source_path to target_path unless the two are already identical, returning whether it was copied.
+    # Files with the same size and modification time are taken to be identical without being read (copies keep the
+    # modification time of their source, so files synced before always match). Only files with the same size but
+    # different modification times (or any files of the same size, if compare_contents is set) have their contents
+    # compared.
+    source_stat = os.stat(source_path)
+    num_bytes = source_stat.st_size
+    if files_identical(source_path, source_stat, target_path, compare_contents):
+        log.info('Skipping copying {} to {} as they are identical'.format(source_path, target_path))
+        file_sync_stats.record(False, num_bytes)
+        return False
+    log.info('Copying {} to {}'.format(source_path, target_path))
+    copy_file(source_path, target_path)
+    file_sync_stats.record(True, num_bytes)
+    return True
+
+
+def sync_files(file_paths, compare_contents=False, max_concurrent_copies=default_max_concurrent_copies):
+    # Syncs each (source_path, target_path) pair in file_paths, several at once, returning whether each was copied
+    file_paths = list(file_paths)
+    if len(file_paths) < 2:
+        return [sync_file(source_path, target_path, compare_contents) for source_path, target_path in file_paths]
+    pool = ThreadPool(min(len(file_paths), max_concurrent_copies))
+    try:
+        return pool.map(lambda paths: sync_file(paths[0], paths[1], compare_contents), file_paths)
+    finally:
+        pool.terminate()
+
+
+def files_identical(source_path, source_stat, target_path, compare_contents=False):
+    try:
+        target_stat = os.stat(target_path)
+    except OSError:
+        return False
+    if source_stat.st_size != target_stat.st_size:
+        return False
+    # Modification times are compared to within a millisecond, as setting them can lose sub-microsecond precision
+    if abs(source_stat.st_mtime - target_stat.st_mtime) < mtime_tolerance and not compare_contents:
+        return True
+    # filecmp only skips reading the files when shallow comparisons are allowed, so this always reads both
+    return filecmp.cmp(source_path, target_path, shallow=False)
+
+
+def copy_file(source_path, target_path):
+    # On Windows, CopyFileW lets the OS copy the file itself (including server-side copies between locations on the
+    # same file share) rather than streaming it through this process
+    if os.name == 'nt':
+        import ctypes
+        if not ctypes.windll.kernel32.CopyFileW(source_path, target_path, False):
+            raise ctypes.WinError()
+    else:
+        shutil.copyfile(source_path, target_path)
+    source_stat = os.stat(source_path)
+    os.utime(target_path, (source_stat.st_atime, source_stat.st_mtime))
+
+
+file_sync_stats = FileSyncStats()
@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 
 import datetime
+import json
 import logging
 import os
 
@@ -9,6 +10,67 @@ default_log_dir = os.getenv(
     os.path.abspath(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'logs'))
 )
 
+default_max_log_payload_length = 10000
+
+
+class LazyFormat(object):
+    """Log message that is only formatted (using str.format) once a handler actually emits it, so that logging a
+    message that no handler will emit (e.g. a debug message while only logging to the console at the info level) costs
+    next to nothing."""
+
+    def __init__(self, message, *args):
+        self.message = message
+        self.args = args
+        self.formatted_message = None
+
+    def __unicode__(self):
+        if self.formatted_message is None:
+            self.formatted_message = self.message.format(*self.args)
+        return self.formatted_message
+
+    # Under Python 2, logging falls back to __unicode__ if the message cannot be converted to ASCII
+    __str__ = __unicode__
+
+
+class LazyJson(object):
+    """Object that is only serialized to JSON once it is formatted into a log message (e.g. by LazyFormat), and
+    truncated to max_length characters to keep large payloads (e.g. service manifests) from flooding the log.
+    Serialization stops as soon as max_length characters have been produced, so a large payload is never serialized in
+    full even when it is logged."""
+
+    def __init__(self, obj, indent=4, max_length=default_max_log_payload_length):
+        self.obj = obj
+        self.indent = indent
+        self.max_length = max_length
+        self.serialized_obj = None
+
+    def __unicode__(self):
+        if self.serialized_obj is None:
+            encoder = json.JSONEncoder(indent=self.indent, default=repr)
+            if self.max_length is None:
+                self.serialized_obj = encoder.encode(self.obj)
+                return self.serialized_obj
+            chunks = []
+            length = 0
+            for chunk in encoder.iterencode(self.obj):
+                chunks.append(chunk)
+                length += len(chunk)
+                if length > self.max_length:
+                    break
+            serialized_obj = ''.join(chunks)
+            if length > self.max_length:
+                serialized_obj = '{}... (truncated to {} characters)'.format(
+                    serialized_obj[:self.max_length],
+                    self.max_length
+                )
+            self.serialized_obj = serialized_obj
+        return self.serialized_obj
+
+    __str__ = __unicode__
+
+    def __format__(self, format_spec):
+        return format(unicode(self), format_spec)
+
 
 def setup_logger(namespace=None, level='DEBUG', handler=None):
     logger = logging.getLogger(namespace)
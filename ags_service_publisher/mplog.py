@@ -29,9 +29,13 @@ def daemon(log_queue):
 
 class MPLogger(logging.Logger):
     log_queue = None
+    # Shared with the parent process (see get_lowest_handler_level), so that records below the level of every handler
+    # there are dropped before they are formatted and sent through the queue. The parent still checks the level of each
+    # record's logger when it handles it.
+    log_level = None
 
     def isEnabledFor(self, level):
-        return True
+        return self.log_level is None or level >= self.log_level.value
 
     def handle(self, record):
         ei = record.exc_info
@@ -45,22 +49,45 @@ class MPLogger(logging.Logger):
         self.log_queue.put(d)
 
 
-def logged_call(log_queue, func, *args, **kwargs):
+def setup_queue_logging(log_queue, log_level=None):
     MPLogger.log_queue = log_queue
+    MPLogger.log_level = log_level
     logging.setLoggerClass(MPLogger)
     # monkey patch root logger and already defined loggers
     logging.root.__class__ = MPLogger
     for logger in logging.Logger.manager.loggerDict.values():
         if not isinstance(logger, logging.PlaceHolder):
             logger.__class__ = MPLogger
+
+
+def get_lowest_handler_level():
+    # Returns the lowest level of any handler (other than a NullHandler) of any logger in this process, below which no
+    # record is emitted
+    loggers = [logging.root] + [
+        logger for logger in logging.Logger.manager.loggerDict.values() if not isinstance(logger, logging.PlaceHolder)
+    ]
+    levels = [
+        handler.level for logger in loggers for handler in logger.handlers
+        if not isinstance(handler, logging.NullHandler)
+    ]
+    return min(levels) if levels else logging.CRITICAL + 1
+
+
+def logged_call(log_queue, func, *args, **kwargs):
+    setup_queue_logging(log_queue)
     return func(*args, **kwargs)
 
 
-@contextlib.contextmanager
-def open_queue():
-    log_queue = multiprocessing.Queue()
+def start_log_daemon(log_queue):
     daemon_thread = threading.Thread(target=daemon, args=(log_queue,))
     daemon_thread.daemon = True
     daemon_thread.start()
+    return daemon_thread
+
+
+@contextlib.contextmanager
+def open_queue():
+    log_queue = multiprocessing.Queue()
+    start_log_daemon(log_queue)
     yield log_queue
     log_queue.put(None)
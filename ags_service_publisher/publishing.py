@@ -1,24 +1,36 @@
 from __future__ import unicode_literals
 
+import collections
 import datetime
-import getpass
-import multiprocessing
 import os
+import Queue
 import tempfile
-from shutil import copyfile, rmtree
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from shutil import rmtree
 
-from ags_utils import list_services, delete_service, get_site_mode, set_site_mode, create_session, get_service_item_info, set_service_item_info
+from ags_utils import AgsAdminClient, default_upload_part_size, default_max_concurrent_upload_parts
+from backup_store import get_backup_store
 from config_io import get_config, default_config_dir
 from datasources import update_data_sources, open_mxd
 from extrafilters import superfilter
+from file_sync import sync_file, sync_files
 from helpers import asterisk_tuple, empty_tuple
-from logging_io import setup_logger
-from mplog import open_queue, logged_call
-from sddraft_io import modify_sddraft
+from logging_io import setup_logger, LazyFormat, LazyJson
+from publishing_state import publishing_state, get_fingerprint
+from publishing_summaries import PublishingSummaryUpdater, update_publishing_summary
+from response_cache import response_cache
+from sddraft_io import SDDraftTransform
+from service_definition_cache import service_definition_cache
 from services import normalize_services, get_source_info
+from workers import WorkerPool, run_in_thread
 
 log = setup_logger(__name__)
 
+default_max_concurrent_publishes = 1
+default_max_prepared_services = 2
+
 
 def publish_config(
     config,
@@ -33,7 +45,11 @@ def publish_config(
     warn_on_publishing_errors=False,
     warn_on_validation_errors=False,
     create_backups=True,
-    update_timestamps=True
+    update_timestamps=True,
+    worker_pool=None,
+    incremental=False,
+    reuse_service_definitions=False,
+    journal=None
 ):
     env_names = superfilter(config['environments'].keys(), included_envs, excluded_envs)
     if len(env_names) == 0:
@@ -58,7 +74,11 @@ def publish_config(
                 warn_on_publishing_errors,
                 warn_on_validation_errors,
                 create_backups,
-                update_timestamps
+                update_timestamps,
+                worker_pool,
+                incremental,
+                reuse_service_definitions,
+                journal
             ):
                 yield result
         else:
@@ -78,7 +98,11 @@ def publish_config_name(
     warn_on_publishing_errors=False,
     warn_on_validation_errors=False,
     create_backups=True,
-    update_timestamps=True
+    update_timestamps=True,
+    worker_pool=None,
+    incremental=False,
+    reuse_service_definitions=False,
+    journal=None
 ):
     config = get_config(config_name, config_dir)
     log.info('Publishing config \'{}\''.format(config_name))
@@ -95,7 +119,11 @@ def publish_config_name(
         warn_on_publishing_errors,
         warn_on_validation_errors,
         create_backups,
-        update_timestamps
+        update_timestamps,
+        worker_pool,
+        incremental,
+        reuse_service_definitions,
+        journal
     ):
         result['config_name'] = config_name
         yield result
@@ -114,7 +142,11 @@ def publish_env(
     warn_on_publishing_errors=False,
     warn_on_validation_errors=False,
     create_backups=True,
-    update_timestamps=True
+    update_timestamps=True,
+    worker_pool=None,
+    incremental=False,
+    reuse_service_definitions=False,
+    journal=None
 ):
     env = config['environments'][env_name]
     source_dir = env['source_dir']
@@ -155,87 +187,156 @@ def publish_env(
         else:
             raise RuntimeError(message)
 
-    initial_site_modes = get_site_modes(ags_instances, env_name, user_config)
-    make_sites_editable(ags_instances, env_name, user_config, initial_site_modes)
+    clients = open_clients(ags_instances, env_name, user_config)
+    try:
+        initial_site_modes = get_site_modes(ags_instances, env_name, user_config, clients)
+        current_site_modes = make_sites_editable(ags_instances, env_name, user_config, initial_site_modes, clients)
+
+        summary_updater = PublishingSummaryUpdater(user_config, env_name, clients) if update_timestamps else None
+        try:
+            for result in publish_services(
+                services,
+                user_config,
+                ags_instances,
+                env_name,
+                default_service_properties,
+                env_service_properties,
+                source_info,
+                source_dir,
+                staging_dir,
+                data_source_mappings,
+                service_folder,
+                copy_source_files_from_staging_folder,
+                service_prefix,
+                service_suffix,
+                warn_on_publishing_errors,
+                create_backups,
+                update_timestamps,
+                clients,
+                worker_pool,
+                incremental,
+                reuse_service_definitions,
+                journal,
+                summary_updater
+            ):
+                yield result
+        finally:
+            # Timestamps are updated while the sites are still editable
+            if summary_updater is not None:
+                summary_updater.close()
+            restore_site_modes(ags_instances, env_name, user_config, initial_site_modes, clients, current_site_modes)
+
+        if cleanup_services:
+            for ags_instance in ags_instances:
+                cleanup_instance(ags_instance, env_name, config, user_config, clients[ags_instance])
+    finally:
+        close_clients(clients)
+
+
+def open_clients(ags_instances, env_name, user_config):
+    return collections.OrderedDict(
+        (ags_instance, AgsAdminClient.from_user_config(user_config, env_name, ags_instance))
+        for ags_instance in ags_instances
+    )
+
+
+def close_clients(clients):
+    for client in clients.itervalues():
+        client.close()
+
+
+def get_ags_instance_setting(user_config, ags_instance_props, key, default=None):
+    # Settings of an ArcGIS Server instance override any top-level setting of the same name
+    value = ags_instance_props.get(key)
+    if value is None:
+        value = user_config.get(key)
+    return default if value is None else value
 
+
+def get_max_concurrent_publishes(user_config, ags_instance_props):
+    return get_ags_instance_setting(
+        user_config,
+        ags_instance_props,
+        'max_concurrent_publishes',
+        default_max_concurrent_publishes
+    )
+
+
+def open_worker_pool(user_config):
+    # Enough workers for every ArcGIS Server instance of the largest environment to publish as many services at once
+    # as it allows
+    return WorkerPool(
+        max(
+            sum(
+                get_max_concurrent_publishes(user_config, ags_instance_props)
+                for ags_instance_props in env['ags_instances'].itervalues()
+            )
+            for env in user_config['environments'].itervalues()
+        )
+    )
+
+
+def get_site_mode_instances(ags_instances, env_name, user_config):
+    # Returns the instances whose site mode is managed during publishing, along with the site mode to leave them in
+    return collections.OrderedDict(
+        (ags_instance, user_config['environments'][env_name]['ags_instances'][ags_instance]['site_mode'])
+        for ags_instance in ags_instances
+        if user_config['environments'][env_name]['ags_instances'][ags_instance].get('site_mode')
+    )
+
+
+def map_instances(func, ags_instances):
+    # Calls func with each instance concurrently (one thread per instance), returning a dict of the results
+    ags_instances = list(ags_instances)
+    if not ags_instances:
+        return {}
+    pool = ThreadPool(len(ags_instances))
     try:
-        for result in publish_services(
-            services,
-            user_config,
-            ags_instances,
-            env_name,
-            default_service_properties,
-            env_service_properties,
-            source_info,
-            source_dir,
-            staging_dir,
-            data_source_mappings,
-            service_folder,
-            copy_source_files_from_staging_folder,
-            service_prefix,
-            service_suffix,
-            warn_on_publishing_errors,
-            create_backups,
-            update_timestamps
-        ):
-            yield result
+        return dict(zip(ags_instances, pool.map(func, ags_instances)))
     finally:
-        restore_site_modes(ags_instances, env_name, user_config, initial_site_modes)
+        pool.terminate()
 
-    if cleanup_services:
-        for ags_instance in ags_instances:
-            cleanup_instance(ags_instance, env_name, config, user_config)
 
+def get_site_modes(ags_instances, env_name, user_config, clients):
+    return map_instances(
+        lambda ags_instance: clients[ags_instance].get_site_mode(),
+        get_site_mode_instances(ags_instances, env_name, user_config)
+    )
 
-def get_site_modes(ags_instances, env_name, user_config):
-    result = {}
-    for ags_instance in ags_instances:
-        ags_instance_props = user_config['environments'][env_name]['ags_instances'][ags_instance]
-        site_mode = ags_instance_props.get('site_mode')
-        if site_mode:
-            server_url = ags_instance_props['url']
-            token = ags_instance_props['token']
-            proxies = ags_instance_props.get('proxies') or user_config.get('proxies')
-            with create_session(server_url, proxies=proxies) as session:
-                current_site_mode = get_site_mode(server_url, token, session=session)
-                result[ags_instance] = current_site_mode
-    return result
 
+def make_sites_editable(ags_instances, env_name, user_config, initial_site_modes, clients):
+    # Returns the site mode of each instance afterwards, so that restoring them does not need to check them again
+    def make_site_editable(ags_instance):
+        if initial_site_modes[ags_instance] != 'EDITABLE':
+            clients[ags_instance].set_site_mode('EDITABLE')
+        return 'EDITABLE'
 
-def make_sites_editable(ags_instances, env_name, user_config, initial_site_modes):
-    for ags_instance in ags_instances:
-        ags_instance_props = user_config['environments'][env_name]['ags_instances'][ags_instance]
-        site_mode = ags_instance_props.get('site_mode')
-        if site_mode:
-            server_url = ags_instance_props['url']
-            token = ags_instance_props['token']
-            proxies = ags_instance_props.get('proxies') or user_config.get('proxies')
-            if initial_site_modes[ags_instance] != 'EDITABLE':
-                with create_session(server_url, proxies=proxies) as session:
-                    set_site_mode(server_url, token, 'EDITABLE', session=session)
-
-
-def restore_site_modes(ags_instances, env_name, user_config, initial_site_modes):
-    for ags_instance in ags_instances:
-        ags_instance_props = user_config['environments'][env_name]['ags_instances'][ags_instance]
-        site_mode = ags_instance_props.get('site_mode')
-        if site_mode:
-            server_url = ags_instance_props['url']
-            token = ags_instance_props['token']
-            proxies = ags_instance_props.get('proxies') or user_config.get('proxies')
-            with create_session(server_url, proxies=proxies) as session:
-                current_site_mode = get_site_mode(server_url, token, session=session)
-                if site_mode.upper() == 'INITIAL':
-                    if current_site_mode != initial_site_modes[ags_instance]:
-                        set_site_mode(server_url, token, initial_site_modes[ags_instance], session=session)
-                elif site_mode.upper() == 'READ_ONLY':
-                    if current_site_mode != 'READ_ONLY':
-                        set_site_mode(server_url, token, 'READ_ONLY', session=session)
-                elif site_mode.upper() == 'EDITABLE':
-                    if current_site_mode != 'EDITABLE':
-                        set_site_mode(server_url, token, 'EDITABLE', session=session)
-                else:
-                    log.warn('Unrecognized site mode {}'.format(site_mode))
+    return map_instances(make_site_editable, get_site_mode_instances(ags_instances, env_name, user_config))
+
+
+def restore_site_modes(ags_instances, env_name, user_config, initial_site_modes, clients, current_site_modes=None):
+    # If the current site modes are not known, they are checked first
+    site_modes = get_site_mode_instances(ags_instances, env_name, user_config)
+
+    def restore_site_mode(ags_instance):
+        site_mode = site_modes[ags_instance].upper()
+        if site_mode == 'INITIAL':
+            target_site_mode = initial_site_modes[ags_instance]
+        elif site_mode in ('READ_ONLY', 'EDITABLE'):
+            target_site_mode = site_mode
+        else:
+            log.warn('Unrecognized site mode {}'.format(site_modes[ags_instance]))
+            return
+        client = clients[ags_instance]
+        current_site_mode = (
+            current_site_modes[ags_instance]
+            if current_site_modes and ags_instance in current_site_modes
+            else client.get_site_mode()
+        )
+        if current_site_mode != target_site_mode:
+            client.set_site_mode(target_site_mode)
+
+    map_instances(restore_site_mode, site_modes)
 
 
 def publish_services(
@@ -255,172 +356,729 @@ def publish_services(
     service_suffix='',
     warn_on_publishing_errors=False,
     create_backups=True,
-    update_timestamps=True
+    update_timestamps=True,
+    clients=None,
+    worker_pool=None,
+    incremental=False,
+    reuse_service_definitions=False,
+    journal=None,
+    summary_updater=None,
+    max_prepared_services=default_max_prepared_services
 ):
-    for (
-        service_name,
-        service_type,
-        service_properties
-    ) in normalize_services(
-        services,
-        default_service_properties,
-        env_service_properties
-    ):
-        service_info = source_info[service_name]
-        file_path = service_info['source_file']
-        with open_queue() as log_queue:
-            if create_backups:
-                backup_dir = os.path.join(source_dir, 'Backup')
-                if not os.path.isdir(backup_dir):
-                    log.warn('Creating backup directory {}'.format(backup_dir))
-                    os.makedirs(backup_dir)
-                if service_type == 'MapServer':
-                    source_mxd_path = file_path
-                    if not source_mxd_path:
-                        file_path = source_mxd_path = os.path.join(source_dir, service_name + '.mxd')
-                    backup_file_name = '{}_{:%Y%m%d_%H%M%S}.mxd'.format(service_name, datetime.datetime.now())
-                    backup_file_path = os.path.join(backup_dir, backup_file_name)
-                    log.info('Backing up source MXD {} to {}'.format(source_mxd_path, backup_file_path))
-                    copyfile(source_mxd_path, backup_file_path)
-                if service_type == 'GeocodeServer':
-                    source_locator_path = file_path
-                    backup_file_name = '{}_{:%Y%m%d_%H%M%S}.loc'.format(service_name, datetime.datetime.now())
-                    backup_file_path = os.path.join(backup_dir, backup_file_name)
-                    log.info('Backing up source locator file {} to {}'.format(source_locator_path, backup_file_path))
-                    copyfile(source_locator_path, backup_file_path)
-                    copyfile(source_locator_path + '.xml', backup_file_path + '.xml')
-                    source_locator_lox_path = os.path.splitext(source_locator_path)[0] + '.lox'
-                    if os.path.isfile(source_locator_lox_path):
-                        copyfile(source_locator_lox_path, os.path.splitext(backup_file_path)[0] + '.lox')
-            if copy_source_files_from_staging_folder:
-                if service_type == 'MapServer':
-                    source_mxd_path = file_path
-                    if not source_mxd_path:
-                        file_path = source_mxd_path = os.path.join(source_dir, service_name + '.mxd')
-                    if staging_dir:
-                        staging_mxd_path = service_info['staging_files'][0]
-                        log.info('Copying staging MXD {} to {}'.format(staging_mxd_path, source_mxd_path))
-                        if not os.path.isdir(source_dir):
-                            log.warn('Creating source directory {}'.format(source_dir))
-                            os.makedirs(source_dir)
-                        copyfile(staging_mxd_path, source_mxd_path)
-                    if not os.path.isfile(source_mxd_path):
-                        raise RuntimeError('Source MXD {} does not exist!'.format(source_mxd_path))
-                    if data_source_mappings:
-                        proc = multiprocessing.Process(
-                            target=logged_call,
-                            args=(
-                                log_queue,
-                                update_data_sources,
-                                source_mxd_path,
-                                data_source_mappings
-                            )
+    ags_instances_props = user_config['environments'][env_name]['ags_instances']
+    max_concurrent_publishes = {
+        ags_instance: get_max_concurrent_publishes(user_config, ags_instances_props[ags_instance])
+        for ags_instance in ags_instances
+    }
+    if worker_pool is None:
+        with WorkerPool(sum(max_concurrent_publishes.itervalues())) as worker_pool:
+            for result in publish_services(
+                services,
+                user_config,
+                ags_instances,
+                env_name,
+                default_service_properties,
+                env_service_properties,
+                source_info,
+                source_dir,
+                staging_dir,
+                data_source_mappings,
+                service_folder,
+                copy_source_files_from_staging_folder,
+                service_prefix,
+                service_suffix,
+                warn_on_publishing_errors,
+                create_backups,
+                update_timestamps,
+                clients,
+                worker_pool,
+                incremental,
+                reuse_service_definitions,
+                journal,
+                summary_updater,
+                max_prepared_services
+            ):
+                yield result
+        return
+    if update_timestamps and summary_updater is None:
+        with PublishingSummaryUpdater(user_config, env_name, clients) as summary_updater:
+            for result in publish_services(
+                services,
+                user_config,
+                ags_instances,
+                env_name,
+                default_service_properties,
+                env_service_properties,
+                source_info,
+                source_dir,
+                staging_dir,
+                data_source_mappings,
+                service_folder,
+                copy_source_files_from_staging_folder,
+                service_prefix,
+                service_suffix,
+                warn_on_publishing_errors,
+                create_backups,
+                update_timestamps,
+                clients,
+                worker_pool,
+                incremental,
+                reuse_service_definitions,
+                journal,
+                summary_updater,
+                max_prepared_services
+            ):
+                yield result
+        return
+
+    # Each instance works through the services in order, publishing up to max_concurrent_publishes of them at once.
+    # Meanwhile, a background thread prepares the services' source files in the same order (backing them up, copying
+    # them from the staging folder and updating their data sources), staying up to max_prepared_services services ahead
+    # of publishing so that this I/O overlaps with publishing instead of holding it up.
+    # Each service is fingerprinted as it is prepared. In incremental mode, a service is skipped on each instance where
+    # it was last successfully published with the same fingerprint, and is not prepared at all if that is true of all
+    # of them. If reuse_service_definitions is set, each service's definition is also drafted, analyzed and staged once
+    # as it is prepared, and the resulting .sd file is uploaded to each instance, rather than each instance staging its
+    # own. If a journal is given (i.e. a batch publishing job is being resumed), services it records as already
+    # published are skipped as well. If update_timestamps is set, the summaries of published services are updated by a
+    # PublishingSummaryUpdater in the background, and any updates that failed are reported once publishing has finished.
+    normalized_services = list(normalize_services(services, default_service_properties, env_service_properties))
+    pending_services = {ags_instance: collections.deque(normalized_services) for ags_instance in ags_instances}
+    publishes_in_flight = collections.Counter()
+    published_fingerprints = get_published_fingerprints(
+        normalized_services,
+        env_name,
+        ags_instances,
+        service_folder,
+        service_prefix,
+        service_suffix,
+        clients
+    ) if incremental else {}
+    file_paths = {}
+    fingerprints = {}
+    service_definitions = {}
+    sddraft_transforms = {}
+    skipped_services = collections.Counter()
+    submitted_services = set()
+    running_tasks = {}
+    events = Queue.Queue()
+    errors = list()
+    aborting = False
+    preparation_error = None
+    preparation_slots = threading.Semaphore(max_prepared_services)
+    stop_preparing = threading.Event()
+
+    def get_skip_reason(ags_instance, service_name, fingerprint):
+        if journal is not None and journal.has_succeeded(env_name, ags_instance, service_folder, service_name):
+            return 'it was already published by the job being resumed'
+        if fingerprint and published_fingerprints.get((ags_instance, service_name)) == fingerprint:
+            return 'it has not changed since it was last published'
+        return None
+
+    def prepare_services():
+        try:
+            for service_name, service_type, service_properties in normalized_services:
+                preparation_slots.acquire()
+                if stop_preparing.is_set():
+                    break
+                log.debug(LazyFormat(
+                    'Service properties for {} service {}/{}: {}',
+                    service_type, service_folder, service_name, LazyJson(service_properties)
+                ))
+                fingerprint = get_service_fingerprint(
+                    service_name,
+                    service_type,
+                    service_properties,
+                    source_info[service_name],
+                    source_dir,
+                    data_source_mappings,
+                    copy_source_files_from_staging_folder
+                )
+                if all(get_skip_reason(ags_instance, service_name, fingerprint) for ags_instance in ags_instances):
+                    log.info(
+                        'Service {}/{} will be skipped on every ArcGIS Server instance, skipping preparation'
+                        .format(service_folder, service_name)
+                    )
+                    events.put((
+                        'prepared',
+                        service_name,
+                        (source_info[service_name]['source_file'], fingerprint, None, None)
+                    ))
+                    continue
+                file_path = prepare_service(
+                    service_name,
+                    service_type,
+                    source_info[service_name],
+                    source_dir,
+                    staging_dir,
+                    data_source_mappings,
+                    copy_source_files_from_staging_folder,
+                    create_backups,
+                    worker_pool,
+                    service_properties
+                )
+                sddraft_transform = get_sddraft_transform(service_name, service_type, service_properties)
+                service_definition = get_service_definition(
+                    service_name,
+                    service_type,
+                    service_properties,
+                    source_dir,
+                    service_folder,
+                    service_prefix,
+                    service_suffix,
+                    fingerprint,
+                    worker_pool,
+                    sddraft_transform
+                ) if reuse_service_definitions and fingerprint else None
+                events.put(('prepared', service_name, (file_path, fingerprint, service_definition, sddraft_transform)))
+        except StandardError as e:
+            log.exception('An error occurred while preparing services in service folder {}'.format(service_folder))
+            events.put(('preparation_failed', None, e))
+
+    preparation_thread = threading.Thread(target=prepare_services, name='ServicePreparation')
+    preparation_thread.daemon = True
+    preparation_thread.start()
+
+    try:
+        while running_tasks or (not aborting and any(pending_services.itervalues())):
+            for ags_instance in ags_instances:
+                while (
+                    not aborting and
+                    pending_services[ags_instance] and
+                    pending_services[ags_instance][0][0] in file_paths and
+                    publishes_in_flight[ags_instance] < max_concurrent_publishes[ags_instance]
+                ):
+                    service_name, service_type, service_properties = pending_services[ags_instance].popleft()
+                    if service_name not in submitted_services:
+                        # Publishing has caught up with this service, so let the next one be prepared
+                        submitted_services.add(service_name)
+                        preparation_slots.release()
+                    skip_reason = get_skip_reason(ags_instance, service_name, fingerprints[service_name])
+                    if skip_reason:
+                        log.info(
+                            'Skipping service {}/{} on ArcGIS Server instance {} as {}'
+                            .format(service_folder, service_name, ags_instance, skip_reason)
                         )
-                        proc.start()
-                        proc.join()
-                        if proc.exitcode != 0:
-                            raise RuntimeError(
-                                'An error occurred in subprocess {} (pid {}) while updating data sources for MXD {}'
-                                .format(proc.name, proc.pid, source_mxd_path)
-                            )
-                        del proc
-                if service_type == 'GeocodeServer':
-                    source_locator_path = file_path
-                    if staging_dir:
-                        staging_locator_path = service_info['staging_files'][0]
-                        log.info('Copying staging locator file {} to {}'.format(staging_locator_path, source_locator_path))
-                        if not os.path.isdir(source_dir):
-                            log.warn('Creating source directory {}'.format(source_dir))
-                            os.makedirs(source_dir)
-                        copyfile(staging_locator_path, source_locator_path)
-                        copyfile(staging_locator_path + '.xml', source_locator_path + '.xml')
-                        staging_locator_lox_path = os.path.splitext(staging_locator_path)[0] + '.lox'
-                        if os.path.isfile(staging_locator_lox_path):
-                            copyfile(staging_locator_lox_path, os.path.splitext(source_locator_path)[0] + '.lox')
-                    if not os.path.isfile(source_locator_path):
-                        raise RuntimeError('Source locator file {} does not exist!'.format(source_locator_path))
-                    if data_source_mappings:
-                        log.warn(
-                            'Data source mappings specified but are not supported with GeocodeServer services, skipping '
-                            'service {}.'
-                            .format(service_name)
+                        skipped_services[ags_instance] += 1
+                        yield dict(
+                            env_name=env_name,
+                            ags_instance=ags_instance,
+                            service_folder=service_folder,
+                            service_name=service_name,
+                            service_type=service_type,
+                            file_path=file_paths[service_name],
+                            succeeded=True,
+                            skipped=True,
+                            error=None,
+                            timestamp=datetime.datetime.now()
                         )
-            else:
-                log.debug('Will skip copying source files from staging folder.')
-            procs = list()
-            for ags_instance in ags_instances:
-                ags_instance_props = user_config['environments'][env_name]['ags_instances'][ags_instance]
-                ags_connection = ags_instance_props['ags_connection']
-                proc = (
-                    multiprocessing.Process(
-                        target=logged_call,
-                        args=(
-                            log_queue,
-                            publish_service,
+                        continue
+                    if service_definitions[service_name] and get_ags_instance_setting(
+                        user_config,
+                        ags_instances_props[ags_instance],
+                        'chunked_uploads'
+                    ):
+                        # Chunked uploads only make requests, so they do not need a worker process
+                        task = run_in_thread(
+                            upload_service_in_parts,
+                            service_definitions[service_name],
                             service_name,
                             service_type,
-                            source_dir,
                             ags_instance,
-                            ags_connection,
+                            env_name,
+                            user_config,
                             service_folder,
-                            service_properties,
                             service_prefix,
-                            service_suffix
+                            service_suffix,
+                            clients[ags_instance] if clients else None
                         )
-                    ),
-                    ags_instance
-                )
-                proc[0].start()
-                procs.append(proc)
-            for proc, ags_instance in procs:
-                proc.join()
-
-            errors = list()
-            for proc, ags_instance in procs:
-                error_message = None
-                timestamp = datetime.datetime.now()
-                if proc.exitcode != 0:
-                    succeeded = False
-                    error_message = 'An error occurred in subprocess {} (pid {}, exitcode {}) ' \
-                        'while publishing service {}/{} to AGS instance {}' \
-                        .format(
-                            proc.name,
-                            proc.pid,
-                            proc.exitcode,
-                            service_folder,
+                    elif service_definitions[service_name]:
+                        task = worker_pool.submit(
+                            upload_service,
+                            service_definitions[service_name],
                             service_name,
-                            ags_instance
-                        )
-                    errors.append(error_message)
-                else:
-                    succeeded = True
-                    if update_timestamps:
-                        set_publishing_summary(
-                            user_config,
-                            env_name,
+                            service_type,
                             ags_instance,
-                            service_name,
+                            ags_instances_props[ags_instance]['ags_connection'],
                             service_folder,
+                            service_prefix,
+                            service_suffix
+                        )
+                    else:
+                        task = worker_pool.submit(
+                            publish_service,
+                            service_name,
                             service_type,
-                            timestamp
+                            source_dir,
+                            ags_instance,
+                            ags_instances_props[ags_instance]['ags_connection'],
+                            service_folder,
+                            service_properties,
+                            service_prefix,
+                            service_suffix,
+                            sddraft_transforms[service_name]
                         )
-                yield dict(
-                    env_name=env_name,
-                    ags_instance=ags_instance,
-                    service_folder=service_folder,
-                    service_name=service_name,
-                    service_type=service_type,
-                    file_path=file_path,
-                    succeeded=succeeded,
-                    error=error_message,
-                    timestamp=timestamp
+                    running_tasks[task.task_id] = (service_name, service_type, ags_instance)
+                    publishes_in_flight[ags_instance] += 1
+                    task.add_done_callback(lambda task: events.put(('published', task.task_id, task.result)))
+
+            if not running_tasks and (aborting or not any(pending_services.itervalues())):
+                break
+            # Wait with a timeout so that the wait can be interrupted with Ctrl+C under Python 2
+            while True:
+                try:
+                    event, key, value = events.get(timeout=1)
+                    break
+                except Queue.Empty:
+                    pass
+
+            if event == 'prepared':
+                file_paths[key], fingerprints[key], service_definitions[key], sddraft_transforms[key] = value
+                continue
+            if event == 'preparation_failed':
+                if running_tasks:
+                    log.error(
+                        'Aborting once the {} service(s) being published in service folder {} have finished.'
+                        .format(len(running_tasks), service_folder)
+                    )
+                preparation_error = value
+                aborting = True
+                continue
+
+            service_name, service_type, ags_instance = running_tasks.pop(key)
+            publishes_in_flight[ags_instance] -= 1
+            result = value
+            error_message = None
+            timestamp = datetime.datetime.now()
+            # Publishing may have changed the service even if it failed part way through
+            published_service_name = '{}{}{}'.format(service_prefix, service_name, service_suffix)
+            response_cache.invalidate_service(ags_instance, published_service_name, service_folder, service_type)
+            if not result['succeeded']:
+                succeeded = False
+                publishing_state.remove_services(
+                    env_name,
+                    ags_instance,
+                    ((published_service_name, service_folder, service_type),)
                 )
-            if len(errors) > 0 and not warn_on_publishing_errors:
-                log.error(
-                    'One or more errors occurred while publishing service {}/{}, aborting.'
-                    .format(service_folder, service_name)
+                error_message = 'An error occurred in worker process (pid {}) ' \
+                    'while publishing service {}/{} to AGS instance {}: {}' \
+                    .format(
+                        result['pid'],
+                        service_folder,
+                        service_name,
+                        ags_instance,
+                        result['error']
+                    )
+                errors.append(error_message)
+                if not warn_on_publishing_errors and not aborting:
+                    log.error(
+                        'One or more errors occurred while publishing service {}/{}, aborting once the {} other '
+                        'service(s) being published have finished.'
+                        .format(service_folder, service_name, len(running_tasks))
+                    )
+                    aborting = True
+            else:
+                succeeded = True
+                if fingerprints[service_name]:
+                    publishing_state.set_fingerprint(
+                        env_name,
+                        ags_instance,
+                        published_service_name,
+                        service_folder,
+                        service_type,
+                        fingerprints[service_name],
+                        timestamp
+                    )
+                if update_timestamps:
+                    # Made in the background, so that the next service does not wait on it
+                    summary_updater.submit(ags_instance, service_name, service_folder, service_type, timestamp)
+            yield dict(
+                env_name=env_name,
+                ags_instance=ags_instance,
+                service_folder=service_folder,
+                service_name=service_name,
+                service_type=service_type,
+                file_path=file_paths[service_name],
+                succeeded=succeeded,
+                skipped=False,
+                error=error_message,
+                timestamp=timestamp
+            )
+    finally:
+        stop_preparing.set()
+        preparation_slots.release()
+        preparation_thread.join()
+
+    for ags_instance, count in skipped_services.iteritems():
+        log.info(
+            'Skipped {} service(s) in service folder {} on ArcGIS Server instance {}'
+            .format(count, service_folder, ags_instance)
+        )
+    if preparation_error is not None:
+        raise preparation_error
+    if len(errors) > 0 and not warn_on_publishing_errors:
+        raise RuntimeError(errors)
+
+
+def get_published_fingerprints(
+    services,
+    env_name,
+    ags_instances,
+    service_folder,
+    service_prefix='',
+    service_suffix='',
+    clients=None
+):
+    # Looks up the fingerprint each service was last successfully published with on each instance, keyed by
+    # (ags_instance, service_name). If clients are given, services that no longer exist on an instance (e.g. because
+    # they were deleted outside of a publishing job) are left out so that they are republished.
+    result = {}
+    for ags_instance in ags_instances:
+        instance_fingerprints = {}
+        for service_name, service_type, service_properties in services:
+            published_service_name = '{}{}{}'.format(service_prefix, service_name, service_suffix)
+            fingerprint = publishing_state.get_fingerprint(
+                env_name,
+                ags_instance,
+                published_service_name,
+                service_folder,
+                service_type
+            )
+            if not fingerprint:
+                continue
+            if clients:
+                try:
+                    report = clients[ags_instance].get_cached_service_report(
+                        published_service_name,
+                        service_folder,
+                        service_type
+                    )
+                except StandardError:
+                    log.warn(
+                        'Unable to check which services exist in service folder {} on ArcGIS Server instance {}, '
+                        'all of its services will be republished'
+                        .format(service_folder, ags_instance),
+                        exc_info=True
+                    )
+                    instance_fingerprints = {}
+                    break
+                if report is None:
+                    log.info(
+                        'Service {}/{} no longer exists on ArcGIS Server instance {}, it will be republished'
+                        .format(service_folder, service_name, ags_instance)
+                    )
+                    continue
+            instance_fingerprints[(ags_instance, service_name)] = fingerprint
+        result.update(instance_fingerprints)
+    return result
+
+
+def get_service_fingerprint(
+    service_name,
+    service_type,
+    service_properties,
+    service_info,
+    source_dir,
+    data_source_mappings,
+    copy_source_files_from_staging_folder=True
+):
+    # Fingerprints what a service is published from: the file(s) its source file is prepared from (i.e. the staging
+    # file, if it will be copied over the source file), its tile scheme file, its data source mappings and its merged
+    # service properties. Returns None if any of the files do not exist.
+    if copy_source_files_from_staging_folder and service_info['staging_files']:
+        file_path = service_info['staging_files'][0]
+    elif service_info['source_file']:
+        file_path = service_info['source_file']
+    elif service_type == 'MapServer':
+        file_path = os.path.join(source_dir, service_name + '.mxd')
+    else:
+        return None
+    file_paths = get_locator_files(file_path) if service_type == 'GeocodeServer' else [file_path]
+    if service_properties.get('tile_scheme_file'):
+        file_paths.append(service_properties['tile_scheme_file'])
+    if not all(os.path.isfile(path) for path in file_paths):
+        return None
+    if service_type == 'GeocodeServer' and service_properties.get('rebuild_locators'):
+        # The rebuilt locator depends on its reference data as well
+        reference_data_fingerprint = get_reference_data_fingerprint(service_properties.get('locator_reference_data'))
+        if reference_data_fingerprint is None:
+            return None
+    else:
+        reference_data_fingerprint = None
+    return get_fingerprint(
+        dict(
+            service_type=service_type,
+            service_properties=service_properties,
+            data_source_mappings=data_source_mappings if copy_source_files_from_staging_folder else None,
+            reference_data=reference_data_fingerprint
+        ),
+        file_paths
+    )
+
+
+def get_sddraft_transform(service_name, service_type, service_properties):
+    # Compiles the SDDraft transform of a service once, to be applied to its draft for every instance. Returns None if
+    # it cannot be compiled (e.g. if its tile scheme file is invalid), in which case each instance compiles its own
+    # (so that the error is reported per instance as usual).
+    try:
+        return SDDraftTransform(service_properties)
+    except StandardError:
+        log.warn(
+            'Unable to compile SDDraft transform for {} service {}, it will be compiled for each ArcGIS Server instance'
+            .format(service_type, service_name),
+            exc_info=True
+        )
+        return None
+
+
+def get_service_definition_key(fingerprint, published_service_name, service_folder=None):
+    # Returns the key of the staged service definition file for a service in the service definition cache. The
+    # published name and folder are part of the key as they are baked into the staged file.
+    return get_fingerprint(
+        dict(fingerprint=fingerprint, service_name=published_service_name, service_folder=service_folder),
+        ()
+    )
+
+
+def get_service_definition(
+    service_name,
+    service_type,
+    service_properties,
+    source_dir,
+    service_folder,
+    service_prefix,
+    service_suffix,
+    fingerprint,
+    worker_pool,
+    sddraft_transform=None
+):
+    # Returns the path to the staged service definition file for a service with the given fingerprint, staging it in a
+    # worker process unless it is already in the service definition cache. Returns None if it could not be staged, in
+    # which case the service is published to each instance separately instead (so that errors such as analysis errors
+    # are reported per instance as usual).
+    published_service_name = '{}{}{}'.format(service_prefix, service_name, service_suffix)
+    key = get_service_definition_key(fingerprint, published_service_name, service_folder)
+    sd_path = service_definition_cache.get_path(key, published_service_name, service_folder)
+    if os.path.isfile(sd_path):
+        log.info(
+            'Reusing staged service definition file {} for service {}/{}'
+            .format(sd_path, service_folder, published_service_name)
+        )
+        return sd_path
+    sd_dir = os.path.dirname(sd_path)
+    if not os.path.isdir(sd_dir):
+        os.makedirs(sd_dir)
+    result = worker_pool.run(
+        stage_service_definition,
+        service_name,
+        service_type,
+        source_dir,
+        sd_path,
+        service_folder,
+        service_properties,
+        service_prefix,
+        service_suffix,
+        sddraft_transform
+    )
+    if not result['succeeded']:
+        log.warn(
+            'An error occurred in worker process (pid {}) while staging the service definition for service {}/{}, '
+            'it will be published to each ArcGIS Server instance separately: {}'
+            .format(result['pid'], service_folder, published_service_name, result['error'])
+        )
+        return None
+    service_definition_cache.remove_stale(key, published_service_name, service_folder)
+    return sd_path
+
+
+def prepare_service(
+    service_name,
+    service_type,
+    service_info,
+    source_dir,
+    staging_dir,
+    data_source_mappings,
+    copy_source_files_from_staging_folder=True,
+    create_backups=True,
+    worker_pool=None,
+    service_properties=None
+):
+    # Backs up the service's source file, copies it from the staging folder, updates its data sources and rebuilds it
+    # if it is a locator, returning the path to the source file.
+    # A locator that was already rebuilt from the same staging files and reference data (and has not changed since) is
+    # neither copied from the staging folder again nor rebuilt, as copying it would overwrite the rebuilt locator.
+    file_path = service_info['source_file']
+    rebuild_locators = bool(
+        service_type == 'GeocodeServer' and service_properties and service_properties.get('rebuild_locators')
+    )
+    locator_rebuilt = False
+    if rebuild_locators:
+        staging_locator_path = (
+            service_info['staging_files'][0]
+            if copy_source_files_from_staging_folder and staging_dir and service_info['staging_files']
+            else None
+        )
+        reference_data_fingerprint = get_reference_data_fingerprint(service_properties.get('locator_reference_data'))
+        locator_rebuilt = is_locator_rebuilt(file_path, reference_data_fingerprint, staging_locator_path)
+    if create_backups:
+        # Backups are content-addressed, so files identical to an existing backup are not copied again
+        backup_store = get_backup_store(source_dir)
+        if service_type == 'MapServer':
+            source_mxd_path = file_path
+            if not source_mxd_path:
+                file_path = source_mxd_path = os.path.join(source_dir, service_name + '.mxd')
+            log.debug('Backing up source MXD {}'.format(source_mxd_path))
+            backup_store.backup(service_name, (source_mxd_path,))
+        if service_type == 'GeocodeServer':
+            source_locator_path = file_path
+            log.debug('Backing up source locator file {}'.format(source_locator_path))
+            backup_store.backup(service_name, get_locator_files(source_locator_path))
+    if copy_source_files_from_staging_folder:
+        if service_type == 'MapServer':
+            source_mxd_path = file_path
+            if not source_mxd_path:
+                file_path = source_mxd_path = os.path.join(source_dir, service_name + '.mxd')
+            if staging_dir:
+                staging_mxd_path = service_info['staging_files'][0]
+                log.debug('Syncing staging MXD {} to {}'.format(staging_mxd_path, source_mxd_path))
+                if not os.path.isdir(source_dir):
+                    log.warn('Creating source directory {}'.format(source_dir))
+                    os.makedirs(source_dir)
+                sync_file(staging_mxd_path, source_mxd_path)
+            if not os.path.isfile(source_mxd_path):
+                raise RuntimeError('Source MXD {} does not exist!'.format(source_mxd_path))
+            if data_source_mappings:
+                result = worker_pool.run(update_data_sources, source_mxd_path, data_source_mappings)
+                if not result['succeeded']:
+                    raise RuntimeError(
+                        'An error occurred in worker process (pid {}) while updating data sources for MXD {}: {}'
+                        .format(result['pid'], source_mxd_path, result['error'])
+                    )
+        if service_type == 'GeocodeServer':
+            source_locator_path = file_path
+            if staging_dir and locator_rebuilt:
+                log.info(
+                    'Skipping syncing staging locator file to {} as it was already rebuilt from it'
+                    .format(source_locator_path)
                 )
-                raise RuntimeError(errors)
+            elif staging_dir:
+                staging_locator_path = service_info['staging_files'][0]
+                log.debug('Syncing staging locator file {} to {}'.format(staging_locator_path, source_locator_path))
+                if not os.path.isdir(source_dir):
+                    log.warn('Creating source directory {}'.format(source_dir))
+                    os.makedirs(source_dir)
+                staging_file_paths = [
+                    (staging_locator_path, source_locator_path),
+                    (staging_locator_path + '.xml', source_locator_path + '.xml')
+                ]
+                staging_locator_lox_path = os.path.splitext(staging_locator_path)[0] + '.lox'
+                if os.path.isfile(staging_locator_lox_path):
+                    staging_file_paths.append(
+                        (staging_locator_lox_path, os.path.splitext(source_locator_path)[0] + '.lox')
+                    )
+                # The locator file and its .xml and .lox files are synced concurrently
+                sync_files(staging_file_paths)
+            if not os.path.isfile(source_locator_path):
+                raise RuntimeError('Source locator file {} does not exist!'.format(source_locator_path))
+            if data_source_mappings:
+                log.warn(
+                    'Data source mappings specified but are not supported with GeocodeServer services, skipping '
+                    'service {}.'
+                    .format(service_name)
+                )
+    else:
+        log.debug('Will skip copying source files from staging folder.')
+    if rebuild_locators:
+        if locator_rebuilt:
+            log.info(
+                'Skipping rebuilding locator {} as neither it nor its inputs have changed since it was last rebuilt'
+                .format(file_path)
+            )
+        else:
+            rebuild_locator(file_path, reference_data_fingerprint, staging_locator_path, worker_pool)
+    return file_path
+
+
+def get_locator_rebuild_fingerprint(locator_path, reference_data_fingerprint, staging_locator_path=None):
+    # Fingerprints a rebuild of the locator file locator_path by its inputs (the fingerprint of its reference data and,
+    # if it is copied from the staging folder, the contents of the staging locator files) and by the size and
+    # modification time of the locator files it left behind, so that a rebuild is only skipped if its inputs are
+    # unchanged and the locator has not been changed (e.g. overwritten with an unbuilt copy) since. Returns None if the
+    # reference data is not known, in which case the locator is always rebuilt.
+    if reference_data_fingerprint is None:
+        return None
+    locator_files = []
+    for file_path in get_locator_files(locator_path) if locator_path else ():
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        locator_files.append((os.path.basename(file_path).lower(), stat.st_size, stat.st_mtime))
+    return get_fingerprint(
+        dict(reference_data=reference_data_fingerprint, locator_files=locator_files),
+        get_locator_files(staging_locator_path) if staging_locator_path else ()
+    )
+
+
+def is_locator_rebuilt(locator_path, reference_data_fingerprint, staging_locator_path=None):
+    fingerprint = get_locator_rebuild_fingerprint(locator_path, reference_data_fingerprint, staging_locator_path)
+    return fingerprint is not None and publishing_state.get_locator_fingerprint(locator_path) == fingerprint
+
+
+def rebuild_locator(locator_path, reference_data_fingerprint=None, staging_locator_path=None, worker_pool=None):
+    # Rebuilds the locator file locator_path in a worker process, recording the fingerprint of the rebuild (see
+    # get_locator_rebuild_fingerprint) if its reference data is known
+    log.info('Rebuilding locator {}'.format(locator_path))
+    start_time = time.time()
+    result = worker_pool.run(rebuild_address_locator, os.path.splitext(locator_path)[0])
+    if not result['succeeded']:
+        raise RuntimeError(
+            'An error occurred in worker process (pid {}) while rebuilding locator {}: {}'
+            .format(result['pid'], locator_path, result['error'])
+        )
+    duration = time.time() - start_time
+    log.info('Rebuilt locator {} in {:.1f} seconds'.format(locator_path, duration))
+    fingerprint = get_locator_rebuild_fingerprint(locator_path, reference_data_fingerprint, staging_locator_path)
+    if fingerprint is not None:
+        publishing_state.set_locator_fingerprint(locator_path, fingerprint, datetime.datetime.now(), duration)
+
+
+def rebuild_address_locator(locator_path):
+    import arcpy
+    arcpy.RebuildAddressLocator_geocoding(locator_path)
+
+
+def get_locator_files(locator_path):
+    # Returns the paths to the files making up the locator file locator_path
+    file_paths = [locator_path, locator_path + '.xml']
+    lox_path = os.path.splitext(locator_path)[0] + '.lox'
+    if os.path.isfile(lox_path):
+        file_paths.append(lox_path)
+    return file_paths
+
+
+def get_reference_data_fingerprint(reference_data=None):
+    # Lists the path, size and modification time of each file in reference_data (a list of files and directories, such
+    # as shapefiles or file geodatabases). Returns None if reference_data is not specified or any of it is not on the
+    # file system (e.g. enterprise geodatabase feature classes), as it cannot be told whether it has changed.
+    if not reference_data:
+        return None
+    result = []
+    for path in (reference_data,) if isinstance(reference_data, basestring) else reference_data:
+        if os.path.isfile(path):
+            file_paths = (path,)
+        elif os.path.isdir(path):
+            file_paths = sorted(
+                os.path.join(dir_path, file_name)
+                for dir_path, dir_names, file_names in os.walk(path)
+                for file_name in file_names
+            )
+        else:
+            return None
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            result.append((file_path, stat.st_size, stat.st_mtime))
+    return result
 
 
 def publish_service(
@@ -432,89 +1090,86 @@ def publish_service(
     service_folder=None,
     service_properties=None,
     service_prefix='',
-    service_suffix=''
+    service_suffix='',
+    sddraft_transform=None
 ):
-    import arcpy
-    arcpy.env.overwriteOutput = True
-
-    original_service_name = service_name
-    service_name = '{}{}{}'.format(service_prefix, service_name, service_suffix)
+    published_service_name = '{}{}{}'.format(service_prefix, service_name, service_suffix)
 
     log.info(
         'Publishing {} service {} to ArcGIS Server instance {}, Connection File: {}, Service Folder: {}'
-        .format(service_type, service_name, ags_instance, ags_connection, service_folder)
+        .format(service_type, published_service_name, ags_instance, ags_connection, service_folder)
     )
 
     tempdir = tempfile.mkdtemp()
     log.debug('Temporary directory created: {}'.format(tempdir))
     try:
-        sddraft = os.path.join(tempdir, service_name + '.sddraft')
-        sd = os.path.join(tempdir, service_name + '.sd')
-        log.debug('Creating SDDraft file: {}'.format(sddraft))
+        sd = os.path.join(tempdir, published_service_name + '.sd')
+        create_service_definition(
+            service_name,
+            service_type,
+            source_dir,
+            sd,
+            ags_connection,
+            service_folder,
+            service_properties,
+            service_prefix,
+            service_suffix,
+            sddraft_transform
+        )
+        upload_service_definition(sd, published_service_name, ags_instance, ags_connection, service_folder)
+    except StandardError:
+        log.exception(
+            'An error occurred while publishing service {}/{} to ArcGIS Server instance {}'
+            .format(service_folder, published_service_name, ags_instance)
+        )
+        raise
+    finally:
+        log.debug('Cleaning up temporary directory: {}'.format(tempdir))
+        rmtree(tempdir, ignore_errors=True)
 
-        if service_type == 'MapServer':
-            mxd_path = os.path.join(source_dir, original_service_name + '.mxd')
-            mxd = open_mxd(mxd_path)
-            arcpy.mapping.CreateMapSDDraft(
-                mxd,
-                sddraft,
-                service_name,
-                'FROM_CONNECTION_FILE',
-                ags_connection,
-                False,
-                service_folder
-            )
-            modify_sddraft(sddraft, service_properties)
-            log.debug('Analyzing SDDraft file: {}'.format(sddraft))
-            analysis = arcpy.mapping.AnalyzeForSD(sddraft)
-
-        elif service_type == 'GeocodeServer':
-            locator_path = os.path.join(source_dir, original_service_name)
-            if service_properties.get('rebuild_locators'):
-                log.info('Rebuilding locator {}'.format(locator_path))
-                arcpy.RebuildAddressLocator_geocoding(locator_path)
-            analysis = arcpy.CreateGeocodeSDDraft(
-                locator_path,
-                sddraft,
-                service_name,
-                'FROM_CONNECTION_FILE',
-                ags_connection,
-                False,
-                service_folder
-            )
-            modify_sddraft(sddraft, service_properties)
 
-        else:
-            raise RuntimeError('Unsupported service type {}!'.format(service_type))
-
-        for key, log_method in (('messages', log.info), ('warnings', log.warn), ('errors', log.error)):
-            log.info('----' + key.upper() + '---')
-            items = analysis[key]
-            for ((message, code), layerlist) in items.iteritems():
-                log_method('    {} (CODE {:05d})'.format(message, code))
-                log_method('       applies to:')
-                for layer in layerlist:
-                    log_method('           {}'.format(layer.longName if hasattr(layer, 'longName') else layer.name))
-                log_method('')
-
-        if analysis['errors'] == {}:
-            log.debug('Staging SDDraft file: {} to SD file: {}'.format(sddraft, sd))
-            arcpy.StageService_server(sddraft, sd)
-            log.debug('Uploading SD file: {} to AGS connection file: {}'.format(sd, ags_connection))
-            arcpy.UploadServiceDefinition_server(sd, ags_connection)
-            log.info(
-                'Service {}/{} successfully published to {} at {:%#m/%#d/%y %#I:%M:%S %p}'
-                .format(service_folder, service_name, ags_instance, datetime.datetime.now())
-            )
-        else:
-            error_message = 'Analysis failed for service {}/{} at {:%#m/%#d/%y %#I:%M:%S %p}' \
-                .format(service_folder, service_name, datetime.datetime.now())
-            log.error(error_message)
-            raise RuntimeError(error_message, analysis['errors'])
+def stage_service_definition(
+    service_name,
+    service_type,
+    source_dir,
+    sd,
+    service_folder=None,
+    service_properties=None,
+    service_prefix='',
+    service_suffix='',
+    sddraft_transform=None
+):
+    # Stages a service definition file that can be uploaded to any ArcGIS Server instance, by drafting it without a
+    # connection file. It is staged in a temporary directory next to sd and then moved into place, so that sd never
+    # refers to a partially staged file.
+    published_service_name = '{}{}{}'.format(service_prefix, service_name, service_suffix)
+
+    log.info(
+        'Staging service definition for {} service {}, Service Folder: {}'
+        .format(service_type, published_service_name, service_folder)
+    )
+
+    tempdir = tempfile.mkdtemp(dir=os.path.dirname(sd))
+    log.debug('Temporary directory created: {}'.format(tempdir))
+    try:
+        temp_sd = os.path.join(tempdir, published_service_name + '.sd')
+        create_service_definition(
+            service_name,
+            service_type,
+            source_dir,
+            temp_sd,
+            None,
+            service_folder,
+            service_properties,
+            service_prefix,
+            service_suffix,
+            sddraft_transform
+        )
+        os.rename(temp_sd, sd)
     except StandardError:
         log.exception(
-            'An error occurred while publishing service {}/{} to ArcGIS Server instance {}'
-            .format(service_folder, service_name, ags_instance)
+            'An error occurred while staging the service definition for service {}/{}'
+            .format(service_folder, published_service_name)
         )
         raise
     finally:
@@ -522,6 +1177,189 @@ def publish_service(
         rmtree(tempdir, ignore_errors=True)
 
 
+def upload_service(
+    sd,
+    service_name,
+    service_type,
+    ags_instance,
+    ags_connection,
+    service_folder=None,
+    service_prefix='',
+    service_suffix=''
+):
+    published_service_name = '{}{}{}'.format(service_prefix, service_name, service_suffix)
+
+    log.info(
+        'Publishing {} service {} to ArcGIS Server instance {} from staged service definition file {}, '
+        'Connection File: {}, Service Folder: {}'
+        .format(service_type, published_service_name, ags_instance, sd, ags_connection, service_folder)
+    )
+
+    try:
+        upload_service_definition(sd, published_service_name, ags_instance, ags_connection, service_folder)
+    except StandardError:
+        log.exception(
+            'An error occurred while publishing service {}/{} to ArcGIS Server instance {}'
+            .format(service_folder, published_service_name, ags_instance)
+        )
+        raise
+
+
+def upload_service_in_parts(
+    sd,
+    service_name,
+    service_type,
+    ags_instance,
+    env_name,
+    user_config,
+    service_folder=None,
+    service_prefix='',
+    service_suffix='',
+    client=None
+):
+    # Publishes a staged service definition file using a chunked, resumable upload through the ArcGIS Server
+    # Administrator API rather than arcpy. An upload that fails part way through resumes from the parts that were
+    # already uploaded the next time the same file is uploaded to the same instance.
+    if client is None:
+        with AgsAdminClient.from_user_config(user_config, env_name, ags_instance) as client:
+            return upload_service_in_parts(
+                sd,
+                service_name,
+                service_type,
+                ags_instance,
+                env_name,
+                user_config,
+                service_folder,
+                service_prefix,
+                service_suffix,
+                client
+            )
+    ags_instance_props = user_config['environments'][env_name]['ags_instances'][ags_instance]
+    published_service_name = '{}{}{}'.format(service_prefix, service_name, service_suffix)
+    upload_part_size_mb = get_ags_instance_setting(user_config, ags_instance_props, 'upload_part_size_mb')
+
+    log.info(
+        'Publishing {} service {} to ArcGIS Server instance {} from staged service definition file {} using a chunked '
+        'upload, Service Folder: {}'
+        .format(service_type, published_service_name, ags_instance, sd, service_folder)
+    )
+
+    try:
+        upload_stats = client.upload_service_definition(
+            sd,
+            int(upload_part_size_mb * 1024 * 1024) if upload_part_size_mb else default_upload_part_size,
+            get_ags_instance_setting(
+                user_config,
+                ags_instance_props,
+                'max_concurrent_upload_parts',
+                default_max_concurrent_upload_parts
+            ),
+            '{}.{}.upload.json'.format(sd, ags_instance)
+        )
+        log.info(
+            'Service {}/{} successfully published to {} at {:%#m/%#d/%y %#I:%M:%S %p}'
+            .format(service_folder, published_service_name, ags_instance, datetime.datetime.now())
+        )
+        return upload_stats
+    except StandardError:
+        log.exception(
+            'An error occurred while publishing service {}/{} to ArcGIS Server instance {}'
+            .format(service_folder, published_service_name, ags_instance)
+        )
+        raise
+
+
+def create_service_definition(
+    service_name,
+    service_type,
+    source_dir,
+    sd,
+    ags_connection=None,
+    service_folder=None,
+    service_properties=None,
+    service_prefix='',
+    service_suffix='',
+    sddraft_transform=None
+):
+    # Drafts, analyzes and stages the service definition file sd. If no connection file is given, the draft is not
+    # tied to a particular ArcGIS Server instance. The draft is modified with sddraft_transform if given (so that the
+    # same compiled transform can be applied to the draft for every instance), or else one compiled from
+    # service_properties.
+    import arcpy
+    arcpy.env.overwriteOutput = True
+
+    original_service_name = service_name
+    service_name = '{}{}{}'.format(service_prefix, service_name, service_suffix)
+    server_type = 'FROM_CONNECTION_FILE' if ags_connection else 'ARCGIS_SERVER'
+
+    sddraft = os.path.splitext(sd)[0] + '.sddraft'
+    if sddraft_transform is None:
+        sddraft_transform = SDDraftTransform(service_properties)
+    log.debug('Creating SDDraft file: {}'.format(sddraft))
+
+    if service_type == 'MapServer':
+        mxd_path = os.path.join(source_dir, original_service_name + '.mxd')
+        mxd = open_mxd(mxd_path)
+        arcpy.mapping.CreateMapSDDraft(
+            mxd,
+            sddraft,
+            service_name,
+            server_type,
+            ags_connection,
+            False,
+            service_folder
+        )
+        sddraft_transform.apply(sddraft)
+        log.debug('Analyzing SDDraft file: {}'.format(sddraft))
+        analysis = arcpy.mapping.AnalyzeForSD(sddraft)
+
+    elif service_type == 'GeocodeServer':
+        locator_path = os.path.join(source_dir, original_service_name)
+        analysis = arcpy.CreateGeocodeSDDraft(
+            locator_path,
+            sddraft,
+            service_name,
+            server_type,
+            ags_connection,
+            False,
+            service_folder
+        )
+        sddraft_transform.apply(sddraft)
+
+    else:
+        raise RuntimeError('Unsupported service type {}!'.format(service_type))
+
+    for key, log_method in (('messages', log.info), ('warnings', log.warn), ('errors', log.error)):
+        log.info('----' + key.upper() + '---')
+        items = analysis[key]
+        for ((message, code), layerlist) in items.iteritems():
+            log_method('    {} (CODE {:05d})'.format(message, code))
+            log_method('       applies to:')
+            for layer in layerlist:
+                log_method('           {}'.format(layer.longName if hasattr(layer, 'longName') else layer.name))
+            log_method('')
+
+    if analysis['errors'] == {}:
+        log.debug('Staging SDDraft file: {} to SD file: {}'.format(sddraft, sd))
+        arcpy.StageService_server(sddraft, sd)
+    else:
+        error_message = 'Analysis failed for service {}/{} at {:%#m/%#d/%y %#I:%M:%S %p}' \
+            .format(service_folder, service_name, datetime.datetime.now())
+        log.error(error_message)
+        raise RuntimeError(error_message, analysis['errors'])
+
+
+def upload_service_definition(sd, service_name, ags_instance, ags_connection, service_folder=None):
+    import arcpy
+
+    log.debug('Uploading SD file: {} to AGS connection file: {}'.format(sd, ags_connection))
+    arcpy.UploadServiceDefinition_server(sd, ags_connection)
+    log.info(
+        'Service {}/{} successfully published to {} at {:%#m/%#d/%y %#I:%M:%S %p}'
+        .format(service_folder, service_name, ags_instance, datetime.datetime.now())
+    )
+
+
 def set_publishing_summary(
     user_config,
     env_name,
@@ -529,35 +1367,23 @@ def set_publishing_summary(
     service_name,
     service_folder,
     service_type,
-    timestamp
+    timestamp,
+    client=None
 ):
-    try:
-        ags_instance_props = user_config['environments'][env_name]['ags_instances'][ags_instance]
-        server_url = ags_instance_props['url']
-        token = ags_instance_props['token']
-        proxies = ags_instance_props.get('proxies') or user_config.get('proxies')
-        with create_session(server_url, proxies=proxies) as session:
-            item_info = get_service_item_info(
-                server_url,
-                token,
-                service_name,
-                service_folder,
-                service_type,
-                session=session
-            )
-            item_info['summary'] = 'Last published by {} on {:%#m/%#d/%y at %#I:%M:%S %p}'.format(
-                getpass.getuser(),
-                timestamp
-            )
-            set_service_item_info(
-                server_url,
-                token,
-                item_info,
+    if client is None:
+        with AgsAdminClient.from_user_config(user_config, env_name, ags_instance) as client:
+            return set_publishing_summary(
+                user_config,
+                env_name,
+                ags_instance,
                 service_name,
                 service_folder,
                 service_type,
-                session=session
+                timestamp,
+                client
             )
+    try:
+        update_publishing_summary(client, service_name, service_folder, service_type, timestamp)
     except StandardError:
         log.warning(
             'An error occurred while updating timestamp for service {}/{} to ArcGIS Server instance {}'
@@ -604,27 +1430,33 @@ def cleanup_instance(
     ags_instance,
     env_name,
     config,
-    user_config
+    user_config,
+    client=None
 ):
+    if client is None:
+        with AgsAdminClient.from_user_config(user_config, env_name, ags_instance) as client:
+            return cleanup_instance(ags_instance, env_name, config, user_config, client)
     configured_services = config['services']
     service_folder = config.get('service_folder')
     log.info(
         'Cleaning up unused services on environment {}, ArcGIS Server instance {}, service folder {}'
         .format(env_name, ags_instance, service_folder)
     )
-    ags_instance_props = user_config['environments'][env_name]['ags_instances'][ags_instance]
-    server_url = ags_instance_props['url']
-    token = ags_instance_props['token']
-    proxies = ags_instance_props.get('proxies') or user_config.get('proxies')
-    with create_session(server_url, proxies=proxies) as session:
-        existing_services = list_services(server_url, token, service_folder, session=session)
-        services_to_remove = [service for service in existing_services if service['serviceName'] not in configured_services]
-        log.info(
-            'Removing {} services: {}'
-            .format(
-                len(services_to_remove),
-                ', '.join((service['serviceName'] for service in services_to_remove))
-            )
+    # List the folder afresh rather than from the response cache, as the services not in it are deleted
+    existing_services = client.list_services(service_folder, use_cache=False)
+    services_to_remove = [service for service in existing_services if service['serviceName'] not in configured_services]
+    log.info(
+        'Removing {} services: {}'
+        .format(
+            len(services_to_remove),
+            ', '.join((service['serviceName'] for service in services_to_remove))
         )
-        for service in services_to_remove:
-            delete_service(server_url, token, service['serviceName'], service_folder, service['type'], session=session)
+    )
+    client.delete_services(
+        (service['serviceName'], service_folder, service['type']) for service in services_to_remove
+    )
+    publishing_state.remove_services(
+        env_name,
+        ags_instance,
+        ((service['serviceName'], service_folder, service['type']) for service in services_to_remove)
+    )
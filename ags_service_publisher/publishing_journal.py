@@ -0,0 +1,149 @@
+from __future__ import unicode_literals
+
+import json
+import os
+import threading
+import time
+
+from config_io import default_config_dir
+from logging_io import setup_logger
+
+log = setup_logger(__name__)
+
+publishing_journal_file_name = 'publishingjournal.jsonl'
+default_publishing_journal_file = os.path.join(default_config_dir, publishing_journal_file_name)
+default_sync_interval = 1
+default_sync_batch_size = 50
+
+
+class PublishingJournal(object):
+    """Append-only journal of the outcome of publishing each service to each ArcGIS Server instance during a batch
+    publishing job, stored as one JSON record per line.
+    Records are flushed as they are written but only synced to disk every sync_batch_size records or sync_interval
+    seconds (and when the journal is closed), so that keeping the journal adds next to nothing to the job.
+    When a job is resumed, the records of the previous job are read back in and services that were already published
+    successfully can be skipped. Services are keyed by configuration file as well as by environment, instance,
+    service folder and name, as several configuration files may publish services of the same name to the same folder;
+    for_config returns a view of the journal for looking up the services of one configuration file.
+    A partially written last record (e.g. if the job was killed) is ignored.
+    May be used as a context manager, in which case the journal is closed on exit."""
+
+    def __init__(
+        self,
+        journal_file=default_publishing_journal_file,
+        resume=False,
+        sync_interval=default_sync_interval,
+        sync_batch_size=default_sync_batch_size
+    ):
+        self.journal_file = journal_file
+        self.sync_interval = sync_interval
+        self.sync_batch_size = sync_batch_size
+        self.succeeded_services = set()
+        self.unsynced_records = 0
+        self.last_sync_time = time.time()
+        self.lock = threading.Lock()
+        if resume:
+            self.load_journal()
+        log.debug('{} publishing journal file: {}'.format('Appending to' if resume else 'Writing', self.journal_file))
+        self.file = open(self.journal_file, 'ab' if resume else 'wb')
+        if resume and self.ends_with_partial_record():
+            # Terminate the partially written record so that it does not swallow the next one
+            self.file.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def get_key(record):
+        return (
+            record.get('config_name'),
+            record.get('env_name'),
+            record.get('ags_instance'),
+            record.get('service_folder'),
+            record.get('service_name')
+        )
+
+    def load_journal(self):
+        if not os.path.isfile(self.journal_file):
+            log.warn('Publishing journal file {} does not exist, nothing to resume'.format(self.journal_file))
+            return
+        log.debug('Loading publishing journal from file: {}'.format(self.journal_file))
+        with open(self.journal_file, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    log.debug('Ignoring incomplete publishing journal record: {}'.format(line))
+                    continue
+                # Later records supersede earlier ones for the same service
+                if record.get('succeeded'):
+                    self.succeeded_services.add(self.get_key(record))
+                else:
+                    self.succeeded_services.discard(self.get_key(record))
+        log.info(
+            'Resuming publishing job from journal file {} ({} services already published)'
+            .format(self.journal_file, len(self.succeeded_services))
+        )
+
+    def ends_with_partial_record(self):
+        if not os.path.isfile(self.journal_file) or os.path.getsize(self.journal_file) == 0:
+            return False
+        with open(self.journal_file, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b'\n'
+
+    def has_succeeded(self, config_name, env_name, ags_instance, service_folder, service_name):
+        return (config_name, env_name, ags_instance, service_folder, service_name) in self.succeeded_services
+
+    def for_config(self, config_name):
+        return ConfigPublishingJournal(self, config_name)
+
+    def record(self, result):
+        record = dict(
+            config_name=result.get('config_name'),
+            env_name=result.get('env_name'),
+            ags_instance=result.get('ags_instance'),
+            service_folder=result.get('service_folder'),
+            service_name=result.get('service_name'),
+            service_type=result.get('service_type'),
+            succeeded=result.get('succeeded'),
+            skipped=result.get('skipped'),
+            error=result.get('error'),
+            timestamp=result['timestamp'].isoformat() if result.get('timestamp') else None
+        )
+        with self.lock:
+            self.file.write(json.dumps(record, default=repr) + '\n')
+            self.file.flush()
+            self.unsynced_records += 1
+            if (
+                self.unsynced_records >= self.sync_batch_size or
+                time.time() - self.last_sync_time >= self.sync_interval
+            ):
+                self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced_records = 0
+        self.last_sync_time = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.flush()
+            self.sync()
+            self.file.close()
+
+
+class ConfigPublishingJournal(object):
+    """View of a publishing journal for the services of a single configuration file, as passed to publish_config."""
+
+    def __init__(self, journal, config_name):
+        self.journal = journal
+        self.config_name = config_name
+
+    def has_succeeded(self, env_name, ags_instance, service_folder, service_name):
+        return self.journal.has_succeeded(self.config_name, env_name, ags_instance, service_folder, service_name)
@@ -0,0 +1,146 @@
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+from config_io import default_config_dir
+from logging_io import setup_logger
+
+log = setup_logger(__name__)
+
+publishing_state_file_name = 'publishingstate.json'
+default_publishing_state_file = os.path.join(default_config_dir, publishing_state_file_name)
+fingerprint_chunk_size = 1024 * 1024
+
+
+class PublishingState(object):
+    """Keeps track of the fingerprint of each service as of its last successful publish, per environment and ArcGIS
+    Server instance, in an on-disk state file, so that incremental publishing jobs can skip services that have not
+    changed since.
+    Also keeps track of the fingerprint of each locator (and its reference data) as of its last rebuild, so that
+    locators are only rebuilt when needed."""
+
+    def __init__(self, state_file=default_publishing_state_file):
+        self.state_file = state_file
+        self.state = None
+        self.lock = threading.RLock()
+
+    def set_state_file(self, state_file):
+        with self.lock:
+            if state_file != self.state_file:
+                self.state_file = state_file
+                self.state = None
+
+    def load_state(self):
+        with self.lock:
+            if self.state is not None:
+                return
+            self.state = dict(services={}, locators={})
+            if not os.path.isfile(self.state_file):
+                return
+            log.debug('Loading publishing state from file: {}'.format(self.state_file))
+            try:
+                with open(self.state_file, 'rb') as f:
+                    self.state.update(json.load(f))
+            except (IOError, ValueError):
+                log.warn('Unable to read publishing state file {}, ignoring'.format(self.state_file), exc_info=True)
+
+    def save_state(self):
+        with self.lock:
+            log.debug('Writing publishing state to file: {}'.format(self.state_file))
+            # Write to a temporary file first so that an interrupted job never leaves a partially written state file
+            temp_file = '{}.{}.tmp'.format(self.state_file, uuid.uuid4().hex)
+            try:
+                with open(temp_file, 'wb') as f:
+                    json.dump(self.state, f, indent=4, sort_keys=True)
+                if os.path.exists(self.state_file):
+                    os.remove(self.state_file)
+                os.rename(temp_file, self.state_file)
+            except (IOError, OSError):
+                log.warn('Unable to write publishing state file {}'.format(self.state_file), exc_info=True)
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+    @staticmethod
+    def get_service_key(service_name, service_folder=None, service_type='MapServer'):
+        return '/'.join(part for part in (service_folder, '{}.{}'.format(service_name, service_type)) if part)
+
+    def get_fingerprint(self, env_name, ags_instance, service_name, service_folder=None, service_type='MapServer'):
+        with self.lock:
+            self.load_state()
+            service_state = (
+                self.state['services']
+                .get(env_name, {})
+                .get(ags_instance, {})
+                .get(self.get_service_key(service_name, service_folder, service_type))
+            )
+            return service_state['fingerprint'] if service_state else None
+
+    def set_fingerprint(
+        self,
+        env_name,
+        ags_instance,
+        service_name,
+        service_folder=None,
+        service_type='MapServer',
+        fingerprint=None,
+        timestamp=None
+    ):
+        with self.lock:
+            self.load_state()
+            self.state['services'].setdefault(env_name, {}).setdefault(ags_instance, {})[
+                self.get_service_key(service_name, service_folder, service_type)
+            ] = dict(
+                fingerprint=fingerprint,
+                timestamp=timestamp.isoformat() if timestamp else None
+            )
+            self.save_state()
+
+    def remove_services(self, env_name, ags_instance, services):
+        # Forgets the fingerprints of services (an iterable of (service_name, service_folder, service_type) tuples),
+        # e.g. because they were deleted or a publish failed part way through
+        with self.lock:
+            self.load_state()
+            instance_services = self.state['services'].get(env_name, {}).get(ags_instance, {})
+            removed = False
+            for service_name, service_folder, service_type in services:
+                key = self.get_service_key(service_name, service_folder, service_type)
+                if key in instance_services:
+                    del instance_services[key]
+                    removed = True
+            if removed:
+                self.save_state()
+
+    def get_locator_fingerprint(self, locator_path):
+        with self.lock:
+            self.load_state()
+            locator_state = self.state['locators'].get(os.path.normcase(os.path.abspath(locator_path)))
+            return locator_state['fingerprint'] if locator_state else None
+
+    def set_locator_fingerprint(self, locator_path, fingerprint, timestamp=None, duration=None):
+        with self.lock:
+            self.load_state()
+            self.state['locators'][os.path.normcase(os.path.abspath(locator_path))] = dict(
+                fingerprint=fingerprint,
+                timestamp=timestamp.isoformat() if timestamp else None,
+                duration=duration
+            )
+            self.save_state()
+
+
+def get_fingerprint(properties, file_paths):
+    # Hashes properties (any JSON-serializable value) together with the contents of each file in file_paths
+    hash_object = hashlib.sha1()
+    hash_object.update(json.dumps(properties, sort_keys=True, default=repr).encode('utf-8'))
+    for file_path in file_paths:
+        hash_object.update(os.path.basename(file_path).lower().encode('utf-8'))
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(fingerprint_chunk_size), b''):
+                hash_object.update(chunk)
+    return hash_object.hexdigest()
+
+
+publishing_state = PublishingState()
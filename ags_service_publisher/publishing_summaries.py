@@ -0,0 +1,148 @@
+from __future__ import unicode_literals
+
+import collections
+import getpass
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
+
+from ags_utils import AgsAdminClient
+from logging_io import setup_logger
+
+log = setup_logger(__name__)
+
+default_max_concurrent_summary_updates = 4
+default_summary_update_batch_size = 20
+
+
+class PublishingSummaryUpdater(object):
+    """Updates the summary of each published service with who last published it and when, in the background, so that
+    the requests involved (getting and then editing the service's item info) stay off the publishing critical path.
+    Updates are queued as services are published. A background thread collects whatever updates have queued up into a
+    batch (of up to batch_size updates, keeping only the latest update of any one service) and makes them on up to
+    max_concurrent_updates threads at once, using each ArcGIS Server instance's pooled admin client (clients are opened
+    for any instances that none were given for).
+    Failed updates are collected and reported once every queued update has been made, when the updater is closed.
+    May be used as a context manager, in which case the updater is closed on exit."""
+
+    def __init__(
+        self,
+        user_config,
+        env_name,
+        clients=None,
+        max_concurrent_updates=default_max_concurrent_summary_updates,
+        batch_size=default_summary_update_batch_size
+    ):
+        self.user_config = user_config
+        self.env_name = env_name
+        self.clients = dict(clients) if clients else {}
+        self.owned_clients = {}
+        self.batch_size = batch_size
+        self.failures = []
+        self.updates = Queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.pool = ThreadPool(max_concurrent_updates)
+        self.update_thread = threading.Thread(target=self.handle_updates, name='PublishingSummaryUpdates')
+        self.update_thread.daemon = True
+        self.update_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, ags_instance, service_name, service_folder, service_type, timestamp):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('Publishing summary updater is closed!')
+        self.updates.put((ags_instance, service_name, service_folder, service_type, timestamp))
+
+    def handle_updates(self):
+        stopping = False
+        while not stopping:
+            update = self.updates.get()
+            if update is None:
+                break
+            batch = collections.OrderedDict()
+            while update is not None:
+                batch[update[:4]] = update
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    update = self.updates.get_nowait()
+                except Queue.Empty:
+                    break
+                if update is None:
+                    stopping = True
+            log.debug('Updating publishing summaries of {} service(s)'.format(len(batch)))
+            for failure in self.pool.map(self.make_update, batch.itervalues()):
+                if failure:
+                    self.failures.append(failure)
+
+    def get_client(self, ags_instance):
+        with self.lock:
+            client = self.clients.get(ags_instance)
+            if client is None:
+                client = AgsAdminClient.from_user_config(self.user_config, self.env_name, ags_instance)
+                self.clients[ags_instance] = self.owned_clients[ags_instance] = client
+            return client
+
+    def make_update(self, update):
+        # Returns an error message if the update failed
+        ags_instance, service_name, service_folder, service_type, timestamp = update
+        try:
+            update_publishing_summary(
+                self.get_client(ags_instance),
+                service_name,
+                service_folder,
+                service_type,
+                timestamp
+            )
+        except StandardError as e:
+            log.debug(
+                'An error occurred while updating timestamp for service {}/{} to ArcGIS Server instance {}'
+                .format(service_folder, service_name, ags_instance),
+                exc_info=True
+            )
+            return '{}/{} on ArcGIS Server instance {}: {}'.format(service_folder, service_name, ags_instance, e)
+
+    def close(self):
+        # Waits for every queued update to be made, then reports any that failed
+        with self.lock:
+            if self.closed:
+                return self.failures
+            self.closed = True
+        self.updates.put(None)
+        # Join with a timeout so that the wait can be interrupted with Ctrl+C under Python 2
+        while self.update_thread.is_alive():
+            self.update_thread.join(1)
+        self.pool.close()
+        self.pool.join()
+        for client in self.owned_clients.itervalues():
+            client.close()
+        if self.failures:
+            log.warn(
+                'Unable to update the publishing timestamps of {} service(s):\n{}'
+                .format(len(self.failures), '\n'.join(self.failures))
+            )
+        return self.failures
+
+
+def update_publishing_summary(client, service_name, service_folder, service_type, timestamp):
+    item_info = client.get_service_item_info(
+        service_name,
+        service_folder,
+        service_type
+    )
+    item_info['summary'] = 'Last published by {} on {:%#m/%#d/%y at %#I:%M:%S %p}'.format(
+        getpass.getuser(),
+        timestamp
+    )
+    client.set_service_item_info(
+        item_info,
+        service_name,
+        service_folder,
+        service_type
+    )
@@ -5,6 +5,7 @@ import collections
 from ..reporters.base_reporter import BaseReporter
 from ..config_io import default_config_dir, get_configs
 from ..datasources import get_mxd_data_sources
+from ..directory_index import DirectoryIndex
 from ..extrafilters import superfilter
 from ..helpers import asterisk_tuple, empty_tuple
 from ..logging_io import setup_logger
@@ -46,6 +47,8 @@ class MxdDataSourcesReporter(BaseReporter):
         warn_on_validation_errors=False,
         config_dir=default_config_dir
     ):
+        # Shared by every config and environment, so that each directory is only listed once per report
+        directory_index = DirectoryIndex()
         for config_name, config in get_configs(included_configs, excluded_configs, config_dir).iteritems():
             env_names = superfilter(config['environments'].keys(), included_envs, excluded_envs)
             services = superfilter(config['services'], included_services, excluded_services)
@@ -65,7 +68,8 @@ class MxdDataSourcesReporter(BaseReporter):
                     source_dir,
                     staging_dir,
                     default_service_properties,
-                    env_service_properties
+                    env_service_properties,
+                    directory_index
                 )
                 if len(errors) > 0:
                     message = 'One or more errors occurred while validating the {} environment for config name {}:\n{}' \
@@ -2,10 +2,10 @@ from __future__ import unicode_literals
 
 import collections
 
-from ..config_io import default_config_dir, get_configs
+from ..config_io import default_config_dir, get_config, get_configs
 from ..helpers import asterisk_tuple, empty_tuple
 from ..logging_io import setup_logger
-from ..publishing import publish_config_name
+from ..publishing import publish_config_name, open_worker_pool
 from ..reporters.base_reporter import BaseReporter
 
 log = setup_logger(__name__)
@@ -22,6 +22,7 @@ class ServicePublishingReporter(BaseReporter):
         ('service_type', 'Service Type'),
         ('file_path', 'File Path'),
         ('succeeded', 'Succeeded'),
+        ('skipped', 'Skipped'),
         ('error', 'Error'),
         ('timestamp', 'Timestamp')
     ))
@@ -41,21 +42,27 @@ class ServicePublishingReporter(BaseReporter):
         warn_on_validation_errors=False,
         warn_on_publishing_errors=False,
         config_dir=default_config_dir,
-        create_backups=True
+        create_backups=True,
+        incremental=False,
+        reuse_service_definitions=False
     ):
-        for config_name, config in get_configs(included_configs, excluded_configs, config_dir).iteritems():
-            for result in publish_config_name(
-                config_name,
-                config_dir,
-                included_envs, excluded_envs,
-                included_instances, excluded_instances,
-                included_services, excluded_services,
-                copy_source_files_from_staging_folder,
-                cleanup_services,
-                service_prefix,
-                service_suffix,
-                warn_on_publishing_errors,
-                warn_on_validation_errors,
-                create_backups
-            ):
-                yield result
+        with open_worker_pool(get_config('userconfig', config_dir)) as worker_pool:
+            for config_name, config in get_configs(included_configs, excluded_configs, config_dir).iteritems():
+                for result in publish_config_name(
+                    config_name,
+                    config_dir,
+                    included_envs, excluded_envs,
+                    included_instances, excluded_instances,
+                    included_services, excluded_services,
+                    copy_source_files_from_staging_folder,
+                    cleanup_services,
+                    service_prefix,
+                    service_suffix,
+                    warn_on_publishing_errors,
+                    warn_on_validation_errors,
+                    create_backups,
+                    worker_pool=worker_pool,
+                    incremental=incremental,
+                    reuse_service_definitions=reuse_service_definitions
+                ):
+                    yield result
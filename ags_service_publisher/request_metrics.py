@@ -0,0 +1,128 @@
+from __future__ import unicode_literals
+
+import collections
+import json
+import logging
+import math
+import re
+import threading
+import time
+
+from requests.compat import urlparse
+
+from logging_io import setup_logger
+
+log = setup_logger(__name__)
+
+default_percentiles = (50, 95, 99)
+
+# Operations on the services root that are not service folders
+site_service_operations = ('report', 'stopServices', 'startServices', 'deleteServices')
+
+admin_service_pattern = re.compile(r'^.+\.(\w+Server)$')
+rest_service_type_pattern = re.compile(r'^\w+Server$')
+
+
+class RequestMetrics(object):
+    """Records the operation, ArcGIS Server instance, HTTP status, response size and wall time of each request made to
+    ArcGIS Server, and aggregates them into per-operation latency percentiles."""
+
+    def __init__(self):
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.requests = []
+
+    def record(self, operation, ags_instance, status_code, num_bytes, elapsed):
+        with self.lock:
+            self.requests.append(dict(
+                operation=operation,
+                ags_instance=ags_instance,
+                status_code=status_code,
+                num_bytes=num_bytes,
+                elapsed=elapsed,
+                timestamp=time.time()
+            ))
+
+    def summarize(self, percentiles=default_percentiles):
+        with self.lock:
+            requests = list(self.requests)
+        grouped_requests = collections.defaultdict(list)
+        for request in requests:
+            grouped_requests[(request['ags_instance'], request['operation'])].append(request)
+        summary = []
+        for (ags_instance, operation), operation_requests in sorted(grouped_requests.iteritems()):
+            elapsed_times = sorted(request['elapsed'] for request in operation_requests)
+            operation_summary = collections.OrderedDict((
+                ('ags_instance', ags_instance),
+                ('operation', operation),
+                ('count', len(operation_requests)),
+                ('errors', sum(1 for request in operation_requests if request['status_code'] != 200)),
+                ('total_bytes', sum(request['num_bytes'] for request in operation_requests)),
+                ('total_time', sum(elapsed_times)),
+            ))
+            for percent in percentiles:
+                operation_summary['p{}'.format(percent)] = get_percentile(elapsed_times, percent)
+            operation_summary['max'] = elapsed_times[-1]
+            summary.append(operation_summary)
+        return summary
+
+    def log_summary(self, level=logging.INFO):
+        summary = self.summarize()
+        if not summary:
+            return
+        log.log(
+            level,
+            'Request metrics:\n{}'.format(
+                '\n'.join(
+                    '{ags_instance} {operation}: {count} requests, {errors} errors, {total_bytes} bytes, '
+                    'p50 {p50:.3f}s, p95 {p95:.3f}s, p99 {p99:.3f}s, max {max:.3f}s'
+                    .format(**operation_summary)
+                    for operation_summary in summary
+                )
+            )
+        )
+
+    def write_summary(self, file_path):
+        log.info('Writing request metrics to file: {}'.format(file_path))
+        with self.lock:
+            requests = list(self.requests)
+        with open(file_path, 'wb') as f:
+            json.dump(dict(summary=self.summarize(), requests=requests), f, indent=4)
+
+
+def get_percentile(sorted_values, percent):
+    # Nearest-rank percentile of an already sorted, non-empty sequence
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def get_operation_name(url):
+    # Names the kind of request made to url by replacing service folder and service names with placeholders, e.g.
+    # admin/services/{service}.MapServer/status or rest/services/{service}/MapServer/export. Upload item and
+    # geoprocessing job IDs are replaced as well, e.g. admin/uploads/{item}/uploadPart.
+    parts = urlparse(url).path.strip('/').split('/')
+    if parts[0] == 'arcgis':
+        parts = parts[1:]
+    if len(parts) > 2 and parts[:2] == ['admin', 'uploads'] and parts[2] != 'register':
+        parts[2] = '{item}'
+    if 'jobs' in parts[:-1]:
+        parts[parts.index('jobs') + 1] = '{job}'
+    if len(parts) < 3 or parts[1] != 'services':
+        return '/'.join(parts)
+    api, services_parts = parts[0], parts[2:]
+    for i, part in enumerate(services_parts):
+        if api == 'admin':
+            match = admin_service_pattern.match(part)
+            if match:
+                return '/'.join([api, 'services', '{{service}}.{}'.format(match.group(1))] + services_parts[i + 1:])
+        elif i > 0 and rest_service_type_pattern.match(part):
+            return '/'.join([api, 'services', '{service}'] + services_parts[i:])
+    if services_parts[0] not in site_service_operations:
+        services_parts = ['{folder}'] + services_parts[1:]
+    return '/'.join([api, 'services'] + services_parts)
+
+
+request_metrics = RequestMetrics()
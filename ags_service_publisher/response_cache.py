@@ -0,0 +1,125 @@
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from requests.compat import urlparse
+
+from config_io import default_config_dir
+from logging_io import setup_logger
+
+log = setup_logger(__name__)
+
+response_cache_dir_name = 'responsecache'
+default_response_cache_dir = os.path.join(default_config_dir, response_cache_dir_name)
+
+
+class ResponseCache(object):
+    """On-disk cache of the responses to read-only ArcGIS Server requests (service folder and service listings,
+    service info and manifests), so that repeated reporting runs do not re-fetch the same data.
+    Each response is stored as a JSON file under a directory for its ArcGIS Server instance, at a path mirroring the
+    URL path it was requested from, so that everything cached for a service (or a whole instance) can be invalidated
+    at once. Responses older than the TTL passed to get are treated as missing."""
+
+    def __init__(self, cache_dir=default_response_cache_dir):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+
+    def set_cache_dir(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def key_from_url(url):
+        return urlparse(url).path.strip('/')
+
+    def get_cache_path(self, ags_instance, key):
+        return os.path.join(self.cache_dir, ags_instance, *key.split('/'))
+
+    def get(self, ags_instance, key, ttl):
+        cache_file = self.get_cache_path(ags_instance, key) + '.json'
+        try:
+            if os.path.getmtime(cache_file) + ttl <= time.time():
+                return None
+            with open(cache_file, 'rb') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        log.debug('Using cached response for ArcGIS Server instance {}: {}'.format(ags_instance, key))
+        return data
+
+    def put(self, ags_instance, key, data):
+        cache_file = self.get_cache_path(ags_instance, key) + '.json'
+        # Write to a temporary file first so that concurrent readers never see a partially written response
+        temp_file = '{}.{}.tmp'.format(cache_file, uuid.uuid4().hex)
+        try:
+            with self.lock:
+                cache_subdir = os.path.dirname(cache_file)
+                if not os.path.isdir(cache_subdir):
+                    os.makedirs(cache_subdir)
+            with open(temp_file, 'wb') as f:
+                json.dump(data, f)
+            with self.lock:
+                if os.path.exists(cache_file):
+                    os.remove(cache_file)
+                os.rename(temp_file, cache_file)
+        except (IOError, OSError):
+            log.warn('Unable to write cached response file {}'.format(cache_file), exc_info=True)
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    def get_or_fetch(self, ags_instance, key, ttl, fetch):
+        if not ags_instance or not ttl:
+            return fetch()
+        data = self.get(ags_instance, key, ttl)
+        if data is None:
+            data = fetch()
+            self.put(ags_instance, key, data)
+        return data
+
+    def invalidate(self, ags_instance, key=None, recursive=False):
+        # Removes the cached response for key, and if recursive, everything cached beneath it.
+        # If key is not specified, everything cached for the instance is removed.
+        cache_path = self.get_cache_path(ags_instance, key) if key else os.path.join(self.cache_dir, ags_instance)
+        with self.lock:
+            try:
+                if key and os.path.isfile(cache_path + '.json'):
+                    os.remove(cache_path + '.json')
+                if (recursive or not key) and os.path.isdir(cache_path):
+                    shutil.rmtree(cache_path)
+            except (IOError, OSError):
+                log.warn('Unable to remove cached responses at {}'.format(cache_path), exc_info=True)
+
+    def invalidate_service(self, ags_instance, service_name, service_folder=None, service_type='MapServer'):
+        log.debug(
+            'Invalidating cached responses for service {}/{} on ArcGIS Server instance {}'
+            .format(service_folder, service_name, ags_instance)
+        )
+        admin_services_key = 'arcgis/admin/services'
+        rest_services_key = 'arcgis/rest/services'
+        # The folder listing changes if a service is published to a new folder
+        self.invalidate(ags_instance, admin_services_key)
+        if service_folder:
+            self.invalidate(ags_instance, '/'.join((admin_services_key, service_folder)))
+        self.invalidate(
+            ags_instance,
+            '/'.join(part for part in (admin_services_key, service_folder, '{}.{}'.format(service_name, service_type)) if part),
+            True
+        )
+        self.invalidate(
+            ags_instance,
+            '/'.join(part for part in (rest_services_key, service_folder, service_name, service_type) if part),
+            True
+        )
+
+    def clear(self):
+        log.debug('Clearing response cache directory: {}'.format(self.cache_dir))
+        with self.lock:
+            if os.path.isdir(self.cache_dir):
+                shutil.rmtree(self.cache_dir)
+
+
+response_cache = ResponseCache()
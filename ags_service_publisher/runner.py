@@ -1,15 +1,27 @@
 from __future__ import unicode_literals
 
+import datetime
+import functools
 import logging
 import os
 
-from ags_utils import prompt_for_credentials, generate_token, import_sde_connection_file, create_session
+from ags_utils import (
+    AgsAdminClient,
+    default_max_concurrent_restarts,
+    default_max_services_down,
+    import_sde_connection_file,
+    prompt_for_credentials
+)
+from backup_store import backup_restore_dir_name, get_backup_store
 from config_io import get_config, get_configs, set_config, default_config_dir
 from datasources import list_sde_connection_files_in_folder
 from extrafilters import superfilter
+from file_sync import file_sync_stats
 from helpers import asterisk_tuple, empty_tuple
 from logging_io import setup_logger, setup_console_log_handler, setup_file_log_handler, default_log_dir
-from publishing import cleanup_config, publish_config
+from publishing import cleanup_config, publish_config, open_worker_pool
+from publishing_journal import PublishingJournal, publishing_journal_file_name
+from publishing_state import publishing_state, publishing_state_file_name
 from reporters import (
     DatasetGeometryStatisticsReporter,
     DatasetUsagesReporter,
@@ -22,12 +34,43 @@ from reporters import (
     ServicePublishingReporter,
     default_report_dir
 )
+from request_metrics import request_metrics
+from response_cache import response_cache, response_cache_dir_name
+from service_definition_cache import service_definition_cache, service_definition_cache_dir_name
 from services import restart_services, test_services
+from tokens import token_manager, token_cache_file_name
 
 log = setup_logger(__name__)
 root_logger = setup_logger()
 
 
+def records_request_metrics(job):
+    # Records the requests made to ArcGIS Server during a Runner job, and reports them once it finishes
+    @functools.wraps(job)
+    def wrapper(self, *args, **kwargs):
+        request_metrics.reset()
+        try:
+            return job(self, *args, **kwargs)
+        finally:
+            self.report_request_metrics(job.__name__)
+    return wrapper
+
+
+def warn_of_expiring_tokens(
+    user_config,
+    included_envs=asterisk_tuple, excluded_envs=empty_tuple,
+    included_instances=asterisk_tuple, excluded_instances=empty_tuple
+):
+    # Warns, before a long-running job starts, about any token it will not be able to renew before it expires
+    for env_name in superfilter(user_config['environments'].keys(), included_envs, excluded_envs):
+        ags_instances = superfilter(
+            user_config['environments'][env_name]['ags_instances'].keys(),
+            included_instances,
+            excluded_instances
+        )
+        token_manager.warn_of_expiring_tokens(ags_instances)
+
+
 class Runner:
     def __init__(
         self,
@@ -36,7 +79,9 @@ class Runner:
         log_to_file=True,
         log_dir=default_log_dir,
         config_dir=default_config_dir,
-        report_dir=default_report_dir
+        report_dir=default_report_dir,
+        log_request_metrics=False,
+        write_request_metrics=False
     ):
         self.verbose = verbose
         self.quiet = quiet
@@ -44,6 +89,8 @@ class Runner:
         self.log_dir = log_dir
         self.config_dir = config_dir
         self.report_dir = report_dir
+        self.log_request_metrics = log_request_metrics
+        self.write_request_metrics = write_request_metrics
 
         if not self.quiet:
             setup_console_log_handler(root_logger, self.verbose)
@@ -53,7 +100,25 @@ class Runner:
             log.debug('Using log directory: {}'.format(self.log_dir))
         log.debug('Using config directory: {}'.format(self.config_dir))
         log.debug('Using report directory: {}'.format(self.report_dir))
+        token_manager.set_cache_file(os.path.join(self.config_dir, token_cache_file_name))
+        response_cache.set_cache_dir(os.path.join(self.config_dir, response_cache_dir_name))
+        publishing_state.set_state_file(os.path.join(self.config_dir, publishing_state_file_name))
+        service_definition_cache.set_cache_dir(os.path.join(self.config_dir, service_definition_cache_dir_name))
+
+    def report_request_metrics(self, job_name):
+        request_metrics.log_summary(logging.INFO if self.log_request_metrics else logging.DEBUG)
+        if self.write_request_metrics and request_metrics.requests:
+            if not os.path.isdir(self.report_dir):
+                log.debug('Creating report directory: {}'.format(self.report_dir))
+                os.mkdir(self.report_dir)
+            request_metrics.write_summary(
+                os.path.join(
+                    self.report_dir,
+                    'Request_Metrics_{}_{}.json'.format(job_name, datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+                )
+            )
 
+    @records_request_metrics
     def run_batch_publishing_job(
         self,
         included_configs=asterisk_tuple, excluded_configs=empty_tuple,
@@ -67,10 +132,16 @@ class Runner:
         warn_on_publishing_errors=False,
         warn_on_validation_errors=False,
         create_backups=True,
-        update_timestamps=True
+        update_timestamps=True,
+        incremental=False,
+        reuse_service_definitions=False,
+        resume=False
     ):
         configs = get_configs(included_configs, excluded_configs, self.config_dir)
+        user_config = get_config('userconfig', self.config_dir)
+        file_sync_stats.reset()
         log.info('Batch publishing configs: {}'.format(', '.join(config_name for config_name in configs.keys())))
+        warn_of_expiring_tokens(user_config, included_envs, excluded_envs, included_instances, excluded_instances)
 
         def publishing_job_generator():
             for config_name, config in configs.iteritems():
@@ -89,9 +160,14 @@ class Runner:
                         warn_on_publishing_errors,
                         warn_on_validation_errors,
                         create_backups,
-                        update_timestamps
+                        update_timestamps,
+                        worker_pool,
+                        incremental,
+                        reuse_service_definitions,
+                        journal.for_config(config_name)
                     ):
                         result['config_name'] = config_name
+                        journal.record(result)
                         yield result
                 except StandardError:
                     log.exception('An error occurred while publishing config \'{}\''.format(config_name))
@@ -101,8 +177,15 @@ class Runner:
                     if log_file_handler:
                         root_logger.removeHandler(log_file_handler)
 
-        return list(publishing_job_generator())
+        # Start the worker processes once for the whole job rather than once per service
+        with open_worker_pool(user_config) as worker_pool, \
+                PublishingJournal(os.path.join(self.config_dir, publishing_journal_file_name), resume) as journal:
+            try:
+                return list(publishing_job_generator())
+            finally:
+                file_sync_stats.log_summary()
 
+    @records_request_metrics
     def run_batch_cleanup_job(
         self,
         included_configs=asterisk_tuple, excluded_configs=empty_tuple,
@@ -111,6 +194,11 @@ class Runner:
     ):
         configs = get_configs(included_configs, excluded_configs, self.config_dir)
         log.info('Batch cleaning configs: {}'.format(', '.join(config_name for config_name in configs.keys())))
+        warn_of_expiring_tokens(
+            get_config('userconfig', self.config_dir),
+            included_envs, excluded_envs,
+            included_instances, excluded_instances
+        )
 
         for config_name, config in configs.iteritems():
             log_file_handler = setup_file_log_handler(root_logger, config_name, self.log_dir) if self.log_to_file else None
@@ -129,6 +217,7 @@ class Runner:
                 if log_file_handler:
                     root_logger.removeHandler(log_file_handler)
 
+    @records_request_metrics
     def run_service_inventory_report(
         self,
         included_services=asterisk_tuple, excluded_services=empty_tuple,
@@ -151,6 +240,7 @@ class Runner:
             self.config_dir
         )
 
+    @records_request_metrics
     def run_service_comparison_report(
         self,
         included_services=asterisk_tuple, excluded_services=empty_tuple,
@@ -175,6 +265,7 @@ class Runner:
             self.config_dir
         )
 
+    @records_request_metrics
     def run_dataset_usages_report(
         self,
         included_datasets=asterisk_tuple, excluded_datasets=empty_tuple,
@@ -205,6 +296,7 @@ class Runner:
             self.config_dir
         )
 
+    @records_request_metrics
     def run_mxd_data_sources_report(
         self,
         included_configs=asterisk_tuple, excluded_configs=empty_tuple,
@@ -237,6 +329,7 @@ class Runner:
             self.config_dir
         )
 
+    @records_request_metrics
     def generate_tokens(
         self,
         included_instances=asterisk_tuple, excluded_instances=empty_tuple,
@@ -260,17 +353,74 @@ class Runner:
             log.info('Refreshing tokens for ArcGIS Server instances: {}'.format(', '.join(ags_instances)))
             for ags_instance in ags_instances:
                 ags_instance_props = env['ags_instances'][ags_instance]
-                server_url = ags_instance_props['url']
-                proxies = ags_instance_props.get('proxies') or user_config.get('proxies')
-                with create_session(server_url, proxies=proxies) as session:
-                    new_token = generate_token(server_url, username, password, expiration, ags_instance, session=session)
+                instance_username, instance_password = prompt_for_credentials(username, password, ags_instance)
+                with AgsAdminClient.from_user_config(user_config, env_name, ags_instance) as client:
+                    new_token = client.generate_token(instance_username, instance_password, expiration)
                     if new_token:
                         ags_instance_props['token'] = new_token
+                        token_manager.set_token(ags_instance, new_token, client.token_expires)
+                        token_manager.register_credentials(
+                            ags_instance,
+                            client.server_url,
+                            instance_username,
+                            instance_password,
+                            expiration,
+                            ags_instance_props.get('proxies') or user_config.get('proxies')
+                        )
                         if not needs_save:
                             needs_save = True
         if needs_save:
             set_config(user_config, 'userconfig', self.config_dir)
 
+    def clear_response_cache(
+        self,
+        included_instances=asterisk_tuple, excluded_instances=empty_tuple,
+        included_envs=asterisk_tuple, excluded_envs=empty_tuple
+    ):
+        user_config = get_config('userconfig', self.config_dir)
+        env_names = superfilter(user_config['environments'].keys(), included_envs, excluded_envs)
+        if len(env_names) == 0:
+            raise RuntimeError('No environments specified!')
+        for env_name in env_names:
+            env = user_config['environments'][env_name]
+            ags_instances = superfilter(env['ags_instances'].keys(), included_instances, excluded_instances)
+            log.info('Clearing cached responses for ArcGIS Server instances: {}'.format(', '.join(ags_instances)))
+            for ags_instance in ags_instances:
+                response_cache.invalidate(ags_instance)
+
+    def list_backups(self, config_name, service_name, env_name):
+        # Returns the timestamps of the backups of a service in an environment's source directory, oldest first
+        config = get_config(config_name, self.config_dir)
+        backup_store = get_backup_store(config['environments'][env_name]['source_dir'])
+        return [backup['timestamp'] for backup in backup_store.get_backups(service_name)]
+
+    def restore_backup(self, config_name, service_name, env_name, timestamp=None, target_dir=None):
+        # Restores the files of the backup of a service made at timestamp (one of those returned by list_backups), or of
+        # its latest backup, to target_dir, returning their paths. By default, they are restored to a directory named
+        # after the service and the time of the backup within a Restored subdirectory of the backup directory, so that
+        # the current source files are left alone.
+        config = get_config(config_name, self.config_dir)
+        backup_store = get_backup_store(config['environments'][env_name]['source_dir'])
+        backups = backup_store.get_backups(service_name)
+        if not backups:
+            raise RuntimeError('No backups of service {} found in {}'.format(service_name, backup_store.backup_dir))
+        if timestamp is None:
+            timestamp = backups[-1]['timestamp']
+        if target_dir is None:
+            target_dir = os.path.join(
+                backup_store.backup_dir,
+                backup_restore_dir_name,
+                '{}_{}'.format(
+                    service_name,
+                    datetime.datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S').strftime('%Y%m%d-%H%M%S')
+                )
+            )
+        if not os.path.isdir(target_dir):
+            log.debug('Creating directory: {}'.format(target_dir))
+            os.makedirs(target_dir)
+        return backup_store.restore(service_name, target_dir, timestamp)
+
+    @records_request_metrics
     def batch_import_sde_connection_files(
         self,
         included_connection_files=asterisk_tuple, excluded_connection_files=empty_tuple,
@@ -305,6 +455,7 @@ class Runner:
                         os.path.join(sde_connections_dir, sde_connection_file + '.sde')
                     )
 
+    @records_request_metrics
     def batch_restart_services(
         self,
         included_services=asterisk_tuple, excluded_services=empty_tuple,
@@ -314,9 +465,16 @@ class Runner:
         include_running_services=True,
         delay=30,
         max_retries=3,
-        test_after_restart=True
+        test_after_restart=True,
+        max_concurrent_restarts=default_max_concurrent_restarts,
+        max_services_down=default_max_services_down
     ):
         log.info('Batch restarting services')
+        warn_of_expiring_tokens(
+            get_config('userconfig', self.config_dir),
+            included_envs, excluded_envs,
+            included_instances, excluded_instances
+        )
 
         restart_services(
             included_services, excluded_services,
@@ -327,9 +485,12 @@ class Runner:
             delay,
             max_retries,
             test_after_restart,
+            max_concurrent_restarts,
+            max_services_down,
             self.config_dir
         )
 
+    @records_request_metrics
     def batch_test_services(
         self,
         included_services=asterisk_tuple, excluded_services=empty_tuple,
@@ -349,6 +510,7 @@ class Runner:
             self.config_dir
         ))
 
+    @records_request_metrics
     def run_service_health_report(
         self,
         included_services=asterisk_tuple, excluded_services=empty_tuple,
@@ -373,6 +535,7 @@ class Runner:
             self.config_dir
         )
 
+    @records_request_metrics
     def run_service_analysis_report(
         self,
         included_envs=asterisk_tuple, excluded_envs=empty_tuple,
@@ -397,6 +560,7 @@ class Runner:
             self.config_dir
         )
 
+    @records_request_metrics
     def run_service_layer_fields_report(
         self,
         included_envs=asterisk_tuple, excluded_envs=empty_tuple,
@@ -421,6 +585,7 @@ class Runner:
             self.config_dir
         )
 
+    @records_request_metrics
     def run_dataset_geometry_statistics_report(
         self,
         included_datasets=asterisk_tuple, excluded_datasets=empty_tuple,
@@ -451,6 +616,7 @@ class Runner:
             self.config_dir
         )
 
+    @records_request_metrics
     def run_service_publishing_report(
         self,
         included_configs=asterisk_tuple, excluded_configs=empty_tuple,
@@ -464,7 +630,9 @@ class Runner:
         warn_on_publishing_errors=False,
         warn_on_validation_errors=False,
         output_filename=None,
-        output_format='csv'
+        output_format='csv',
+        incremental=False,
+        reuse_service_definitions=False
     ):
         reporter = ServicePublishingReporter(
             output_dir=self.report_dir,
@@ -482,5 +650,7 @@ class Runner:
             service_suffix,
             warn_on_publishing_errors,
             warn_on_validation_errors,
-            self.config_dir
+            self.config_dir,
+            incremental=incremental,
+            reuse_service_definitions=reuse_service_definitions
         )
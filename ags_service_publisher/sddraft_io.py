@@ -1,5 +1,8 @@
 from __future__ import unicode_literals
 
+import copy
+import os
+import threading
 from xml.etree import ElementTree
 
 from helpers import snake_case_to_pascal_case
@@ -8,106 +11,165 @@ from logging_io import setup_logger
 log = setup_logger(__name__)
 
 
-def modify_sddraft(sddraft, service_properties=None):
-    if not service_properties:
-        log.debug('No service properties specified, SDDraft will not be modified.')
-        return
-    log.debug('Modifying service definition draft file: {}'.format(sddraft))
-    tree = ElementTree.parse(sddraft)
-
-    # Handle special configuration service properties
-    replace_service = service_properties.get('replace_service', False)
-    tile_scheme_file = service_properties.get('tile_scheme_file')
-    cache_tile_format = service_properties.get('cache_tile_format')
-    compression_quality = service_properties.get('compression_quality')
-    keep_existing_cache = service_properties.get('keep_existing_cache', False)
-    feature_access = service_properties.get('feature_access')
-
-    if feature_access:
-        log.debug('Feature access properties specified')
-        feature_access_enabled = feature_access.get('enabled', False)
-        feature_access_capabilities = feature_access.get('capabilities')
-
-        feature_access_element = tree.find(
-            "./Configurations/SVCConfiguration/Definition/Extensions/SVCExtension[TypeName='FeatureServer']"
-        )
-
-        if feature_access_enabled:
-            log.debug('Enabling feature access')
-            feature_access_element.find('Enabled').text = 'true'
-
-        if feature_access_capabilities:
-            feature_access_capabilities = [capability.capitalize() for capability in feature_access_capabilities]
-            log.debug('Setting feature access capabilities {}'.format(feature_access_capabilities))
-            feature_access_element.find(
-                "./Info/PropertyArray/PropertySetProperty[Key='WebCapabilities']/Value"
-            ).text = ','.join(feature_access_capabilities)
-    else:
-        log.debug('No feature access properties specified')
-
-    # Replace the service if specified
-    if replace_service:
-        log.debug('Replacing existing service')
-        tree.find('Type').text = 'esriServiceDefinitionType_Replacement'
-    else:
-        log.debug('Publishing new service')
-
-    # Update the tile cache scheme if specified
-    if tile_scheme_file:
-        log.debug('Tile scheme file {} specified'.format(tile_scheme_file))
-        tile_tree = ElementTree.parse(tile_scheme_file)
-        tile_cache_info_element = tile_tree.find('TileCacheInfo')
-        cache_schema_element = tree.find('CacheSchema')
-        old_tile_cache_info_element = cache_schema_element.find('TileCacheInfo')
-        cache_schema_element.remove(old_tile_cache_info_element)
-        cache_schema_element.append(tile_cache_info_element)
-    else:
-        log.debug('No tile scheme file specified')
-
-    # Update the cache tile format if specified
-    if cache_tile_format:
-        log.debug('Cache tile format {} specified'.format(cache_tile_format))
-        cache_schema_element = tree.find('CacheSchema')
-        tile_image_info_element = cache_schema_element.find('TileImageInfo')
-        cache_tile_format_element = tile_image_info_element.find('CacheTileFormat')
-        cache_tile_format_element.text = cache_tile_format
-    else:
-        log.debug('No cache tile format specified')
-
-    # Update the cache image compression quality if specified
-    if compression_quality:
-        log.debug('Cache image compression quality {} specified'.format(compression_quality))
-        cache_schema_element = tree.find('CacheSchema')
-        tile_image_info_element = cache_schema_element.find('TileImageInfo')
-        compression_quality_element = tile_image_info_element.find('CompressionQuality')
-        compression_quality_element.text = compression_quality
-    else:
-        log.debug('No cache image compression quality specified')
-
-    # Keep the existing cache if specified
-    if keep_existing_cache:
-        log.debug('Keeping existing map cache')
-        keep_existing_map_cache_element = tree.find('KeepExistingMapCache')
-        keep_existing_map_cache_element.text = 'true'
-    else:
-        log.debug('Replacing existing map cache')
-
-    xpath = "./Configurations/SVCConfiguration/Definition/*/PropertyArray/PropertySetProperty"
-    log.debug('Searching for elements matching XPath expression: {}'.format(xpath))
-    property_elements = tree.findall(xpath)
-    log.debug('{} match(es) for XPath expression: {}'.format(len(property_elements), xpath))
-    for property_element in property_elements:
-        property_name = property_element.find('Key').text
-        for key, value in service_properties.iteritems():
-            if snake_case_to_pascal_case(key).lower() == property_name.lower():
+class TileSchemeCache(object):
+    """Process-wide cache of the TileCacheInfo elements parsed from tile scheme files, keyed by path and modification
+    time, so that a tile scheme file shared by many cached map services is only parsed once per process (including
+    once per long-lived worker process) rather than once per service and instance, and is parsed again if it changes.
+    Cached elements are shared, so callers must copy them rather than modify them or add them to another tree."""
+
+    def __init__(self):
+        self.elements = {}
+        self.lock = threading.Lock()
+
+    def get(self, tile_scheme_file):
+        key = os.path.normcase(os.path.abspath(tile_scheme_file))
+        mtime = os.path.getmtime(tile_scheme_file)
+        with self.lock:
+            cached = self.elements.get(key)
+            if cached and cached[0] == mtime:
+                log.debug('Using cached tile scheme from file {}'.format(tile_scheme_file))
+                return cached[1]
+        log.debug('Parsing tile scheme file {}'.format(tile_scheme_file))
+        tile_cache_info_element = ElementTree.parse(tile_scheme_file).find('TileCacheInfo')
+        with self.lock:
+            self.elements[key] = (mtime, tile_cache_info_element)
+        return tile_cache_info_element
+
+    def clear(self):
+        with self.lock:
+            self.elements.clear()
+
+
+class SDDraftTransform(object):
+    """Modifications to make to service definition drafts, compiled once from a service's merged service properties so
+    that they can be applied to the draft for each ArcGIS Server instance without resolving the properties again.
+    The special configuration properties (feature access, tile scheme, cache settings and so on) are resolved, and the
+    tile scheme file parsed (through the tile scheme cache), when the transform is compiled, and the remaining
+    properties are mapped by the lowercased PascalCase key they match in the draft, so that applying the transform
+    takes a single pass over its property elements. Transforms can be pickled, so one compiled in the main process can be applied in a worker process."""
+
+    def __init__(self, service_properties=None):
+        service_properties = service_properties or {}
+        self.empty = not service_properties
+
+        # Handle special configuration service properties
+        self.replace_service = service_properties.get('replace_service', False)
+        self.tile_scheme_file = service_properties.get('tile_scheme_file')
+        self.cache_tile_format = service_properties.get('cache_tile_format')
+        self.compression_quality = service_properties.get('compression_quality')
+        self.keep_existing_cache = service_properties.get('keep_existing_cache', False)
+        feature_access = service_properties.get('feature_access')
+        self.feature_access_enabled = feature_access.get('enabled', False) if feature_access else False
+        feature_access_capabilities = feature_access.get('capabilities') if feature_access else None
+        self.feature_access_capabilities = [
+            capability.capitalize() for capability in feature_access_capabilities
+        ] if feature_access_capabilities else None
+        self.feature_access = bool(feature_access)
+
+        if self.tile_scheme_file:
+            self.tile_cache_info_element = tile_scheme_cache.get(self.tile_scheme_file)
+        else:
+            self.tile_cache_info_element = None
+
+        self.property_values = {
+            snake_case_to_pascal_case(key).lower(): value
+            for key, value in service_properties.iteritems()
+        }
+
+    def apply(self, sddraft):
+        if self.empty:
+            log.debug('No service properties specified, SDDraft will not be modified.')
+            return
+        log.debug('Modifying service definition draft file: {}'.format(sddraft))
+        tree = ElementTree.parse(sddraft)
+
+        if self.feature_access:
+            log.debug('Feature access properties specified')
+            feature_access_element = tree.find(
+                "./Configurations/SVCConfiguration/Definition/Extensions/SVCExtension[TypeName='FeatureServer']"
+            )
+
+            if self.feature_access_enabled:
+                log.debug('Enabling feature access')
+                feature_access_element.find('Enabled').text = 'true'
+
+            if self.feature_access_capabilities:
+                log.debug('Setting feature access capabilities {}'.format(self.feature_access_capabilities))
+                feature_access_element.find(
+                    "./Info/PropertyArray/PropertySetProperty[Key='WebCapabilities']/Value"
+                ).text = ','.join(self.feature_access_capabilities)
+        else:
+            log.debug('No feature access properties specified')
+
+        # Replace the service if specified
+        if self.replace_service:
+            log.debug('Replacing existing service')
+            tree.find('Type').text = 'esriServiceDefinitionType_Replacement'
+        else:
+            log.debug('Publishing new service')
+
+        # Update the tile cache scheme if specified
+        if self.tile_scheme_file:
+            log.debug('Tile scheme file {} specified'.format(self.tile_scheme_file))
+            cache_schema_element = tree.find('CacheSchema')
+            old_tile_cache_info_element = cache_schema_element.find('TileCacheInfo')
+            cache_schema_element.remove(old_tile_cache_info_element)
+            # Copied, as the element is shared with the tile scheme cache and any other drafts it is applied to
+            cache_schema_element.append(copy.deepcopy(self.tile_cache_info_element))
+        else:
+            log.debug('No tile scheme file specified')
+
+        # Update the cache tile format if specified
+        if self.cache_tile_format:
+            log.debug('Cache tile format {} specified'.format(self.cache_tile_format))
+            cache_schema_element = tree.find('CacheSchema')
+            tile_image_info_element = cache_schema_element.find('TileImageInfo')
+            cache_tile_format_element = tile_image_info_element.find('CacheTileFormat')
+            cache_tile_format_element.text = self.cache_tile_format
+        else:
+            log.debug('No cache tile format specified')
+
+        # Update the cache image compression quality if specified
+        if self.compression_quality:
+            log.debug('Cache image compression quality {} specified'.format(self.compression_quality))
+            cache_schema_element = tree.find('CacheSchema')
+            tile_image_info_element = cache_schema_element.find('TileImageInfo')
+            compression_quality_element = tile_image_info_element.find('CompressionQuality')
+            compression_quality_element.text = self.compression_quality
+        else:
+            log.debug('No cache image compression quality specified')
+
+        # Keep the existing cache if specified
+        if self.keep_existing_cache:
+            log.debug('Keeping existing map cache')
+            keep_existing_map_cache_element = tree.find('KeepExistingMapCache')
+            keep_existing_map_cache_element.text = 'true'
+        else:
+            log.debug('Replacing existing map cache')
+
+        xpath = "./Configurations/SVCConfiguration/Definition/*/PropertyArray/PropertySetProperty"
+        log.debug('Searching for elements matching XPath expression: {}'.format(xpath))
+        property_elements = tree.findall(xpath)
+        log.debug('{} match(es) for XPath expression: {}'.format(len(property_elements), xpath))
+        for property_element in property_elements:
+            property_name = property_element.find('Key').text
+            if property_name.lower() in self.property_values:
+                value = self.property_values[property_name.lower()]
                 if str(value) == 'True' or str(value) == 'False':
                     value = str(value).lower()
                 log.debug('Setting value of property name {} to {}'.format(property_name, value))
                 property_element.find('Value').text = str(value)
 
-    # Add the namespaces which get stripped back into the .SD
-    root_elem = tree.getroot()
-    root_elem.attrib['xmlns:typens'] = 'http://www.esri.com/schemas/ArcGIS/10.1'
-    root_elem.attrib['xmlns:xs'] = 'http://www.w3.org/2001/XMLSchema'
-    log.debug('Writing service definition file: {}'.format(sddraft))
-    tree.write(sddraft)
+        # Add the namespaces which get stripped back into the .SD
+        root_elem = tree.getroot()
+        root_elem.attrib['xmlns:typens'] = 'http://www.esri.com/schemas/ArcGIS/10.1'
+        root_elem.attrib['xmlns:xs'] = 'http://www.w3.org/2001/XMLSchema'
+        log.debug('Writing service definition file: {}'.format(sddraft))
+        tree.write(sddraft)
+
+
+def modify_sddraft(sddraft, service_properties=None):
+    SDDraftTransform(service_properties).apply(sddraft)
+
+
+tile_scheme_cache = TileSchemeCache()
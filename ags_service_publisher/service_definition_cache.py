@@ -0,0 +1,57 @@
+from __future__ import unicode_literals
+
+import os
+import shutil
+import threading
+
+from config_io import default_config_dir
+from logging_io import setup_logger
+
+log = setup_logger(__name__)
+
+service_definition_cache_dir_name = 'sdcache'
+default_service_definition_cache_dir = os.path.join(default_config_dir, service_definition_cache_dir_name)
+
+
+class ServiceDefinitionCache(object):
+    """On-disk cache of staged service definition (.sd) files, so that a service is only drafted, analyzed and staged
+    once and the same .sd file is then uploaded to each ArcGIS Server instance.
+    Files are content-addressed: each one is named after a key derived from everything that went into staging it (see
+    publishing.get_service_definition_key), under a directory for its service folder and service. Only the most
+    recently staged file is kept for each service."""
+
+    def __init__(self, cache_dir=default_service_definition_cache_dir):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+
+    def set_cache_dir(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get_service_dir(self, service_name, service_folder=None):
+        return os.path.join(self.cache_dir, service_folder or '', service_name)
+
+    def get_path(self, key, service_name, service_folder=None):
+        return os.path.join(self.get_service_dir(service_name, service_folder), key + '.sd')
+
+    def remove_stale(self, key, service_name, service_folder=None):
+        # Removes every other staged file for the service (along with anything kept alongside it, such as the progress
+        # of its uploads) once a new one has been staged
+        service_dir = self.get_service_dir(service_name, service_folder)
+        with self.lock:
+            for file_name in os.listdir(service_dir) if os.path.isdir(service_dir) else ():
+                if not file_name.startswith(key + '.'):
+                    file_path = os.path.join(service_dir, file_name)
+                    log.debug('Removing stale service definition file: {}'.format(file_path))
+                    try:
+                        os.remove(file_path)
+                    except OSError:
+                        log.warn('Unable to remove stale service definition file {}'.format(file_path), exc_info=True)
+
+    def clear(self):
+        log.debug('Clearing service definition cache directory: {}'.format(self.cache_dir))
+        with self.lock:
+            if os.path.isdir(self.cache_dir):
+                shutil.rmtree(self.cache_dir)
+
+
+service_definition_cache = ServiceDefinitionCache()
@@ -6,61 +6,132 @@ import os
 import tempfile
 from copy import deepcopy
 from itertools import chain
+from multiprocessing.pool import ThreadPool
 from shutil import rmtree
 
-from ags_utils import (
-    create_session,
-    get_service_manifest,
-    get_service_status,
-    list_service_folders,
-    list_service_workspaces,
-    list_services,
-    restart_service,
-    test_service
-)
+from ags_utils import AgsAdminClient, default_max_concurrent_restarts, default_max_services_down
 from config_io import get_config, default_config_dir
 from datasources import open_mxd, list_layers_in_mxd, get_layer_fields, get_layer_properties
+from directory_index import DirectoryIndex
 from extrafilters import superfilter
 from helpers import asterisk_tuple, empty_tuple
-from logging_io import setup_logger
+from logging_io import setup_logger, LazyFormat, LazyJson
 
 log = setup_logger(__name__)
 
+default_max_concurrent_requests = 4
+default_max_concurrent_instances = 8
 
-def generate_service_inventory(
+
+def get_max_concurrent_requests(user_config, ags_instance_props):
+    return (
+        ags_instance_props.get('max_concurrent_requests') or
+        user_config.get('max_concurrent_requests') or
+        default_max_concurrent_requests
+    )
+
+
+def crawl_services(
+    user_config,
     included_services=asterisk_tuple, excluded_services=empty_tuple,
     included_service_folders=asterisk_tuple, excluded_service_folders=empty_tuple,
     included_instances=asterisk_tuple, excluded_instances=empty_tuple,
     included_envs=asterisk_tuple, excluded_envs=empty_tuple,
-    config_dir=default_config_dir
+    service_types=None
 ):
-    user_config = get_config('userconfig', config_dir)
+    """Generator function which yields a (service_props, ags_instance_props, client) tuple for each service
+    matching the given filters.
+    Service folders are listed concurrently across all of the matching ArcGIS Server instances, and the services within
+    each service folder are listed concurrently using at most max_concurrent_requests threads per instance (set either
+    per instance or at the top level of userconfig.yml).
+    Results are yielded in the same order as a sequential crawl. Each AgsAdminClient remains open until the generator
+    is exhausted or closed, so it may be reused for any further requests made against that service's instance."""
     env_names = superfilter(user_config['environments'].keys(), included_envs, excluded_envs)
     if len(env_names) == 0:
         raise RuntimeError('No environments specified!')
+
+    instances = []
     for env_name in env_names:
         env = user_config['environments'][env_name]
         ags_instances = superfilter(env['ags_instances'].keys(), included_instances, excluded_instances)
-        log.info('Listing services on ArcGIS Server instances {}'.format(', '.join(ags_instances)))
-        for ags_instance in ags_instances:
-            ags_instance_props = env['ags_instances'][ags_instance]
-            server_url = ags_instance_props['url']
-            token = ags_instance_props['token']
-            proxies = ags_instance_props.get('proxies') or user_config.get('proxies')
-            with create_session(server_url, proxies=proxies) as session:
-                service_folders = list_service_folders(server_url, token, session=session)
-                for service_folder in superfilter(service_folders, included_service_folders, excluded_service_folders):
-                    for service in list_services(server_url, token, service_folder, session=session):
-                        service_name = service['serviceName']
-                        service_type = service['type']
-                        if superfilter((service_name,), included_services, excluded_services):
-                            yield dict(
-                                env_name=env_name,
-                                ags_instance=ags_instance,
-                                service_folder=service_folder,
-                                service_name=service_name,
-                                service_type=service_type
-                            )
+        log.info('Crawling services on ArcGIS Server instances {}'.format(', '.join(ags_instances)))
+        instances.extend((env_name, ags_instance, env['ags_instances'][ags_instance]) for ags_instance in ags_instances)
+    if len(instances) == 0:
+        return
+
+    clients = []
+
+    def crawl_instance(instance):
+        env_name, ags_instance, ags_instance_props = instance
+        client = AgsAdminClient.from_user_config(user_config, env_name, ags_instance)
+        clients.append(client)
+        service_folders = superfilter(
+            client.list_service_folders(),
+            included_service_folders,
+            excluded_service_folders
+        )
+
+        def list_folder_services(service_folder):
+            return service_folder, client.list_services(service_folder)
+
+        max_concurrent_requests = get_max_concurrent_requests(user_config, ags_instance_props)
+        log.debug(
+            'Listing services in {} service folders on ArcGIS Server instance {} ({} concurrent requests)'
+            .format(len(service_folders), ags_instance, max_concurrent_requests)
+        )
+        folder_pool = ThreadPool(max(1, min(max_concurrent_requests, len(service_folders))))
+        try:
+            folder_services = folder_pool.map(list_folder_services, service_folders)
+        finally:
+            folder_pool.terminate()
+        return env_name, ags_instance, ags_instance_props, client, folder_services
+
+    instance_pool = ThreadPool(min(default_max_concurrent_instances, len(instances)))
+    try:
+        for (
+            env_name,
+            ags_instance,
+            ags_instance_props,
+            client,
+            folder_services
+        ) in instance_pool.imap(crawl_instance, instances):
+            for service_folder, services in folder_services:
+                for service in services:
+                    service_name = service['serviceName']
+                    service_type = service['type']
+                    if (
+                        (not service_types or service_type in service_types) and
+                        superfilter((service_name,), included_services, excluded_services)
+                    ):
+                        yield dict(
+                            env_name=env_name,
+                            ags_instance=ags_instance,
+                            service_folder=service_folder,
+                            service_name=service_name,
+                            service_type=service_type
+                        ), ags_instance_props, client
+    finally:
+        instance_pool.terminate()
+        for client in clients:
+            client.close()
+
+
+def generate_service_inventory(
+    included_services=asterisk_tuple, excluded_services=empty_tuple,
+    included_service_folders=asterisk_tuple, excluded_service_folders=empty_tuple,
+    included_instances=asterisk_tuple, excluded_instances=empty_tuple,
+    included_envs=asterisk_tuple, excluded_envs=empty_tuple,
+    config_dir=default_config_dir
+):
+    user_config = get_config('userconfig', config_dir)
+    for service_props, ags_instance_props, client in crawl_services(
+        user_config,
+        included_services, excluded_services,
+        included_service_folders, excluded_service_folders,
+        included_instances, excluded_instances,
+        included_envs, excluded_envs
+    ):
+        yield service_props
 
 
 def analyze_services(
@@ -74,135 +145,121 @@ def analyze_services(
     import arcpy
     arcpy.env.overwriteOutput = True
     user_config = get_config('userconfig', config_dir)
-    env_names = superfilter(user_config['environments'].keys(), included_envs, excluded_envs)
 
-    for env_name in env_names:
-        log.debug('Analyzing services for environment {}'.format(env_name))
-        env = user_config['environments'][env_name]
-        for ags_instance in superfilter(env['ags_instances'], included_instances, excluded_instances):
-            ags_instance_props = user_config['environments'][env_name]['ags_instances'][ags_instance]
-            ags_connection = ags_instance_props['ags_connection']
-            server_url = ags_instance_props['url']
-            token = ags_instance_props['token']
-            proxies = ags_instance_props.get('proxies') or user_config.get('proxies')
-            with create_session(server_url, proxies=proxies) as session:
-                service_folders = list_service_folders(server_url, token, session=session)
-                for service_folder in superfilter(service_folders, included_service_folders, excluded_service_folders):
-                    for service in list_services(server_url, token, service_folder, session=session):
-                        service_name = service['serviceName']
-                        service_type = service['type']
-                        if (
-                            service_type in ('MapServer', 'GeocodeServer') and
-                            superfilter((service_name,), included_services, excluded_services)
-                        ):
-                            service_props = dict(
-                                env_name=env_name,
-                                ags_instance=ags_instance,
-                                service_folder=service_folder,
-                                service_name=service_name,
-                                service_type=service_type
+    for service_props, ags_instance_props, client in crawl_services(
+        user_config,
+        included_services, excluded_services,
+        included_service_folders, excluded_service_folders,
+        included_instances, excluded_instances,
+        included_envs, excluded_envs,
+        service_types=('MapServer', 'GeocodeServer')
+    ):
+        ags_instance = service_props['ags_instance']
+        service_folder = service_props['service_folder']
+        service_name = service_props['service_name']
+        service_type = service_props['service_type']
+        ags_connection = ags_instance_props['ags_connection']
+        try:
+            service_manifest = client.get_service_manifest(service_name, service_folder, service_type)
+            service_props['file_path'] = file_path = service_manifest['resources'][0]['onPremisePath']
+            file_type = {
+                'MapServer': 'MXD',
+                'GeocodeServer': 'Locator'
+            }[service_type]
+            log.info(
+                'Analyzing {} service {}/{} on ArcGIS Server instance {} (Connection File: {}, {} Path: {})'
+                .format(service_type, service_folder, service_name, ags_instance, ags_connection, file_type, file_path)
+            )
+            if not arcpy.Exists(file_path):
+                raise RuntimeError('{} {} does not exist!'.format(file_type, file_path))
+            try:
+                tempdir = tempfile.mkdtemp()
+                log.debug('Temporary directory created: {}'.format(tempdir))
+                sddraft = os.path.join(tempdir, service_name + '.sddraft')
+                log.debug('Creating SDDraft file: {}'.format(sddraft))
+
+                if service_type == 'MapServer':
+                    mxd = open_mxd(file_path)
+                    analysis = arcpy.mapping.CreateMapSDDraft(
+                        mxd,
+                        sddraft,
+                        service_name,
+                        'FROM_CONNECTION_FILE',
+                        ags_connection,
+                        False,
+                        service_folder
+                    )
+                elif service_type == 'GeocodeServer':
+                    locator_path = file_path
+                    analysis = arcpy.CreateGeocodeSDDraft(
+                        locator_path,
+                        sddraft,
+                        service_name,
+                        'FROM_CONNECTION_FILE',
+                        ags_connection,
+                        False,
+                        service_folder
+                    )
+                else:
+                    raise RuntimeError('Unsupported service type {}!'.format(service_type))
+
+                for key, log_method in (('messages', log.info), ('warnings', log.warn), ('errors', log.error)):
+                    items = analysis[key]
+                    severity = key[:-1].title()
+                    if items:
+                        log.info('----' + key.upper() + '---')
+                        for ((message, code), layerlist) in items.iteritems():
+                            code = '{:05d}'.format(code)
+                            log_method('    {} (CODE {})'.format(message, code))
+                            code = '="{}"'.format(code)
+                            issue_props = dict(
+                                severity=severity,
+                                code=code,
+                                message=message
                             )
-                            try:
-                                service_manifest = get_service_manifest(server_url, token, service_name, service_folder, service_type, session=session)
-                                service_props['file_path'] = file_path = service_manifest['resources'][0]['onPremisePath']
-                                file_type = {
-                                    'MapServer': 'MXD',
-                                    'GeocodeServer': 'Locator'
-                                }[service_type]
-                                log.info(
-                                    'Analyzing {} service {}/{} on ArcGIS Server instance {} (Connection File: {}, {} Path: {})'
-                                    .format(service_type, service_folder, service_name, ags_instance, ags_connection, file_type, file_path)
-                                )
-                                if not arcpy.Exists(file_path):
-                                    raise RuntimeError('{} {} does not exist!'.format(file_type, file_path))
-                                try:
-                                    tempdir = tempfile.mkdtemp()
-                                    log.debug('Temporary directory created: {}'.format(tempdir))
-                                    sddraft = os.path.join(tempdir, service_name + '.sddraft')
-                                    log.debug('Creating SDDraft file: {}'.format(sddraft))
-
-                                    if service_type == 'MapServer':
-                                        mxd = open_mxd(file_path)
-                                        analysis = arcpy.mapping.CreateMapSDDraft(
-                                            mxd,
-                                            sddraft,
-                                            service_name,
-                                            'FROM_CONNECTION_FILE',
-                                            ags_connection,
-                                            False,
-                                            service_folder
-                                        )
-                                    elif service_type == 'GeocodeServer':
-                                        locator_path = file_path
-                                        analysis = arcpy.CreateGeocodeSDDraft(
-                                            locator_path,
-                                            sddraft,
-                                            service_name,
-                                            'FROM_CONNECTION_FILE',
-                                            ags_connection,
-                                            False,
-                                            service_folder
-                                        )
-                                    else:
-                                        raise RuntimeError('Unsupported service type {}!'.format(service_type))
-
-                                    for key, log_method in (('messages', log.info), ('warnings', log.warn), ('errors', log.error)):
-                                        items = analysis[key]
-                                        severity = key[:-1].title()
-                                        if items:
-                                            log.info('----' + key.upper() + '---')
-                                            for ((message, code), layerlist) in items.iteritems():
-                                                code = '{:05d}'.format(code)
-                                                log_method('    {} (CODE {})'.format(message, code))
-                                                code = '="{}"'.format(code)
-                                                issue_props = dict(
-                                                    severity=severity,
-                                                    code=code,
-                                                    message=message
-                                                )
-                                                if not layerlist:
-                                                    yield dict(chain(
-                                                        service_props.iteritems(),
-                                                        issue_props.iteritems()
-                                                    ))
-                                                else:
-                                                    log_method('       applies to:')
-                                                    for layer in layerlist:
-                                                        layer_name = layer.longName if hasattr(layer, 'longName') else layer.name
-                                                        layer_props = dict(
-                                                            dataset_name=layer.datasetName,
-                                                            workspace_path=layer.workspacePath,
-                                                            layer_name=layer_name
-                                                        )
-                                                        log_method('           {}'.format(layer_name))
-                                                        yield dict(chain(
-                                                            service_props.iteritems(),
-                                                            issue_props.iteritems(),
-                                                            layer_props.iteritems()
-                                                        ))
-                                                log_method('')
-
-                                    if analysis['errors']:
-                                        error_message = 'Analysis failed for service {}/{} at {:%#m/%#d/%y %#I:%M:%S %p}' \
-                                            .format(service_folder, service_name, datetime.datetime.now())
-                                        log.error(error_message)
-                                        raise RuntimeError(error_message, analysis['errors'])
-                                finally:
-                                    log.debug('Cleaning up temporary directory: {}'.format(tempdir))
-                                    rmtree(tempdir, ignore_errors=True)
-                            except StandardError as e:
-                                log.exception(
-                                    'An error occurred while analyzing {} service {}/{} on ArcGIS Server instance {}'
-                                    .format(service_type, service_folder, service_name, ags_instance)
-                                )
-                                if not warn_on_errors:
-                                    raise
-                                else:
-                                    yield dict(
-                                        severity='Error',
-                                        message=e.message,
-                                        **service_props
+                            if not layerlist:
+                                yield dict(chain(
+                                    service_props.iteritems(),
+                                    issue_props.iteritems()
+                                ))
+                            else:
+                                log_method('       applies to:')
+                                for layer in layerlist:
+                                    layer_name = layer.longName if hasattr(layer, 'longName') else layer.name
+                                    layer_props = dict(
+                                        dataset_name=layer.datasetName,
+                                        workspace_path=layer.workspacePath,
+                                        layer_name=layer_name
                                     )
+                                    log_method('           {}'.format(layer_name))
+                                    yield dict(chain(
+                                        service_props.iteritems(),
+                                        issue_props.iteritems(),
+                                        layer_props.iteritems()
+                                    ))
+                            log_method('')
+
+                if analysis['errors']:
+                    error_message = 'Analysis failed for service {}/{} at {:%#m/%#d/%y %#I:%M:%S %p}' \
+                        .format(service_folder, service_name, datetime.datetime.now())
+                    log.error(error_message)
+                    raise RuntimeError(error_message, analysis['errors'])
+            finally:
+                log.debug('Cleaning up temporary directory: {}'.format(tempdir))
+                rmtree(tempdir, ignore_errors=True)
+        except StandardError as e:
+            log.exception(
+                'An error occurred while analyzing {} service {}/{} on ArcGIS Server instance {}'
+                .format(service_type, service_folder, service_name, ags_instance)
+            )
+            if not warn_on_errors:
+                raise
+            else:
+                yield dict(
+                    severity='Error',
+                    message=e.message,
+                    **service_props
+                )
 
 
 def list_service_layer_fields(
@@ -216,119 +273,103 @@ def list_service_layer_fields(
     import arcpy
     arcpy.env.overwriteOutput = True
     user_config = get_config('userconfig', config_dir)
-    env_names = superfilter(user_config['environments'].keys(), included_envs, excluded_envs)
 
-    for env_name in env_names:
-        log.debug('Listing service layers and fields for environment {}'.format(env_name))
-        env = user_config['environments'][env_name]
-        for ags_instance in superfilter(env['ags_instances'], included_instances, excluded_instances):
-            ags_instance_props = user_config['environments'][env_name]['ags_instances'][ags_instance]
-            ags_connection = ags_instance_props['ags_connection']
-            server_url = ags_instance_props['url']
-            token = ags_instance_props['token']
-            proxies = ags_instance_props.get('proxies') or user_config.get('proxies')
-            with create_session(server_url, proxies=proxies) as session:
-                service_folders = list_service_folders(server_url, token, session=session)
-                for service_folder in superfilter(service_folders, included_service_folders, excluded_service_folders):
-                    for service in list_services(server_url, token, service_folder, session=session):
-                        service_name = service['serviceName']
-                        service_type = service['type']
-                        if (
-                            service_type == 'MapServer' and
-                            superfilter((service_name,), included_services, excluded_services)
-                        ):
-                            service_props = dict(
-                                env_name=env_name,
-                                ags_instance=ags_instance,
-                                service_folder=service_folder,
-                                service_name=service_name,
-                                service_type=service_type,
-                                ags_connection=ags_connection
+    for service_props, ags_instance_props, client in crawl_services(
+        user_config,
+        included_services, excluded_services,
+        included_service_folders, excluded_service_folders,
+        included_instances, excluded_instances,
+        included_envs, excluded_envs,
+        service_types=('MapServer',)
+    ):
+        service_folder = service_props['service_folder']
+        service_name = service_props['service_name']
+        service_type = service_props['service_type']
+        service_props['ags_connection'] = ags_instance_props['ags_connection']
+        try:
+            service_manifest = client.get_service_manifest(service_name, service_folder, service_type)
+            service_props['mxd_path'] = mxd_path = service_manifest['resources'][0]['onPremisePath']
+            log.info(
+                'Listing layers and fields for {service_type} service {service_folder}/{service_name} '
+                'on ArcGIS Server instance {ags_instance} '
+                '(Connection File: {ags_connection}, MXD Path: {mxd_path})'
+                .format(**service_props)
+            )
+            if not arcpy.Exists(mxd_path):
+                raise RuntimeError('MXD {} does not exist!'.format(mxd_path))
+            mxd = open_mxd(mxd_path)
+            for layer in list_layers_in_mxd(mxd):
+                if not (
+                    (hasattr(layer, 'isGroupLayer') and layer.isGroupLayer) or
+                    (hasattr(layer, 'isRasterLayer') and layer.isRasterLayer)
+                ):
+                    layer_name = getattr(layer, 'longName', layer.name)
+                    try:
+                        layer_props = get_layer_properties(layer)
+                    except StandardError as e:
+                        log.exception(
+                            'An error occurred while retrieving properties for layer {} in MXD {}'
+                            .format(layer_name, mxd_path)
+                        )
+                        if not warn_on_errors:
+                            raise
+                        else:
+                            yield dict(
+                                error='Error retrieving layer properties: {}'.format(e.message),
+                                layer_name=layer_name,
+                                **service_props
                             )
-                            try:
-                                service_manifest = get_service_manifest(server_url, token, service_name, service_folder, service_type, session=session)
-                                service_props['mxd_path'] = mxd_path = service_manifest['resources'][0]['onPremisePath']
-                                log.info(
-                                    'Listing layers and fields for {service_type} service {service_folder}/{service_name} '
-                                    'on ArcGIS Server instance {ags_instance} '
-                                    '(Connection File: {ags_connection}, MXD Path: {mxd_path})'
-                                    .format(**service_props)
-                                )
-                                if not arcpy.Exists(mxd_path):
-                                    raise RuntimeError('MXD {} does not exist!'.format(mxd_path))
-                                mxd = open_mxd(mxd_path)
-                                for layer in list_layers_in_mxd(mxd):
-                                    if not (
-                                        (hasattr(layer, 'isGroupLayer') and layer.isGroupLayer) or
-                                        (hasattr(layer, 'isRasterLayer') and layer.isRasterLayer)
-                                    ):
-                                        layer_name = getattr(layer, 'longName', layer.name)
-                                        try:
-                                            layer_props = get_layer_properties(layer)
-                                        except StandardError as e:
-                                            log.exception(
-                                                'An error occurred while retrieving properties for layer {} in MXD {}'
-                                                .format(layer_name, mxd_path)
-                                            )
-                                            if not warn_on_errors:
-                                                raise
-                                            else:
-                                                yield dict(
-                                                    error='Error retrieving layer properties: {}'.format(e.message),
-                                                    layer_name=layer_name,
-                                                    **service_props
-                                                )
-                                                continue
-                                        try:
-                                            if layer_props['is_broken']:
-                                                raise RuntimeError(
-                                                    'Layer\'s data source is broken (Layer: {}, Data Source: {})'.format(
-                                                        layer_name,
-                                                        getattr(layer, 'dataSource', 'n/a')
-                                                    )
-                                                )
-                                            for field_props in get_layer_fields(layer):
-                                                field_props['needs_index'] = not field_props['has_index'] and (
-                                                    field_props['in_definition_query'] or
-                                                    field_props['in_label_class_expression'] or
-                                                    field_props['in_label_class_sql_query'] or
-                                                    field_props['field_name'] == layer_props['symbology_field'] or
-                                                    field_props['field_type'] == 'Geometry'
-                                                )
-
-                                                yield dict(chain(
-                                                    service_props.iteritems(),
-                                                    layer_props.iteritems(),
-                                                    field_props.iteritems()
-                                                ))
-                                        except StandardError as e:
-                                            log.exception(
-                                                'An error occurred while listing fields for layer {} in MXD {}'
-                                                .format(layer_name, mxd_path)
-                                            )
-                                            if not warn_on_errors:
-                                                raise
-                                            else:
-                                                yield dict(chain(
-                                                    service_props.iteritems(),
-                                                    layer_props.iteritems()
-                                                ),
-                                                    error='Error retrieving layer fields: {}'.format(e.message)
-                                                )
-                            except StandardError as e:
-                                log.exception(
-                                    'An error occurred while listing layers and fields for '
-                                    '{service_type} service {service_folder}/{service_name} on '
-                                    'ArcGIS Server instance {ags_instance} (Connection File: {ags_connection})'
-                                    .format(**service_props)
+                            continue
+                    try:
+                        if layer_props['is_broken']:
+                            raise RuntimeError(
+                                'Layer\'s data source is broken (Layer: {}, Data Source: {})'.format(
+                                    layer_name,
+                                    getattr(layer, 'dataSource', 'n/a')
                                 )
-                                if not warn_on_errors:
-                                    raise
-                                else:
-                                    yield dict(
-                                        error=e.message,
-                                        **service_props
-                                    )
+                            )
+                        for field_props in get_layer_fields(layer):
+                            field_props['needs_index'] = not field_props['has_index'] and (
+                                field_props['in_definition_query'] or
+                                field_props['in_label_class_expression'] or
+                                field_props['in_label_class_sql_query'] or
+                                field_props['field_name'] == layer_props['symbology_field'] or
+                                field_props['field_type'] == 'Geometry'
+                            )
+
+                            yield dict(chain(
+                                service_props.iteritems(),
+                                layer_props.iteritems(),
+                                field_props.iteritems()
+                            ))
+                    except StandardError as e:
+                        log.exception(
+                            'An error occurred while listing fields for layer {} in MXD {}'
+                            .format(layer_name, mxd_path)
+                        )
+                        if not warn_on_errors:
+                            raise
+                        else:
+                            yield dict(chain(
+                                service_props.iteritems(),
+                                layer_props.iteritems()
+                            ),
+                                error='Error retrieving layer fields: {}'.format(e.message)
+                            )
+        except StandardError as e:
+            log.exception(
+                'An error occurred while listing layers and fields for '
+                '{service_type} service {service_folder}/{service_name} on '
+                'ArcGIS Server instance {ags_instance} (Connection File: {ags_connection})'
+                .format(**service_props)
+            )
+            if not warn_on_errors:
+                raise
+            else:
+                yield dict(
+                    error=e.message,
+                    **service_props
+                )
 
 
 def find_service_dataset_usages(
@@ -343,50 +384,29 @@ def find_service_dataset_usages(
     config_dir=default_config_dir
 ):
     user_config = get_config('userconfig', config_dir)
-    env_names = superfilter(user_config['environments'].keys(), included_envs, excluded_envs)
-    if len(env_names) == 0:
-        raise RuntimeError('No environments specified!')
-    for env_name in env_names:
-        env = user_config['environments'][env_name]
-        ags_instances = superfilter(env['ags_instances'].keys(), included_instances, excluded_instances)
-        log.info('Finding service dataset usages on ArcGIS Server instances {}'.format(', '.join(ags_instances)))
-        for ags_instance in ags_instances:
-            ags_instance_props = env['ags_instances'][ags_instance]
-            server_url = ags_instance_props['url']
-            token = ags_instance_props['token']
-            proxies = ags_instance_props.get('proxies') or user_config.get('proxies')
-            with create_session(server_url, proxies=proxies) as session:
-                service_folders = list_service_folders(server_url, token, session=session)
-                for service_folder in superfilter(service_folders, included_service_folders, excluded_service_folders):
-                    for service in list_services(server_url, token, service_folder, session=session):
-                        service_name = service['serviceName']
-                        service_type = service['type']
-                        service_props = dict(
-                            env_name=env_name,
-                            ags_instance=ags_instance,
-                            service_folder=service_folder,
-                            service_name=service_name,
-                            service_type=service_type
-                        )
-                        if superfilter((service_name,), included_services, excluded_services):
-                            for dataset_props in list_service_workspaces(
-                                server_url,
-                                token,
-                                service_name,
-                                service_folder,
-                                service_type,
-                                session=session
-                            ):
-                                if (
-                                    superfilter((dataset_props['dataset_name'],), included_datasets, excluded_datasets) and
-                                    superfilter((dataset_props['user'],), included_users, excluded_users) and
-                                    superfilter((dataset_props['database'],), included_databases, excluded_databases) and
-                                    superfilter((dataset_props['version'],), included_versions, excluded_versions)
-                                ):
-                                    yield dict(chain(
-                                        service_props.iteritems(),
-                                        dataset_props.iteritems()
-                                    ))
+    log.info('Finding service dataset usages')
+    for service_props, ags_instance_props, client in crawl_services(
+        user_config,
+        included_services, excluded_services,
+        included_service_folders, excluded_service_folders,
+        included_instances, excluded_instances,
+        included_envs, excluded_envs
+    ):
+        for dataset_props in client.list_service_workspaces(
+            service_props['service_name'],
+            service_props['service_folder'],
+            service_props['service_type']
+        ):
+            if (
+                superfilter((dataset_props['dataset_name'],), included_datasets, excluded_datasets) and
+                superfilter((dataset_props['user'],), included_users, excluded_users) and
+                superfilter((dataset_props['database'],), included_databases, excluded_databases) and
+                superfilter((dataset_props['version'],), included_versions, excluded_versions)
+            ):
+                yield dict(chain(
+                    service_props.iteritems(),
+                    dataset_props.iteritems()
+                ))
 
 
 def restart_services(
@@ -398,39 +418,46 @@ def restart_services(
     delay=30,
     max_retries=3,
     test_after_restart=True,
+    max_concurrent_restarts=default_max_concurrent_restarts,
+    max_services_down=default_max_services_down,
     config_dir=default_config_dir
 ):
     user_config = get_config('userconfig', config_dir)
-    env_names = superfilter(user_config['environments'].keys(), included_envs, excluded_envs)
-    if len(env_names) == 0:
-        raise RuntimeError('No environments specified!')
-    for env_name in env_names:
-        env = user_config['environments'][env_name]
-        ags_instances = superfilter(env['ags_instances'].keys(), included_instances, excluded_instances)
-        log.info('Restarting services on ArcGIS Server instances {}'.format(', '.join(ags_instances)))
-        for ags_instance in ags_instances:
-            ags_instance_props = env['ags_instances'][ags_instance]
-            server_url = ags_instance_props['url']
-            token = ags_instance_props['token']
-            proxies = ags_instance_props.get('proxies') or user_config.get('proxies')
-            with create_session(server_url, proxies=proxies) as session:
-                service_folders = list_service_folders(server_url, token, session=session)
-                for service_folder in superfilter(service_folders, included_service_folders, excluded_service_folders):
-                    for service in list_services(server_url, token, service_folder, session=session):
-                        service_name = service['serviceName']
-                        service_type = service['type']
-                        if superfilter((service_name,), included_services, excluded_services):
-                            if not include_running_services:
-                                status = get_service_status(server_url, token, service_name, service_folder, service_type, session=session)
-                                configured_state = status.get('configuredState')
-                                if configured_state == 'STARTED':
-                                    log.debug(
-                                        'Skipping restart of service {}/{} ({}) because its configured state is {} and include_running_services is {}'
-                                        .format(service_folder, service_name, service_type, configured_state, include_running_services)
-                                    )
-                                    continue
-                                restart_service(server_url, token, service_name, service_folder, service_type, delay, max_retries, test_after_restart, session=session)
-                            restart_service(server_url, token, service_name, service_folder, service_type, delay, max_retries, test_after_restart, session=session)
+    log.info('Restarting services')
+    services_to_restart = []
+    current_client = None
+    for service_props, ags_instance_props, client in crawl_services(
+        user_config,
+        included_services, excluded_services,
+        included_service_folders, excluded_service_folders,
+        included_instances, excluded_instances,
+        included_envs, excluded_envs
+    ):
+        service_folder = service_props['service_folder']
+        service_name = service_props['service_name']
+        service_type = service_props['service_type']
+        if client is not current_client:
+            # Restart each instance's services once all of them have been crawled
+            if services_to_restart:
+                current_client.restart_services(
+                    services_to_restart, delay, max_retries, test_after_restart, max_concurrent_restarts, max_services_down
+                )
+            services_to_restart = []
+            current_client = client
+        if not include_running_services:
+            status = client.get_cached_service_status(service_name, service_folder, service_type)
+            configured_state = status.get('configuredState')
+            if configured_state == 'STARTED':
+                log.debug(
+                    'Skipping restart of service {}/{} ({}) because its configured state is {} and include_running_services is {}'
+                    .format(service_folder, service_name, service_type, configured_state, include_running_services)
+                )
+                continue
+        services_to_restart.append((service_name, service_folder, service_type))
+    if services_to_restart:
+        current_client.restart_services(
+            services_to_restart, delay, max_retries, test_after_restart, max_concurrent_restarts, max_services_down
+        )
 
 
 def test_services(
@@ -442,34 +469,25 @@ def test_services(
     config_dir=default_config_dir
 ):
     user_config = get_config('userconfig', config_dir)
-    env_names = superfilter(user_config['environments'].keys(), included_envs, excluded_envs)
-    if len(env_names) == 0:
-        raise RuntimeError('No environments specified!')
-    for env_name in env_names:
-        env = user_config['environments'][env_name]
-        ags_instances = superfilter(env['ags_instances'].keys(), included_instances, excluded_instances)
-        log.info('Testing services on ArcGIS Server instances {}'.format(', '.join(ags_instances)))
-        for ags_instance in ags_instances:
-            ags_instance_props = env['ags_instances'][ags_instance]
-            server_url = ags_instance_props['url']
-            token = ags_instance_props['token']
-            proxies = ags_instance_props.get('proxies') or user_config.get('proxies')
-            with create_session(server_url, proxies=proxies) as session:
-                service_folders = list_service_folders(server_url, token, session=session)
-                for service_folder in superfilter(service_folders, included_service_folders, excluded_service_folders):
-                    for service in list_services(server_url, token, service_folder, session=session):
-                        service_name = service['serviceName']
-                        service_type = service['type']
-                        if superfilter((service_name,), included_services, excluded_services):
-                            test_data = test_service(server_url, token, service_name, service_folder, service_type, warn_on_errors, session=session)
-                            yield dict(
-                                env_name=env_name,
-                                ags_instance=ags_instance,
-                                service_folder=service_folder,
-                                service_name=service_name,
-                                service_type=service_type,
-                                **test_data
-                            )
+    log.info('Testing services')
+    for service_props, ags_instance_props, client in crawl_services(
+        user_config,
+        included_services, excluded_services,
+        included_service_folders, excluded_service_folders,
+        included_instances, excluded_instances,
+        included_envs, excluded_envs
+    ):
+        test_data = client.test_service(
+            service_props['service_name'],
+            service_props['service_folder'],
+            service_props['service_type'],
+            warn_on_errors,
+            use_cached_status=True
+        )
+        yield dict(
+            service_props,
+            **test_data
+        )
 
 
 def normalize_services(services, default_service_properties=None, env_service_properties=None):
@@ -503,12 +521,23 @@ def normalize_service(service, default_service_properties=None, env_service_prop
     return service_name, service_type, merged_service_properties
 
 
-def get_source_info(services, source_dir, staging_dir, default_service_properties, env_service_properties):
-    log.debug(
-        'Getting source info for services {}, source directory: {}, staging directory {}'
-        .format(services, source_dir, staging_dir)
-    )
-
+def get_source_info(
+    services,
+    source_dir,
+    staging_dir,
+    default_service_properties,
+    env_service_properties,
+    directory_index=None
+):
+    # Each source and staging directory is listed once into directory_index (a DirectoryIndex, which may be shared
+    # between calls that look in the same directories) rather than checking for each service's files one by one
+    log.debug(LazyFormat(
+        'Getting source info for services {}, source directory: {}, staging directory {}',
+        LazyJson(services), source_dir, staging_dir
+    ))
+
+    if directory_index is None:
+        directory_index = DirectoryIndex()
     source_info = {}
     errors = []
 
@@ -532,17 +561,21 @@ def get_source_info(services, source_dir, staging_dir, default_service_propertie
             for _staging_dir in staging_dirs:
                 log.debug('Finding staging items in directory: {}'.format(_staging_dir))
                 if service_type == 'MapServer':
-                    staging_file = os.path.abspath(os.path.join(_staging_dir, service_name + '.mxd'))
+                    staging_file_name = service_name + '.mxd'
                 elif service_type == 'GeocodeServer':
-                    staging_file = os.path.abspath(os.path.join(_staging_dir, service_name + '.loc'))
+                    staging_file_name = service_name + '.loc'
                 else:
                     log.debug('Unsupported service type {} of service {} will be skipped'.format(service_type, service_name))
 
-                if os.path.isfile(staging_file):
+                staging_file = directory_index.find_file(_staging_dir, staging_file_name)
+                if staging_file:
                     log.debug('Staging file found: {}'.format(staging_file))
                     staging_files.append(staging_file)
                 else:
-                    log.debug('Staging file missing: {}'.format(staging_file))
+                    log.debug(
+                        'Staging file missing: {}'
+                        .format(os.path.abspath(os.path.join(_staging_dir, staging_file_name)))
+                    )
 
             if len(staging_files) == 0:
                 errors.append('- No staging file found for service {}'.format(service_name))
@@ -558,15 +591,17 @@ def get_source_info(services, source_dir, staging_dir, default_service_propertie
         if source_dir:
             log.debug('Finding source files in directory: {}'.format(source_dir))
             if service_type == 'MapServer':
-                source_file = os.path.abspath(os.path.join(source_dir, service_name + '.mxd'))
+                source_file_name = service_name + '.mxd'
             elif service_type == 'GeocodeServer':
-                source_file = os.path.abspath(os.path.join(source_dir, service_name + '.loc'))
+                source_file_name = service_name + '.loc'
             else:
                 log.debug('Unsupported service type {} of service {} will be skipped'.format(service_type, service_name))
-            if os.path.isfile(source_file):
+            source_file = directory_index.find_file(source_dir, source_file_name)
+            if source_file:
                 log.debug('Source file found: {}'.format(source_file))
                 service_info['source_file'] = source_file
             else:
+                source_file = os.path.abspath(os.path.join(source_dir, source_file_name))
                 log.debug('Source file missing: {}'.format(source_file))
                 errors.append('- Source file {} for service {} does not exist!'.format(source_file, service_name))
 
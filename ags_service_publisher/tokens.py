@@ -0,0 +1,203 @@
+from __future__ import unicode_literals
+
+import json
+import os
+import threading
+import time
+
+from ags_utils import AgsAdminClient
+from config_io import default_config_dir
+from logging_io import setup_logger
+
+log = setup_logger(__name__)
+
+token_cache_file_name = 'tokencache.json'
+default_token_cache_file = os.path.join(default_config_dir, token_cache_file_name)
+default_renewal_margin = 120
+default_retry_interval = 30
+default_expiry_warning_margin = 3600
+
+
+class TokenManager(object):
+    """Keeps track of the tokens (and their expiration times) of each ArcGIS Server instance, both in memory and in an
+    on-disk cache.
+    If the credentials used to generate an instance's token have been registered, the token is renewed in a background
+    thread renewal_margin seconds before it expires, and is also renewed on demand if it is found to have expired or is
+    rejected by the server. Credentials are only ever kept in memory, so a job run in a process of its own (e.g. a
+    scheduled job) cannot renew tokens unless generate_tokens is run in that process first; warn_of_expiring_tokens
+    warns about the tokens that such a job would not be able to renew.
+    Tokens are generated without holding the lock that guards the tokens, so renewing the token of one instance never
+    holds up getting the tokens of others; only one thread renews any one instance's token at a time."""
+
+    def __init__(self, cache_file=default_token_cache_file, renewal_margin=default_renewal_margin):
+        self.cache_file = cache_file
+        self.renewal_margin = renewal_margin
+        self.tokens = {}
+        self.credentials = {}
+        self.renewal_locks = {}
+        self.lock = threading.RLock()
+        self.wake_event = threading.Event()
+        self.renewal_thread = None
+        self.load_cache()
+
+    def set_cache_file(self, cache_file):
+        with self.lock:
+            if cache_file != self.cache_file:
+                self.cache_file = cache_file
+                self.tokens = {}
+                self.load_cache()
+
+    def load_cache(self):
+        if not os.path.isfile(self.cache_file):
+            return
+        log.debug('Loading token cache from file: {}'.format(self.cache_file))
+        try:
+            with open(self.cache_file, 'rb') as f:
+                cached_tokens = json.load(f)
+        except (IOError, ValueError):
+            log.warn('Unable to read token cache file {}, ignoring'.format(self.cache_file), exc_info=True)
+            return
+        # Expired tokens are loaded too (though never returned by get_token), so that they can be warned about
+        with self.lock:
+            for ags_instance, token_info in cached_tokens.iteritems():
+                self.tokens.setdefault(ags_instance, token_info)
+
+    def save_cache(self):
+        with self.lock:
+            cached_tokens = {
+                ags_instance: token_info
+                for ags_instance, token_info in self.tokens.iteritems()
+                if not self.is_expired(token_info)
+            }
+            log.debug('Writing token cache to file: {}'.format(self.cache_file))
+            try:
+                with open(self.cache_file, 'wb') as f:
+                    json.dump(cached_tokens, f, indent=4)
+            except IOError:
+                log.warn('Unable to write token cache file {}'.format(self.cache_file), exc_info=True)
+
+    @staticmethod
+    def is_expired(token_info, margin=0):
+        expires = token_info.get('expires')
+        return expires is not None and expires / 1000.0 - margin <= time.time()
+
+    def set_token(self, ags_instance, token, expires=None):
+        with self.lock:
+            self.tokens[ags_instance] = dict(token=token, expires=expires)
+            self.save_cache()
+        self.wake_event.set()
+
+    def get_token(self, ags_instance, default=None):
+        with self.lock:
+            token_info = self.tokens.get(ags_instance)
+            if token_info and not self.is_expired(token_info):
+                return token_info['token']
+            if ags_instance not in self.credentials:
+                return default
+        return self.renew_token(ags_instance)
+
+    def register_credentials(self, ags_instance, server_url, username, password, expiration=15, proxies=None):
+        with self.lock:
+            self.credentials[ags_instance] = dict(
+                server_url=server_url,
+                username=username,
+                password=password,
+                expiration=expiration,
+                proxies=proxies
+            )
+            if not self.renewal_thread:
+                self.renewal_thread = threading.Thread(target=self.renew_tokens_in_background, name='TokenRenewal')
+                self.renewal_thread.daemon = True
+                self.renewal_thread.start()
+        self.wake_event.set()
+
+    def can_renew(self, ags_instance):
+        return ags_instance in self.credentials
+
+    def warn_of_expiring_tokens(self, ags_instances, margin=default_expiry_warning_margin):
+        # Warns about the token of each instance that has expired or expires within margin seconds but cannot be
+        # renewed, as no credentials have been registered for the instance in this process
+        with self.lock:
+            for ags_instance in ags_instances:
+                token_info = self.tokens.get(ags_instance)
+                if ags_instance in self.credentials or not token_info or token_info.get('expires') is None:
+                    continue
+                remaining_time = token_info['expires'] / 1000.0 - time.time()
+                if remaining_time >= margin:
+                    continue
+                log.warn(
+                    'The token for ArcGIS Server instance {} {} and cannot be renewed, as no credentials have been '
+                    'registered in this process, so requests to the instance will fail from then on. Run '
+                    'Runner.generate_tokens(reuse_credentials=True) first, in the same process as the job, to have it '
+                    'renewed automatically.'
+                    .format(
+                        ags_instance,
+                        'has expired' if remaining_time <= 0 else 'expires in {:.0f} minutes (at {})'.format(
+                            remaining_time / 60,
+                            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(token_info['expires'] / 1000.0))
+                        )
+                    )
+                )
+
+    def renew_token(self, ags_instance):
+        with self.lock:
+            credentials = self.credentials[ags_instance]
+            renewal_lock = self.renewal_locks.setdefault(ags_instance, threading.Lock())
+            stale_token_info = self.tokens.get(ags_instance)
+        with renewal_lock:
+            # If another thread renewed the token while this one was waiting, use the token it renewed
+            with self.lock:
+                token_info = self.tokens.get(ags_instance)
+                if token_info is not stale_token_info and token_info and not self.is_expired(token_info):
+                    return token_info['token']
+            log.debug('Renewing token for ArcGIS Server instance {}'.format(ags_instance))
+            with AgsAdminClient(
+                credentials['server_url'],
+                proxies=credentials['proxies'],
+                ags_instance=ags_instance
+            ) as client:
+                token = client.generate_token(credentials['username'], credentials['password'], credentials['expiration'])
+                expires = client.token_expires
+            self.set_token(ags_instance, token, expires)
+            return token
+
+    def renew_tokens_in_background(self):
+        while True:
+            self.wake_event.clear()
+            next_renewal = None
+            due_instances = []
+            with self.lock:
+                for ags_instance in self.credentials.keys():
+                    token_info = self.tokens.get(ags_instance)
+                    if not token_info or token_info.get('expires') is None:
+                        continue
+                    if self.is_expired(token_info, self.renewal_margin):
+                        due_instances.append(ags_instance)
+                        continue
+                    renewal_time = token_info['expires'] / 1000.0 - self.renewal_margin
+                    if next_renewal is None or renewal_time < next_renewal:
+                        next_renewal = renewal_time
+            # Tokens are renewed outside the lock, so that getting tokens is not held up by the requests
+            for ags_instance in due_instances:
+                try:
+                    self.renew_token(ags_instance)
+                    with self.lock:
+                        expires = self.tokens[ags_instance].get('expires')
+                    if expires is None:
+                        continue
+                    renewal_time = expires / 1000.0 - self.renewal_margin
+                except StandardError:
+                    log.warn(
+                        'An error occurred while renewing the token for ArcGIS Server instance {}, '
+                        'retrying in {} seconds'
+                        .format(ags_instance, default_retry_interval),
+                        exc_info=True
+                    )
+                    renewal_time = time.time() + default_retry_interval
+                if next_renewal is None or renewal_time < next_renewal:
+                    next_renewal = renewal_time
+            timeout = max(1, next_renewal - time.time()) if next_renewal is not None else None
+            self.wake_event.wait(timeout)
+
+
+token_manager = TokenManager()
@@ -0,0 +1,230 @@
+from __future__ import unicode_literals
+
+import itertools
+import multiprocessing
+import os
+import threading
+import traceback
+from Queue import Empty
+
+from logging_io import setup_logger
+from mplog import get_lowest_handler_level, setup_queue_logging, start_log_daemon
+
+log = setup_logger(__name__)
+
+default_preload_modules = ('arcpy',)
+
+thread_task_ids = itertools.count()
+
+
+class WorkerTask(object):
+    def __init__(self, task_id, func, args):
+        self.task_id = task_id
+        self.func = func
+        self.args = args
+        self.result = None
+        self.finished = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def set_result(self, result):
+        with self.lock:
+            self.result = result
+            self.finished.set()
+            callbacks = self.callbacks
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        # Calls callback with the task once it has finished (or right away if it already has)
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def get(self):
+        # Wait with a timeout so that the wait can be interrupted with Ctrl+C under Python 2
+        while not self.finished.wait(1):
+            pass
+        return self.result
+
+
+class WorkerPool(object):
+    """Pool of long-lived worker processes for running arcpy tasks (e.g. publishing services or updating data
+    sources), so that each worker only pays the cost of starting up and importing arcpy once per batch job rather than
+    once per task.
+    Workers log through an mplog queue, as with logged_call, but only send the records that a handler of this process
+    would emit as of when the task was submitted (e.g. debug records only while a debug log file is open). Each task's
+    result is a dict with the keys succeeded, value (the return value of the task's function), error (the error message
+    if it failed) and pid. A worker that exits unexpectedly (e.g. if arcpy crashes) fails its current task and is
+    replaced with a new one.
+    May be used as a context manager, in which case the workers are stopped on exit."""
+
+    def __init__(self, processes, preload_modules=default_preload_modules):
+        self.processes = max(1, processes)
+        self.preload_modules = preload_modules
+        self.log_queue = multiprocessing.Queue()
+        self.log_level = multiprocessing.Value('i', get_lowest_handler_level())
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.task_ids = itertools.count()
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+        start_log_daemon(self.log_queue)
+        log.debug('Starting {} worker processes'.format(self.processes))
+        self.workers = [self.start_worker() for _ in range(self.processes)]
+        self.result_thread = threading.Thread(target=self.handle_results, name='WorkerPoolResults')
+        self.result_thread.daemon = True
+        self.result_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start_worker(self):
+        # Shared with the worker (rather than reported through the result queue) so that the task a worker was running
+        # is still known if the worker exits abruptly
+        current_task_id = multiprocessing.Value('l', -1)
+        worker = multiprocessing.Process(
+            target=run_worker,
+            args=(
+                self.log_queue,
+                self.task_queue,
+                self.result_queue,
+                current_task_id,
+                self.preload_modules,
+                self.log_level
+            )
+        )
+        worker.current_task_id = current_task_id
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def submit(self, func, *args):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('Worker pool is closed!')
+            task = WorkerTask(next(self.task_ids), func, args)
+            self.tasks[task.task_id] = task
+        # Handlers may have been added or removed since the last task (e.g. a log file for each configuration file)
+        self.log_level.value = get_lowest_handler_level()
+        self.task_queue.put((task.task_id, func, args))
+        return task
+
+    def run(self, func, *args):
+        return self.submit(func, *args).get()
+
+    def handle_results(self):
+        while True:
+            try:
+                message = self.result_queue.get(timeout=1)
+            except Empty:
+                message = None
+            with self.lock:
+                if message:
+                    self.handle_result(message)
+                else:
+                    self.check_workers()
+                if self.closed and not self.tasks:
+                    break
+
+    def handle_result(self, message):
+        task_id, result = message
+        task = self.tasks.pop(task_id, None)
+        if task is not None:
+            task.set_result(result)
+
+    def fail_task(self, task, error, pid=None):
+        del self.tasks[task.task_id]
+        task.set_result(dict(succeeded=False, value=None, error=error, pid=pid))
+
+    def check_workers(self):
+        dead_workers = [(i, worker) for i, worker in enumerate(self.workers) if not worker.is_alive()]
+        if not dead_workers:
+            return
+        # Pick up anything the workers managed to report before they exited
+        while True:
+            try:
+                self.handle_result(self.result_queue.get_nowait())
+            except Empty:
+                break
+        for i, worker in dead_workers:
+            task = self.tasks.get(worker.current_task_id.value)
+            if task is not None:
+                self.fail_task(
+                    task,
+                    'Worker process {} (pid {}, exitcode {}) exited unexpectedly while running {}'
+                    .format(worker.name, worker.pid, worker.exitcode, task.func.__name__),
+                    worker.pid
+                )
+            if not self.closed:
+                log.warn(
+                    'Worker process {} (pid {}) exited unexpectedly with exitcode {}, starting a new one'
+                    .format(worker.name, worker.pid, worker.exitcode)
+                )
+                self.workers[i] = self.start_worker()
+        if self.closed and len(dead_workers) == len(self.workers):
+            for task in self.tasks.values():
+                self.fail_task(task, 'Worker pool was closed before running {}'.format(task.func.__name__))
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        log.debug('Stopping {} worker processes'.format(len(self.workers)))
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.result_thread.join()
+        self.log_queue.put(None)
+
+
+def run_worker(
+    log_queue,
+    task_queue,
+    result_queue,
+    current_task_id,
+    preload_modules=default_preload_modules,
+    log_level=None
+):
+    setup_queue_logging(log_queue, log_level)
+    for module_name in preload_modules:
+        try:
+            __import__(module_name)
+        except ImportError:
+            log.warn('Unable to preload module {} in worker process (pid {})'.format(module_name, os.getpid()))
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        task_id, func, args = task
+        current_task_id.value = task_id
+        result_queue.put((task_id, run_task(func, args)))
+        current_task_id.value = -1
+
+
+def run_task(func, args):
+    try:
+        return dict(succeeded=True, value=func(*args), error=None, pid=os.getpid())
+    # arcpy errors do not all derive from StandardError
+    except Exception as e:
+        log.debug(traceback.format_exc())
+        return dict(succeeded=False, value=None, error='{}: {}'.format(type(e).__name__, e), pid=os.getpid())
+
+
+def run_in_thread(func, *args):
+    # Runs a task that does not need a worker process (e.g. one that only makes requests) in a thread of this process
+    # instead, returning a WorkerTask with the same kind of result as a WorkerPool task
+    task = WorkerTask('thread-{}'.format(next(thread_task_ids)), func, args)
+    thread = threading.Thread(target=lambda: task.set_result(run_task(func, args)), name='WorkerTask-{}'.format(task.task_id))
+    thread.daemon = True
+    thread.start()
+    return task
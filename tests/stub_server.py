@@ -0,0 +1,77 @@
+from __future__ import unicode_literals
+
+import cgi
+import json
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        form = {key: values[-1] for key, values in urlparse.parse_qs(url.query).iteritems()}
+        files = {}
+        content_type = self.headers.getheader('content-type') or ''
+        if content_type.startswith('multipart/form-data'):
+            fields = cgi.FieldStorage(
+                fp=self.rfile,
+                headers=self.headers,
+                environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': content_type}
+            )
+            for field in fields.list or ():
+                if field.filename is not None:
+                    files[field.name] = field.value
+                else:
+                    form[field.name] = field.value
+        else:
+            body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+            form.update((key, values[-1]) for key, values in urlparse.parse_qs(body).iteritems())
+        path = url.path.strip('/').split('/')
+        with self.server.lock:
+            self.server.requests.append((path, form))
+        response = json.dumps(self.server.handle(path, form, files))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for an ArcGIS Server instance, serving JSON responses from a handler function so that client code
+    can be tested offline. The handler is called with the path of each request (as a list of its parts), its form
+    fields (including any query string parameters) and any uploaded files (as a dict mapping each field name to its
+    contents), and returns the response as a dict. Every request's path and form fields are recorded in requests.
+    May be used as a context manager, in which case the server is closed on exit."""
+
+    daemon_threads = True
+
+    def __init__(self, handle):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubRequestHandler)
+        self.handle = handle
+        self.requests = []
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+    def get_requests(self, operation):
+        # Returns the form fields of every request made to an operation (the last part of its path)
+        with self.lock:
+            return [form for path, form in self.requests if path[-1] == operation]
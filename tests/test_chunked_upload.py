@@ -0,0 +1,109 @@
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ags_service_publisher.ags_utils import AgsAdminClient
+from stub_server import StubServer
+
+part_size = 1024
+num_parts = 5
+
+
+class StubUploadsHandler(object):
+    # Serves the operations of the Administrator API's uploads resource as documented by Esri, rejecting parts that are
+    # not sent in the file and partId fields
+    def __init__(self):
+        self.items = {}
+        self.failing_parts = set()
+
+    def __call__(self, path, form, files):
+        if path[-2:] == ['uploads', 'register']:
+            item_id = 'i{}'.format(len(self.items))
+            self.items[item_id] = dict(parts={}, data=None)
+            return dict(status='success', item=dict(itemID=item_id, itemName=form['itemName'], committed=False))
+        item_id, operation = path[-2:]
+        item = self.items.get(item_id)
+        if item is None:
+            return dict(status='error', messages=['Item {} not found'.format(item_id)])
+        if operation == 'parts':
+            return dict(itemID=item_id, parts=sorted(item['parts']))
+        if operation == 'uploadPart':
+            if 'file' not in files or 'partId' not in form:
+                return dict(status='error', messages=['Missing file or partId'])
+            if int(form['partId']) in self.failing_parts:
+                return dict(status='error', messages=['Failed to upload part {}'.format(form['partId'])])
+            item['parts'][form['partId']] = files['file']
+            return dict(status='success', item=dict(itemID=item_id, committed=False))
+        if operation == 'commit':
+            item['data'] = b''.join(item['parts'][part_id] for part_id in form['parts'].split(','))
+            return dict(status='success', item=dict(itemID=item_id, committed=True))
+        return dict(status='error', messages=['Unsupported operation {}'.format(operation)])
+
+
+class ChunkedUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.temp_dir, 'Service.sd')
+        with open(self.file_path, 'wb') as f:
+            f.write(os.urandom(part_size * (num_parts - 1) + 7))
+        self.resume_file = self.file_path + '.upload.json'
+        self.handler = StubUploadsHandler()
+        self.server = StubServer(self.handler)
+        self.client = AgsAdminClient(self.server.url, 'token', max_retries=0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def read_file(self):
+        with open(self.file_path, 'rb') as f:
+            return f.read()
+
+    def test_upload_commits_all_parts_in_order(self):
+        upload_stats = self.client.upload_file(self.file_path, part_size, resume_file=self.resume_file)
+        self.assertEqual(upload_stats['parts'], num_parts)
+        self.assertEqual(upload_stats['resumed_parts'], 0)
+        self.assertEqual(len(self.server.get_requests('uploadPart')), num_parts)
+        self.assertEqual(self.server.get_requests('commit')[-1]['parts'], '1,2,3,4,5')
+        self.assertEqual(self.handler.items[upload_stats['item_id']]['data'], self.read_file())
+        self.assertFalse(os.path.exists(self.resume_file))
+
+    def test_failed_upload_resumes_from_uploaded_parts(self):
+        self.handler.failing_parts.add(3)
+        with self.assertRaises(RuntimeError):
+            self.client.upload_file(self.file_path, part_size, max_retries=1, resume_file=self.resume_file)
+        with open(self.resume_file, 'rb') as f:
+            self.assertEqual(json.load(f)['uploaded_parts'], [1, 2, 4, 5])
+        self.assertEqual(self.server.get_requests('commit'), [])
+
+        self.handler.failing_parts.clear()
+        del self.server.requests[:]
+        upload_stats = self.client.upload_file(self.file_path, part_size, max_retries=1, resume_file=self.resume_file)
+        self.assertEqual(upload_stats['item_id'], 'i0')
+        self.assertEqual(upload_stats['resumed_parts'], num_parts - 1)
+        self.assertEqual(self.server.get_requests('register'), [])
+        self.assertEqual(len(self.server.get_requests('parts')), 1)
+        self.assertEqual([form['partId'] for form in self.server.get_requests('uploadPart')], ['3'])
+        self.assertEqual(self.handler.items['i0']['data'], self.read_file())
+        self.assertFalse(os.path.exists(self.resume_file))
+
+    def test_changed_file_starts_a_new_upload(self):
+        self.handler.failing_parts.add(3)
+        with self.assertRaises(RuntimeError):
+            self.client.upload_file(self.file_path, part_size, resume_file=self.resume_file)
+        self.handler.failing_parts.clear()
+        with open(self.file_path, 'ab') as f:
+            f.write(b'changed')
+        upload_stats = self.client.upload_file(self.file_path, part_size, resume_file=self.resume_file)
+        self.assertEqual(upload_stats['item_id'], 'i1')
+        self.assertEqual(upload_stats['resumed_parts'], 0)
+        self.assertEqual(self.handler.items['i1']['data'], self.read_file())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ags_service_publisher.publishing import prepare_service
+from ags_service_publisher.publishing_state import publishing_state
+
+
+class FakeWorkerPool(object):
+    # Stands in for a WorkerPool, "rebuilding" locators by appending to them rather than running arcpy
+    def __init__(self):
+        self.rebuilt_locators = []
+
+    def run(self, func, locator_path):
+        self.rebuilt_locators.append(locator_path)
+        with open(locator_path + '.loc', 'ab') as f:
+            f.write(b'-rebuilt')
+        return dict(succeeded=True, value=None, error=None, pid=os.getpid())
+
+
+class LocatorRebuildTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.temp_dir, 'source')
+        self.staging_dir = os.path.join(self.temp_dir, 'staging')
+        self.reference_data_dir = os.path.join(self.temp_dir, 'reference')
+        for directory in (self.source_dir, self.staging_dir, self.reference_data_dir):
+            os.makedirs(directory)
+        self.write_file(os.path.join(self.staging_dir, 'Locator.loc'), b'locator')
+        self.write_file(os.path.join(self.staging_dir, 'Locator.loc.xml'), b'<locator/>')
+        self.write_file(os.path.join(self.reference_data_dir, 'streets.shp'), b'streets')
+        self.original_state_file = publishing_state.state_file
+        publishing_state.set_state_file(os.path.join(self.temp_dir, 'publishingstate.json'))
+        self.source_locator_path = os.path.join(self.source_dir, 'Locator.loc')
+        self.worker_pool = FakeWorkerPool()
+
+    def tearDown(self):
+        publishing_state.set_state_file(self.original_state_file)
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    @staticmethod
+    def write_file(file_path, contents):
+        with open(file_path, 'wb') as f:
+            f.write(contents)
+
+    def prepare(self):
+        prepare_service(
+            'Locator',
+            'GeocodeServer',
+            dict(
+                source_file=self.source_locator_path,
+                staging_files=[os.path.join(self.staging_dir, 'Locator.loc')]
+            ),
+            self.source_dir,
+            self.staging_dir,
+            {},
+            copy_source_files_from_staging_folder=True,
+            create_backups=False,
+            worker_pool=self.worker_pool,
+            service_properties=dict(rebuild_locators=True, locator_reference_data=[self.reference_data_dir])
+        )
+        with open(self.source_locator_path, 'rb') as f:
+            return f.read()
+
+    def test_second_prepare_from_staging_skips_rebuild(self):
+        self.assertEqual(self.prepare(), b'locator-rebuilt')
+        self.assertEqual(self.prepare(), b'locator-rebuilt')
+        self.assertEqual(len(self.worker_pool.rebuilt_locators), 1)
+
+    def test_changed_staging_locator_is_rebuilt(self):
+        self.prepare()
+        self.write_file(os.path.join(self.staging_dir, 'Locator.loc'), b'locator2')
+        self.assertEqual(self.prepare(), b'locator2-rebuilt')
+        self.assertEqual(len(self.worker_pool.rebuilt_locators), 2)
+
+    def test_changed_reference_data_is_rebuilt(self):
+        self.prepare()
+        self.write_file(os.path.join(self.reference_data_dir, 'streets.shp'), b'more streets')
+        self.prepare()
+        self.assertEqual(len(self.worker_pool.rebuilt_locators), 2)
+
+    def test_overwritten_source_locator_is_synced_and_rebuilt(self):
+        self.prepare()
+        self.write_file(self.source_locator_path, b'unbuilt')
+        self.assertEqual(self.prepare(), b'locator-rebuilt')
+        self.assertEqual(len(self.worker_pool.rebuilt_locators), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
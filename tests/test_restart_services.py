@@ -0,0 +1,45 @@
+from __future__ import unicode_literals
+
+import threading
+import time
+import unittest
+
+from ags_service_publisher.ags_utils import AgsAdminClient
+
+
+class RestartServicesTest(unittest.TestCase):
+    def setUp(self):
+        self.client = AgsAdminClient('http://localhost', 'token')
+        self.lock = threading.Lock()
+        self.services_down = 0
+        self.max_services_down = 0
+        self.restarted_services = []
+        self.client.restart_service_batch = self.restart_service_batch
+
+    def tearDown(self):
+        self.client.close()
+
+    def restart_service_batch(self, services, delay=30, max_retries=3, test_after_restart=True):
+        # Stands in for stopping and starting the services, tracking how many are down at once
+        with self.lock:
+            self.services_down += len(services)
+            self.max_services_down = max(self.max_services_down, self.services_down)
+        time.sleep(0.01)
+        with self.lock:
+            self.services_down -= len(services)
+            self.restarted_services.extend(services)
+        return []
+
+    def test_services_down_are_limited_across_folders(self):
+        services = [
+            ('Service{}'.format(i), 'Folder{}'.format(j), 'MapServer')
+            for i in range(7)
+            for j in range(4)
+        ]
+        self.client.restart_services(services, max_concurrent_restarts=4, max_services_down=10)
+        self.assertLessEqual(self.max_services_down, 10)
+        self.assertEqual(sorted(self.restarted_services), sorted(services))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+from __future__ import unicode_literals
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from ags_service_publisher.backup_store import get_backup_store
+from ags_service_publisher.config_io import set_config
+from ags_service_publisher.runner import Runner
+
+
+class RestoreBackupTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.config_dir = os.path.join(self.temp_dir, 'config')
+        self.source_dir = os.path.join(self.temp_dir, 'source')
+        os.makedirs(self.config_dir)
+        os.makedirs(self.source_dir)
+        set_config(
+            dict(services=['Service'], environments=dict(dev=dict(ags_instances=['dev1'], source_dir=self.source_dir))),
+            'Config',
+            self.config_dir
+        )
+        self.source_path = os.path.join(self.source_dir, 'Service.mxd')
+        backup_store = get_backup_store(self.source_dir)
+        for i, contents in enumerate((b'first', b'second')):
+            with open(self.source_path, 'wb') as f:
+                f.write(contents)
+            backup_store.backup('Service', (self.source_path,), datetime.datetime(2017, 6, 1, 9, 30, i))
+        self.runner = Runner(quiet=True, log_to_file=False, config_dir=self.config_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    @staticmethod
+    def read_file(file_path):
+        with open(file_path, 'rb') as f:
+            return f.read()
+
+    def test_list_backups(self):
+        self.assertEqual(
+            self.runner.list_backups('Config', 'Service', 'dev'),
+            ['2017-06-01T09:30:00', '2017-06-01T09:30:01']
+        )
+
+    def test_restore_latest_backup(self):
+        restored_files = self.runner.restore_backup('Config', 'Service', 'dev')
+        self.assertEqual(
+            restored_files,
+            [os.path.join(self.source_dir, 'Backup', 'Restored', 'Service_20170601-093001', 'Service.mxd')]
+        )
+        self.assertEqual(self.read_file(restored_files[0]), b'second')
+
+    def test_restore_superseded_backup(self):
+        # Superseded backups are compressed, but are restored as they were
+        restored_files = self.runner.restore_backup('Config', 'Service', 'dev', '2017-06-01T09:30:00')
+        self.assertEqual(os.path.basename(os.path.dirname(restored_files[0])), 'Service_20170601-093000')
+        self.assertEqual(self.read_file(restored_files[0]), b'first')
+        self.assertEqual(self.read_file(self.source_path), b'second')
+
+    def test_restore_to_target_dir(self):
+        restored_files = self.runner.restore_backup(
+            'Config', 'Service', 'dev', '2017-06-01T09:30:00', target_dir=self.source_dir
+        )
+        self.assertEqual(restored_files, [self.source_path])
+        self.assertEqual(self.read_file(self.source_path), b'first')
+
+    def test_unknown_timestamp(self):
+        with self.assertRaises(RuntimeError):
+            self.runner.restore_backup('Config', 'Service', 'dev', '2017-06-02T00:00:00')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+from __future__ import unicode_literals
+
+import json
+import unittest
+
+from ags_service_publisher.ags_utils import AgsAdminClient
+from stub_server import StubServer
+
+started_status = dict(configuredState='STARTED', realTimeState='STARTED')
+stopped_status = dict(configuredState='STOPPED', realTimeState='STOPPED')
+unreported_status = dict(configuredState='STARTED', realTimeState='STOPPED')
+
+
+def get_report(service_name, service_type, status):
+    # Mirrors the entries of the reports array returned by admin/services/<folder>/report
+    return dict(
+        folderName='Folder',
+        serviceName=service_name,
+        type=service_type,
+        description='',
+        isDefault=False,
+        isPrivate=False,
+        hasManifest=True,
+        status=status,
+        iteminfo=dict(summary='{} summary'.format(service_name), tags=['tag'])
+    )
+
+
+def handle(path, form, files):
+    if path[-2:] == ['Folder', 'report']:
+        return dict(reports=[
+            get_report('Streets', 'MapServer', started_status),
+            get_report('Streets', 'FeatureServer', stopped_status),
+            get_report('Locator', 'GeocodeServer', stopped_status)
+        ])
+    if path[-2:] == ['Unreported.MapServer', 'status']:
+        return unreported_status
+    return dict(status='error', messages=['Unexpected request: {}'.format('/'.join(path))])
+
+
+class ServiceFolderReportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(handle)
+        self.client = AgsAdminClient(self.server.url, 'token', max_retries=0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_statuses_come_from_one_report_request(self):
+        self.assertEqual(self.client.get_cached_service_status('Streets', 'Folder', 'MapServer'), started_status)
+        self.assertEqual(self.client.get_cached_service_status('Streets', 'Folder', 'FeatureServer'), stopped_status)
+        self.assertEqual(self.client.get_cached_service_status('Locator', 'Folder', 'GeocodeServer'), stopped_status)
+        report_requests = self.server.get_requests('report')
+        self.assertEqual(len(report_requests), 1)
+        self.assertEqual(json.loads(report_requests[0]['parameters']), ['status', 'iteminfo'])
+        self.assertEqual(self.server.get_requests('status'), [])
+
+    def test_report_includes_service_info(self):
+        report = self.client.get_cached_service_report('Locator', 'Folder', 'GeocodeServer')
+        self.assertEqual(report['iteminfo'], dict(summary='Locator summary', tags=['tag']))
+        self.assertTrue(report['hasManifest'])
+        self.assertIsNone(self.client.get_cached_service_report('Locator', 'Folder', 'MapServer'))
+
+    def test_unreported_service_falls_back_to_its_status(self):
+        self.assertEqual(self.client.get_cached_service_status('Unreported', 'Folder', 'MapServer'), unreported_status)
+        self.assertEqual(len(self.server.get_requests('report')), 1)
+        self.assertEqual(len(self.server.get_requests('status')), 1)
+
+    def test_invalidated_report_is_requested_again(self):
+        self.client.get_cached_service_status('Streets', 'Folder', 'MapServer')
+        self.client.invalidate_service_reports('Folder')
+        self.client.get_cached_service_status('Streets', 'Folder', 'MapServer')
+        self.assertEqual(len(self.server.get_requests('report')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()